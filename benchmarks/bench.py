@@ -0,0 +1,423 @@
+"""
+Benchmarks of the public API of mongostats.
+
+Every benchmark reports the operations per second, the database round trips
+per operation and the median and p99 latency. The round trips are counted
+with a pymongo command listener against a server, with `--mongomock` they are
+the calls of the mongomock collection methods.
+
+    python benchmarks/bench.py                        #mongod on localhost
+    python benchmarks/bench.py --uri mongodb://host:27017/
+    python benchmarks/bench.py --mongomock --scale 0.01
+    python benchmarks/bench.py --only on_event,get_data_view,get_many
+
+The default load is 1M events, 100k sessions and 10k MultiNumericStat keys,
+`--scale` multiplies these. The `mongostats_bench` database is dropped before
+and after the run. mongomock does not implement every aggregation operator,
+the benchmarks using them are reported as unsupported.
+
+The asyncio stats run against `pymongo.AsyncMongoClient` or Motor, with
+`--mongomock` against an asyncio wrapper of mongomock. Their reads are
+checked against the written events.
+"""
+import argparse
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+import typing
+from datetime import datetime,timedelta,timezone
+from zoneinfo import ZoneInfo
+
+import pymongo
+import pymongo.errors
+import pymongo.monitoring
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import mongostats as stat
+
+DATABASE = "mongostats_bench"
+
+
+class CommandCounter(pymongo.monitoring.CommandListener):
+    """
+    Counts the commands sent to the server
+    """
+    def __init__(self) -> None:
+        self.count = 0
+
+    def started(self,event) -> None:
+        self.count += 1
+
+    def succeeded(self,event) -> None:
+        pass
+
+    def failed(self,event) -> None:
+        pass
+
+
+class MongomockCounter:
+    """
+    Counts the calls of the mongomock collection methods, each is one round
+    trip on a server. The calls made by an other counted method (find_one
+    calls find) and the further batches of a cursor are not counted
+    """
+    METHODS = ("find","find_one","aggregate","insert_one","insert_many","update_one",
+               "update_many","replace_one","delete_one","delete_many","bulk_write",
+               "count_documents","estimated_document_count","distinct","find_one_and_update",
+               "find_one_and_replace","find_one_and_delete","create_index","create_indexes","drop")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def install(self) -> None:
+        import mongomock.collection
+        for name in MongomockCounter.METHODS:
+            method = getattr(mongomock.collection.Collection,name)
+            setattr(mongomock.collection.Collection,name,self._wrap(method))
+
+    def _wrap(self,method):
+        @functools.wraps(method)
+        def call(*args,**kwargs):
+            depth = getattr(self._local,"depth",0)
+            if not depth:
+                with self._lock:
+                    self.count += 1
+            self._local.depth = depth+1
+            try:
+                return method(*args,**kwargs)
+            finally:
+                self._local.depth = depth
+        return call
+
+
+class AsyncMongomock:
+    """
+    In-memory asyncio stand-in of a client, wraps a mongomock client with
+    the awaitable pymongo API the async stats use
+    """
+    class Cursor:
+        def __init__(self,cursor) -> None:
+            self.cursor = cursor
+
+        async def to_list(self,length) -> list:
+            return list(self.cursor)
+
+    class Collection:
+        def __init__(self,collection) -> None:
+            self.collection = collection
+
+        def find(self,*args,**kwargs):
+            return AsyncMongomock.Cursor(self.collection.find(*args,**kwargs))
+
+        def aggregate(self,pipeline,**kwargs):
+            return AsyncMongomock.Cursor(self.collection.aggregate(pipeline,**kwargs))
+
+        def __getattr__(self,name:str):
+            method = getattr(self.collection,name)
+
+            async def call(*args,**kwargs):
+                return method(*args,**kwargs)
+            return call
+
+    class Database:
+        def __init__(self,database) -> None:
+            self.database = database
+
+        def __getitem__(self,name:str):
+            return AsyncMongomock.Collection(self.database[name])
+
+    def __init__(self,client) -> None:
+        self.client = client
+
+    def __getitem__(self,name:str):
+        return AsyncMongomock.Database(self.client[name])
+
+
+def create_async_client(args,client):
+    """
+    Returns an asyncio client of the benchmark server, None if no asyncio
+    driver is installed
+    """
+    if args.mongomock:
+        return AsyncMongomock(client)
+    if hasattr(pymongo,"AsyncMongoClient"):
+        return pymongo.AsyncMongoClient(args.uri)
+    try:
+        import motor.motor_asyncio
+    except ImportError:
+        return None
+    return motor.motor_asyncio.AsyncIOMotorClient(args.uri)
+
+
+def check(name:str,actual,expected) -> None:
+    if actual != expected:
+        print("%-44s wrong result: %r, expected %r" % (name,actual,expected))
+
+
+class Result(typing.NamedTuple):
+    name: str
+    ops: int
+    ops_per_sec: float
+    round_trips: typing.Optional[float]
+    p50_ms: float
+    p99_ms: float
+
+
+def percentile(latencies:typing.List[float],fraction:float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered)-1,int(len(ordered)*fraction))]
+
+
+class Runner:
+    def __init__(self,counter,only:typing.Set[str]) -> None:
+        self.counter = counter
+        self.only = only
+        self.results = []
+
+    def run(self,name:str,op:typing.Callable[[int],typing.Any],count:int,
+            finish:typing.Callable[[],typing.Any]=None) -> int:
+        """
+        Calls `op(i)` `count` times, `finish` is called after the loop and is
+        included in the throughput but not in the latencies. Returns the
+        number of calls, 0 if the benchmark is not selected or unsupported
+        """
+        if self.only and not any(part in name for part in self.only):
+            return 0
+        count = max(1,count)
+        latencies = []
+        if self.counter:
+            self.counter.count = 0
+        try:
+            start = time.perf_counter()
+            for i in range(count):
+                begin = time.perf_counter()
+                op(i)
+                latencies.append(time.perf_counter()-begin)
+            if finish:
+                finish()
+            total = time.perf_counter()-start
+        except (NotImplementedError,ImportError,pymongo.errors.OperationFailure) as e:
+            print("%-44s unsupported: %s" % (name,str(e).splitlines()[0][:60]))
+            return 0
+        round_trips = self.counter.count/count if self.counter else None
+        result = Result(name,count,count/total,round_trips,
+                        percentile(latencies,0.5)*1000,percentile(latencies,0.99)*1000)
+        self.results.append(result)
+        print("%-44s %9d %12.0f %8s %9.3f %9.3f" % (
+            result.name,result.ops,result.ops_per_sec,
+            "-" if round_trips is None else "%.2f" % round_trips,
+            result.p50_ms,result.p99_ms))
+        return count
+
+
+def seed_minutes(stat_obj,start:datetime,end:datetime) -> None:
+    """
+    Writes a value into every minute of the range and moves the rollup
+    watermarks to its start, so the next rollup processes the whole range
+    """
+    db = stat.main.database
+    docs = []
+    time_ = start
+    while time_ < end:
+        docs.append({"_id":time_,"value":(time_.minute % 7) + 1})
+        time_ += timedelta(minutes=1)
+    stat_obj._get_collection(stat.EventInterval.MINUTE).insert_many(docs,ordered=False)
+    for interval in stat_obj.intervals[1:]:
+        db[stat.main.WATERMARK_COLLECTION].replace_one(
+            {"_id":stat_obj._get_watermark_name(interval)},
+            {"time":stat_obj._get_bucket(interval,start)},upsert=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="mongostats benchmarks")
+    parser.add_argument("--uri",default="mongodb://localhost:27017/")
+    parser.add_argument("--mongomock",action="store_true",
+                        help="use mongomock instead of a server")
+    parser.add_argument("--scale",type=float,default=1.0,
+                        help="multiplier of the generated load")
+    parser.add_argument("--only",default="",
+                        help="comma separated parts of the benchmark names to run")
+    args = parser.parse_args()
+
+    events = int(1000000*args.scale)
+    sessions = int(100000*args.scale)
+    keys = max(1,int(10000*args.scale))
+    queries = max(10,int(200*args.scale))
+
+    if args.mongomock:
+        import mongomock
+        counter = MongomockCounter()
+        counter.install()
+        client = mongomock.MongoClient()
+    else:
+        counter = CommandCounter()
+        client = pymongo.MongoClient(args.uri,event_listeners=[counter])
+    client.drop_database(DATABASE)
+    stat.initialize_connection(client,DATABASE)
+
+    runner = Runner(counter,{part for part in args.only.split(",") if part})
+    print("%-44s %9s %12s %8s %9s %9s" % ("benchmark","ops","ops/sec","rt/op","p50 ms","p99 ms"))
+
+    #events
+    event_stat = stat.EventStat("bench_event")
+    runner.run("EventStat.on_event",lambda i: event_stat.on_event(),events)
+
+    stat.configure_write_buffer(max_size=1000,max_age=1.0)
+    buffered_stat = stat.EventStat("bench_buffered",buffered=True)
+    runner.run("EventStat.on_event buffered",lambda i: buffered_stat.on_event(),events,
+               finish=stat.flush)
+
+    numeric_stat = stat.NumericStat("bench_numeric")
+    runner.run("NumericStat.on_event",lambda i: numeric_stat.on_event(i % 100),events // 10)
+
+    multi_stat = stat.MultiNumericStat("bench_multi")
+    runner.run("MultiNumericStat.on_event (%d keys)" % keys,
+               lambda i: multi_stat.on_event("key%d" % (i % keys),1),events // 10)
+
+    top_stat = stat.MultiNumericStat("bench_top",buffered=True,top_k=100)
+    runner.run("MultiNumericStat.on_event top_k=100",
+               lambda i: top_stat.on_event("key%d" % (i % keys),1),events // 10,
+               finish=lambda: top_stat._drain_heavy_hitters())
+
+    distribution_stat = stat.DistributionStat("bench_distribution")
+    runner.run("DistributionStat.on_event",
+               lambda i: distribution_stat.on_event((i % 1000) / 10 + 0.1),events // 10)
+
+    #sessions
+    state_stat = stat.StateStat("bench_sessions",start_event="bench_login",end_event="bench_logout",
+                                magnitude_event="bench_ccu",duration_event="bench_duration",
+                                unique_start_event="bench_unique",event_tracking="bench_tracking",
+                                funnels={"bench_funnel":["view","cart","pay"]})
+    steps = ["view","cart","pay"]
+    runner.run("StateStat.on_start_event",lambda i: state_stat.on_start_event(i),sessions)
+    runner.run("StateStat.on_custom_event",
+               lambda i: state_stat.on_custom_event(i // 2 % sessions,steps[i % 3]),sessions*2)
+    runner.run("StateStat.on_end_event",lambda i: state_stat.on_end_event(i),sessions)
+
+    memory_stat = stat.StateStat("bench_memory",magnitude_event="bench_memory_ccu",in_memory=True)
+    runner.run("StateStat.on_start_event in_memory",lambda i: memory_stat.on_start_event(i),sessions,
+               finish=memory_stat.checkpoint)
+    runner.run("StateStat.on_end_event in_memory",lambda i: memory_stat.on_end_event(i),sessions,
+               finish=memory_stat.checkpoint)
+
+    #rollups over 30 days of minutes
+    now = datetime.now()
+    history_stat = stat.EventStat("bench_history")
+    seed_minutes(history_stat,now-timedelta(days=30),now)
+    runner.run("EventStat.on_interval (30 days)",lambda i: history_stat.on_interval(),1)
+    runner.run("EventStat.on_interval (steady)",lambda i: history_stat.on_interval(),queries)
+    runner.run("MultiNumericStat.on_interval",lambda i: multi_stat.on_interval(),1)
+    runner.run("StateStat.on_interval",lambda i: state_stat.on_interval(),1)
+    runner.run("run_interval",lambda i: stat.run_interval(),1)
+
+    #a UTC stat read in the New York days, from its rolled up hours
+    utc_now = datetime.now(timezone.utc)
+    zoned_stat = stat.EventStat("bench_zoned",timezone=ZoneInfo("UTC"))
+    seed_minutes(zoned_stat,(utc_now-timedelta(days=30)).replace(tzinfo=None),utc_now.replace(tzinfo=None))
+    runner.run("EventStat.on_interval zoned (30 days)",lambda i: zoned_stat.on_interval(),1)
+
+    #queries
+    interval = stat.EventInterval
+    runner.run("EventStat.get_data_view MINUTE 1 day",
+               lambda i: history_stat.get_data_view(interval.MINUTE,now-timedelta(days=1),now),queries)
+    runner.run("EventStat.get_data_view HOUR 30 days",
+               lambda i: history_stat.get_data_view(interval.HOUR,now-timedelta(days=30),now),queries)
+    runner.run("EventStat.iter_data_view MINUTE 30 days",
+               lambda i: sum(len(keys) for keys,_ in history_stat.iter_data_view(
+                   interval.MINUTE,now-timedelta(days=30),now)),
+               max(1,queries // 10))
+    runner.run("EventStat.get_series MINUTE 1 day",
+               lambda i: history_stat.get_series(interval.MINUTE,now-timedelta(days=1),now),queries)
+    runner.run("get_many 2 EventStats MINUTE 1 day",
+               lambda i: stat.get_many([history_stat,event_stat],interval.MINUTE,
+                                       now-timedelta(days=1),now),queries)
+    runner.run("get_many Event+MultiNumeric MINUTE 1 hour",
+               lambda i: stat.get_many([history_stat,multi_stat],interval.MINUTE,
+                                       now-timedelta(hours=1),now),
+               max(1,queries // 10))
+    runner.run("MultiNumericStat.get_data_view MINUTE 1 hour",
+               lambda i: multi_stat.get_data_view(interval.MINUTE,now-timedelta(hours=1),now),
+               max(1,queries // 10))
+    runner.run("MultiNumericStat.get_series MINUTE 1 hour",
+               lambda i: multi_stat.get_series(interval.MINUTE,now-timedelta(hours=1),now),
+               max(1,queries // 10))
+    runner.run("MultiNumericStat.iter_data_view MINUTE 1 hour",
+               lambda i: sum(len(keys) for keys,_ in multi_stat.iter_data_view(
+                   interval.MINUTE,now-timedelta(hours=1),now)),
+               max(1,queries // 10))
+    runner.run("DistributionStat.get_quantiles 1 hour",
+               lambda i: distribution_stat.get_quantiles(interval.MINUTE,now-timedelta(hours=1),now),
+               queries)
+    zone = ZoneInfo("America/New_York")
+    runner.run("EventStat.get_zoned_data_view DAY 30 days",
+               lambda i: zoned_stat.get_zoned_data_view(interval.DAY,utc_now-timedelta(days=30),
+                                                        utc_now,zone),queries)
+    later = datetime.now()+timedelta(minutes=1)
+    runner.run("StateStat.get_funnel_analysis",
+               lambda i: state_stat.get_funnel_analysis(now-timedelta(hours=1),later,steps),
+               max(1,queries // 10))
+    runner.run("StateStat.get_funnel",
+               lambda i: state_stat.get_funnel("bench_funnel",interval.MINUTE,now-timedelta(hours=1),later),
+               queries)
+
+    #asyncio
+    async_client = create_async_client(args,client)
+    if async_client is None:
+        print("asyncio: no asyncio driver installed, skipped")
+    else:
+        run_async(runner,async_client,events,queries)
+
+    client.drop_database(DATABASE)
+
+
+def run_async(runner:Runner,async_client,events:int,queries:int) -> None:
+    stat.initialize_async_connection(async_client,DATABASE)
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    interval = stat.EventInterval
+    start = datetime.now()-timedelta(minutes=1)
+
+    event_stat = stat.AsyncEventStat("bench_async_event")
+    count = max(1,events // 10)
+    written = runner.run("AsyncEventStat.on_event",lambda i: run(event_stat.on_event()),count)
+    runner.run("AsyncEventStat.on_interval",lambda i: run(event_stat.on_interval()),1)
+    runner.run("AsyncEventStat.get_data_view MINUTE",
+               lambda i: run(event_stat.get_data_view(interval.MINUTE,start,datetime.now())),queries)
+    _,values = run(event_stat.get_data_view(interval.MINUTE,start,datetime.now()))
+    check("AsyncEventStat.get_data_view",sum(values),written)
+
+    multi_stat = stat.AsyncMultiNumericStat("bench_async_multi")
+    run(multi_stat.create_indexes())
+    written = runner.run("AsyncMultiNumericStat.on_event",
+                         lambda i: run(multi_stat.on_event("key%d" % (i % 10),1)),count)
+    runner.run("AsyncMultiNumericStat.on_interval",lambda i: run(multi_stat.on_interval()),1)
+    _,values = run(multi_stat.get_data_view(interval.MINUTE,start,datetime.now()))
+    check("AsyncMultiNumericStat.get_data_view",sum(sum(value.values()) for value in values),written)
+
+    #the DAY buckets of a zoned stat start at the local midnight
+    zone = ZoneInfo("America/New_York")
+    state_stat = stat.AsyncStateStat("bench_async_sessions",start_event="bench_async_login",
+                                     timezone=zone)
+    run(state_stat.create_indexes())
+    sessions = max(1,count // 10)
+    written = runner.run("AsyncStateStat.on_start_event",lambda i: run(state_stat.on_start_event(i)),
+                         sessions)
+    runner.run("AsyncStateStat.on_end_event",lambda i: run(state_stat.on_end_event(i)),sessions)
+    runner.run("AsyncStateStat.on_interval",lambda i: run(state_stat.on_interval()),1)
+    now = datetime.now(tz=zone)
+    _,values = run(state_stat.start_event.get_data_view(interval.MINUTE,now-timedelta(minutes=1),now))
+    check("AsyncStateStat start events",sum(values),written)
+    keys,_ = run(state_stat.start_event.get_data_view(interval.DAY,now-timedelta(days=1),now))
+    midnight = now.replace(hour=0,minute=0,second=0,microsecond=0)
+    check("AsyncStateStat DAY keys",keys[-1],
+          midnight.astimezone(timezone.utc).replace(tzinfo=None))
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Cold start cost of mongostats, as paid by every new AWS Lambda container.
+
+Every measurement runs in a fresh interpreter. It reports:
+- the import time of the package, lazily and with every optional submodule
+- the time and round trips of creating the stats
+- the time and round trips of their first writes
+- the time and round trips of `ensure_schema()`
+
+    python benchmarks/cold_start.py                   #mongod on localhost
+    python benchmarks/cold_start.py --mongomock       #round trips as collection calls
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..")
+
+#pymongo is imported first, the application needs it for the client anyway
+IMPORT_LAZY = """
+import pymongo, time
+started = time.perf_counter()
+import mongostats
+print(time.perf_counter() - started)
+"""
+
+IMPORT_EAGER = """
+import pymongo, time
+started = time.perf_counter()
+import mongostats
+import mongostats.aio, mongostats.storage, mongostats.scheduler, mongostats.cache
+import mongostats.query, mongostats.diagnostics, mongostats.spool
+print(time.perf_counter() - started)
+"""
+
+STATS = """
+import json, sys, time
+sys.path.insert(0, %(benchmarks)r)
+import mongostats as stat
+from bench import CommandCounter, MongomockCounter
+
+if %(mongomock)r:
+    import mongomock
+    counter = MongomockCounter()
+    counter.install()
+    client = mongomock.MongoClient()
+else:
+    import pymongo
+    counter = CommandCounter()
+    client = pymongo.MongoClient(%(uri)r, event_listeners=[counter])
+client.drop_database("mongostats_cold_start")
+stat.initialize_connection(client, "mongostats_cold_start")
+result = {}
+
+def measure(name, func):
+    counter.count = 0
+    started = time.perf_counter()
+    func()
+    result[name] = (time.perf_counter() - started, counter.count)
+
+stats = []
+def create():
+    for i in range(%(count)d):
+        stats.append(stat.MultiNumericStat("cold_multi%%d" %% i))
+        stats.append(stat.StateStat("cold_state%%d" %% i, expire_after_seconds=3600,
+                                    event_tracking="cold_tracking%%d" %% i))
+
+def first_writes():
+    for i in range(0, len(stats), 2):
+        stats[i].on_event("key", 1)
+        stats[i+1].on_start_event("id")
+
+measure("create stats", create)
+measure("first writes", first_writes)
+measure("ensure_schema (after the writes)", stat.ensure_schema)
+client.drop_database("mongostats_cold_start")
+print(json.dumps(result))
+"""
+
+
+def run(code:str) -> str:
+    env = dict(os.environ,PYTHONPATH=ROOT+os.pathsep+os.environ.get("PYTHONPATH",""))
+    return subprocess.run([sys.executable,"-c",code],check=True,capture_output=True,
+                          text=True,env=env).stdout.strip().splitlines()[-1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="mongostats cold start benchmark")
+    parser.add_argument("--uri",default="mongodb://localhost:27017/")
+    parser.add_argument("--mongomock",action="store_true",
+                        help="use mongomock instead of a server")
+    parser.add_argument("--stats",type=int,default=10,
+                        help="number of MultiNumericStat and StateStat pairs")
+    parser.add_argument("--repeat",type=int,default=5)
+    args = parser.parse_args()
+
+    print("%-36s %10s %8s" % ("step","ms","rt"))
+    for name,code in (("import mongostats",IMPORT_LAZY),
+                      ("import with every submodule",IMPORT_EAGER)):
+        times = [float(run(code)) for _ in range(args.repeat)]
+        print("%-36s %10.1f %8s" % (name,statistics.median(times)*1000,"-"))
+
+    result = json.loads(run(STATS % {"benchmarks":os.path.dirname(os.path.abspath(__file__)),
+                                     "mongomock":args.mongomock,"uri":args.uri,
+                                     "count":args.stats}))
+    for name,(seconds,round_trips) in result.items():
+        print("%-36s %10.1f %8s" % (name,seconds*1000,"-" if round_trips is None else round_trips))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,44 @@
-from .main import initialize_connection, EventStat, StateStat, ConfigError, EventInterval, NumericStat, MultiNumericStat
+from .main import initialize_connection, EventStat, StateStat, ConfigError, EventInterval, NumericStat, MultiNumericStat, DistributionStat, ensure_schema
+from .buffer import configure_write_buffer, flush, shutdown, start_background_flush
+from .metrics import enable_metrics, disable_metrics, reset_metrics, get_metrics, get_prometheus_text, start_metrics_server
 
-__all__ = ['initialize_connection', 'EventStat', 'StateStat', 'ConfigError', 'EventInterval','NumericStat','MultiNumericStat']
\ No newline at end of file
+__all__ = ['initialize_connection', 'EventStat', 'StateStat', 'ConfigError', 'EventInterval','NumericStat','MultiNumericStat','DistributionStat',
+           'ensure_schema',
+           'initialize_async_connection','AsyncEventStat','AsyncNumericStat','AsyncMultiNumericStat','AsyncStateStat',
+           'BucketedStorage','TimeSeriesStorage','migrate_to_bucketed',
+           'run_interval','IntervalResult',
+           'configure_write_buffer','flush','shutdown','start_background_flush',
+           'BucketCache','get_many',
+           'explain','find_collection_scans','QueryPlan',
+           'Spool',
+           'enable_metrics','disable_metrics','reset_metrics','get_metrics','get_prometheus_text','start_metrics_server']
+
+#the optional parts are imported at their first use (PEP 562), importing the
+#package stays cheap for short lived processes like AWS Lambda
+_LAZY = {
+    'initialize_async_connection': 'aio', 'AsyncEventStat': 'aio', 'AsyncNumericStat': 'aio',
+    'AsyncMultiNumericStat': 'aio', 'AsyncStateStat': 'aio',
+    'BucketedStorage': 'storage', 'TimeSeriesStorage': 'storage', 'migrate_to_bucketed': 'storage',
+    'run_interval': 'scheduler', 'IntervalResult': 'scheduler',
+    'BucketCache': 'cache',
+    'get_many': 'query',
+    'explain': 'diagnostics', 'find_collection_scans': 'diagnostics', 'QueryPlan': 'diagnostics',
+    'Spool': 'spool',
+}
+_SUBMODULES = {'aio', 'storage', 'scheduler', 'cache', 'query', 'diagnostics', 'spool', 'series', 'sketches', 'bucketing'}
+
+
+def __getattr__(name):
+    import importlib
+
+    if name in _SUBMODULES:
+        return importlib.import_module('.'+name, __name__)
+    if name not in _LAZY:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module('.'+_LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | _SUBMODULES)
@@ -0,0 +1,450 @@
+"""
+asyncio variants of the stat classes. They share the bucketing and the
+aggregation pipelines with the blocking classes, only the database calls are
+awaited. Any asyncio MongoDB driver with the pymongo API can be used, for
+example `motor.motor_asyncio.AsyncIOMotorClient` or `pymongo.AsyncMongoClient`.
+"""
+import asyncio
+import functools
+import inspect
+import math
+import typing
+from datetime import datetime
+
+import pymongo.errors
+
+from . import metrics
+from .main import (WATERMARK_COLLECTION,ConfigError,EventInterval,
+                   EventStat,MultiNumericStat,StatBase,StateStat)
+
+database = None
+
+
+def initialize_async_connection(mongoclient,dbname:str):
+    """
+    This function initializes the asyncio database connection for the
+    statistics
+    """
+    global database
+    database = mongoclient[dbname]
+
+
+# Decorator for error handling
+def handle_database_errors(func):
+    @functools.wraps(func)
+    async def wrapper(*args,**kwargs):
+        if database is None:
+            raise ConfigError("The async database connection is not initialized")
+        if not metrics.enabled:
+            return await func(*args,**kwargs)
+        return await metrics.measure_async(func,args,kwargs)
+    return wrapper
+
+
+def _unsupported(name:str):
+    #the blocking reads of the base classes can not iterate an async cursor
+    def method(self,*args,**kwargs):
+        raise ConfigError("The async stats do not support %s" % name)
+    method.__name__ = name
+    return method
+
+
+async def _aggregate(coll,pipeline:list) -> list:
+    #motor returns the cursor directly, the pymongo async API needs an await
+    cursor = coll.aggregate(pipeline)
+    if inspect.isawaitable(cursor):
+        cursor = await cursor
+    return await cursor.to_list(None)
+
+
+async def _load_watermarks(names:typing.List[str]) -> typing.Dict[str,datetime]:
+    if not names:
+        return {}
+    cursor = database[WATERMARK_COLLECTION].find({"_id":{"$in":names}})
+    return {doc["_id"]:doc["time"] for doc in await cursor.to_list(None)}
+
+
+async def _rollup(stat:StatBase,now:datetime,time_field:str,group:dict) -> None:
+    """
+    Rolls up every closed period since the last run, see
+    :meth:`EventStat._rollup`
+    """
+    watermarks = await _load_watermarks(stat._get_watermark_names())
+    windows = stat._get_pending_windows(now,watermarks)
+    if not windows:
+        return
+
+    coll = stat._get_collection(stat.intervals[0])
+    result = (await _aggregate(coll,stat._get_facet_pipeline(windows,time_field,group)))[0]
+    #every interval is computed from the smallest one, the writes are independent
+    await asyncio.gather(*(
+        stat._get_collection(interval).bulk_write(updates,ordered=False)
+        for interval,updates in stat._get_rollup_updates(windows,result)
+        if updates))
+    await database[WATERMARK_COLLECTION].bulk_write(
+        stat._get_watermark_updates(windows),ordered=False)
+
+
+async def _stream_rollup(stat:MultiNumericStat,now:datetime) -> None:
+    """
+    Rolls up every closed period since the last run one interval at a time,
+    see :meth:`MultiNumericStat._rollup`
+    """
+    watermarks = await _load_watermarks(stat._get_watermark_names())
+    coll = stat._get_collection(stat.intervals[0])
+    for window in stat._get_pending_windows(now,watermarks):
+        cursor = coll.aggregate(stat._get_group_pipeline(*window,"_id.time",{"key":"$_id.key"}),
+                                allowDiskUse=True,batchSize=stat.rollup_batch_size)
+        if inspect.isawaitable(cursor):
+            cursor = await cursor
+        while True:
+            docs = await cursor.to_list(stat.rollup_batch_size)
+            if not docs:
+                break
+            for updates in stat._get_rollup_batches(docs):
+                await stat._get_collection(window[0]).bulk_write(updates,ordered=False)
+        await database[WATERMARK_COLLECTION].bulk_write(
+            stat._get_watermark_updates([window]),ordered=False)
+
+
+async def run_interval(stats:typing.Iterable) -> None:
+    """
+    Awaits the `on_interval` of the given async stats concurrently
+    """
+    await asyncio.gather(*(stat.on_interval() for stat in stats))
+
+
+class AsyncEventStat(EventStat):
+    """
+    asyncio variant of :class:`EventStat`
+    """
+    def __init__(self, name: str,
+                 min_interval: EventInterval = EventInterval.MINUTE,
+                 max_interval: EventInterval = EventInterval.MONTH,
+                 timezone=None) -> None:
+        super().__init__(name, min_interval, max_interval, timezone=timezone)
+
+    iter_data_view = _unsupported("iter_data_view")
+    get_series = _unsupported("get_series")
+    get_zoned_data_view = _unsupported("get_zoned_data_view")
+
+    def _get_collection(self,interval:EventInterval):
+        return database[self.name+"_"+str(interval)]
+
+    @handle_database_errors
+    async def on_event(self) -> None:
+        """
+        Call this function when the event happens
+        """
+        await self._inc(1)
+
+    async def _inc(self,count) -> None:
+        smallestInterval = self.intervals[0]
+        time = self._get_bucket(smallestInterval)
+
+        coll = self._get_collection(smallestInterval)
+        await coll.update_one({"_id":time},{"$inc":{"value":count}},True)
+
+    @handle_database_errors
+    async def on_interval(self) -> None:
+        """
+        Call this function periodically, at least as often as the second
+        smallest interval
+        """
+        await self._rollup(self._get_now())
+
+    async def _rollup(self,now:datetime) -> None:
+        await _rollup(self,now,"_id",None)
+
+    @handle_database_errors
+    async def get_data_view(self,interval:EventInterval,start_date:datetime,
+                            end_date:datetime) -> typing.Tuple[typing.List[datetime],typing.List[int]]:
+        """
+        Gets the collected data from the time range.
+        Returns a list of keys and values as `list[datetime], list[int]`
+        """
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        cursor = self._find_data_view(interval,start_date,end_date)
+        docs = await cursor.to_list(None)
+        return self._build_data_view(interval,start_date,end_date,docs)
+
+
+class AsyncNumericStat(AsyncEventStat):
+    """
+    asyncio variant of :class:`NumericStat`
+    """
+    @handle_database_errors
+    async def on_event(self,count) -> None:
+        """
+        Call this function when the event happens
+        """
+        if not math.isfinite(count):
+            return
+        await self._inc(count)
+
+
+class AsyncMultiNumericStat(MultiNumericStat):
+    """
+    asyncio variant of :class:`MultiNumericStat`. Call `create_indexes` once
+    before using it
+    """
+    def __init__(self, name: str,
+                 min_interval: EventInterval = EventInterval.MINUTE,
+                 max_interval: EventInterval = EventInterval.MONTH,
+                 timezone=None) -> None:
+        super().__init__(name, min_interval, max_interval, timezone=timezone)
+
+    iter_data_view = _unsupported("iter_data_view")
+    get_series = _unsupported("get_series")
+
+    def _get_collection(self,interval:EventInterval):
+        return database[self.name+"_"+str(interval)]
+
+    @handle_database_errors
+    async def create_indexes(self) -> None:
+        await asyncio.gather(*(
+            coll.create_index(keys,**options)
+            for coll,keys,options in self._get_index_specs()))
+
+    @handle_database_errors
+    async def on_event(self,parameter,count) -> None:
+        """
+        Call this function when the event happens
+        """
+        smallestInterval = self.intervals[0]
+        time = self._get_bucket(smallestInterval)
+
+        coll = self._get_collection(smallestInterval)
+        await coll.update_one({"_id":{"time":time,"key":parameter}},{"$inc":{"value":count}},True)
+
+    @handle_database_errors
+    async def on_interval(self) -> None:
+        """
+        Call this function periodically, at least as often as the second
+        smallest interval
+        """
+        await _stream_rollup(self,self._get_now())
+
+    @handle_database_errors
+    async def get_data_view(self,interval:EventInterval,start_date:datetime,
+                            end_date:datetime,parameters:typing.Iterable=None) -> typing.Tuple[typing.List[datetime],typing.List[dict]]:
+        """
+        Gets the collected data from the time range. If `parameters` is
+        provided only those keys are read.
+        Returns a list of keys and values as `list[datetime], list[dict]`
+        """
+        if parameters is not None:
+            parameters = list(parameters)
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        cursor = self._find_data_view(interval,start_date,end_date,parameters=parameters)
+        docs = await cursor.to_list(None)
+        return self._build_data_view(interval,start_date,end_date,docs)
+
+
+class AsyncStateStat(StateStat):
+    """
+    asyncio variant of :class:`StateStat`. Call `create_indexes` once
+    before using it
+    """
+    _event_stat_class = AsyncEventStat
+    _funnel_stat_class = AsyncMultiNumericStat
+
+    def _create_event_stat(self,name:str) -> AsyncEventStat:
+        if self.storage:
+            raise ConfigError("The async stats only support the default storage")
+        return super()._create_event_stat(name)
+
+    def _set_spool(self,stat) -> None:
+        if self.spool is not None:
+            raise ConfigError("The async stats do not support the spool")
+        stat.spool = None
+
+    def _load_sessions(self) -> None:
+        raise ConfigError("The async stats do not support the in-memory sessions")
+
+    def _create_distribution_stat(self,name:str):
+        raise ConfigError("The async stats do not support the duration distribution")
+
+    def _get_session_collection(self):
+        return database[self.name+"_SESSION"]
+
+    def _get_unique_collection(self):
+        return database[self.name+"_UNIQUE"]
+
+    def _get_tracking_collection(self):
+        return database[self.event_tracking_name]
+
+    def _get_duration_collection(self):
+        return database[self.duration_event_name]
+
+    @handle_database_errors
+    async def create_indexes(self) -> None:
+        await asyncio.gather(*(
+            coll.create_index(keys,**options)
+            for coll,keys,options in self._get_index_specs()))
+
+    @handle_database_errors
+    async def on_start_event(self,id):
+        """
+        Call this function when the state starts, see
+        :meth:`StateStat.on_start_event`
+        """
+        try:
+            coll = self._get_session_collection()
+            await coll.insert_one({"_id":id,"created":self._get_now(),"events":[]})
+        except pymongo.errors.DuplicateKeyError:
+            await self.on_end_event(id)
+            await self.on_start_event(id)
+            return
+
+        pending = []
+        if self.unique_start_event:
+            closed = self._add_unique(id)
+            if closed:
+                pending.append(self._get_unique_collection().bulk_write(
+                    self._get_unique_sketch_writes(closed),ordered=False))
+
+        if self.start_event:
+            pending.append(self.start_event.on_event())
+        await asyncio.gather(*pending)
+
+    @handle_database_errors
+    async def on_end_event(self,id):
+        """
+        Call this function when the state ends, see
+        :meth:`StateStat.on_end_event`
+        """
+        coll = self._get_session_collection()
+        doc = await coll.find_one_and_delete({"_id":id})
+        if not doc:
+            return
+
+        pending = []
+        if self.end_event:
+            pending.append(self.end_event.on_event())
+
+        duration = (self._get_now() - doc["created"]).total_seconds()
+        for funnel_name,step in self._get_funnel_steps(doc):
+            pending.append(self.funnel_stats[funnel_name].on_event(step,1))
+
+        if self.duration_event_name:
+            coll = self._get_duration_collection()
+            pending.append(coll.insert_one({"duration":duration,"endTime":self._get_now()}))
+
+        if self.event_tracking_name:
+            if 'events' in doc and len(doc['events']):
+                coll = self._get_tracking_collection()
+                pending.append(coll.insert_one(self._get_tracking_document(doc,duration)))
+        await asyncio.gather(*pending)
+
+    @handle_database_errors
+    async def on_custom_event(self,id,event_name,extra_info=None,timeoffset=0):
+        """
+        Call this function when you want to add an event to the event
+        tracking, see :meth:`StateStat.on_custom_event`
+        """
+        await self.on_custom_events(id,[(event_name,extra_info,timeoffset)])
+
+    @handle_database_errors
+    async def on_custom_events(self,id,events:typing.Iterable) -> None:
+        """
+        Adds many events of a session to the event tracking in one update,
+        see :meth:`StateStat.on_custom_events`
+        """
+        events = StateStat._get_event_arguments(events)
+        if not events:
+            return
+        now = self._get_now()
+
+        coll = self._get_session_collection()
+        if self.absolute_event_times:
+            entries = [StateStat._get_timed_event(*event,now) for event in events]
+        else:
+            doc = await coll.find_one({"_id":id},projection={'created': True})
+            if not doc:
+                return
+            entries = [StateStat._get_tracked_event(doc,*event,now) for event in events]
+        await coll.update_one({"_id":id},self._get_events_update(entries))
+
+    @handle_database_errors
+    async def on_interval(self) -> None:
+        """
+        Call this function periodically, at least as often as the second
+        smallest interval
+        """
+        now = self._get_now()
+        pending = []
+        if self.start_event:
+            pending.append(self.start_event.on_interval())
+        if self.end_event:
+            pending.append(self.end_event.on_interval())
+        for stat in self.funnel_stats.values():
+            pending.append(stat.on_interval())
+        if self.magnitude_event:
+            pending.append(self._magnitude_interval(now))
+        if self.unique_start_event:
+            pending.append(self._unique_interval(now))
+        await asyncio.gather(*pending)
+
+    async def _magnitude_interval(self,now:datetime) -> None:
+        smallest_interval = self.intervals[0]
+        time = self._get_bucket(smallest_interval,now)
+
+        count = await self._get_session_collection().count_documents({})
+        coll = self.magnitude_event._get_collection(smallest_interval)
+        await coll.update_one({"_id":time},{"$max":{"value":count}},upsert=True)
+
+        await self.magnitude_event._rollup(now)
+
+    async def _unique_interval(self,now:datetime) -> None:
+        coll = self._get_unique_collection()
+        with self._unique_lock:
+            sketches = self._take_unique_sketches(self._get_bucket(self.intervals[0],now))
+            sketches.update(self._unique_sketches)
+        if sketches:
+            await coll.bulk_write(self._get_unique_sketch_writes(sketches),ordered=False)
+
+        watermarks = await _load_watermarks(
+            [self._get_unique_watermark_name(interval) for interval in self.intervals])
+        for interval,start,end in self._get_unique_windows(now,watermarks):
+            #the larger intervals are merged from the smaller ones, in order
+            docs = await coll.find(self._get_unique_source_query(interval,start,end)).to_list(None)
+            sketch_writes,value_writes = self._get_unique_updates(interval,start,end,docs)
+            if sketch_writes:
+                await coll.bulk_write(sketch_writes,ordered=False)
+            await self.unique_start_event._get_collection(interval).bulk_write(value_writes,ordered=False)
+            await database[WATERMARK_COLLECTION].update_one(
+                {"_id":self._get_unique_watermark_name(interval)},
+                {"$max":{"time":end}},upsert=True)
+            await coll.delete_many(self._get_unique_cleanup_query(interval,start,end))
+
+    @handle_database_errors
+    async def get_funnel(self,name:str,interval:EventInterval,start_date:datetime,
+                         end_date:datetime) -> typing.List[typing.Tuple[int,int]]:
+        """
+        Reads a registered funnel, see :meth:`StateStat.get_funnel`
+        """
+        if name not in self.funnel_stats:
+            raise ConfigError("There is no registered funnel named "+name)
+        _,values = await self.funnel_stats[name].get_data_view(interval,start_date,end_date)
+        return StateStat._sum_funnel_steps(values)
+
+    @handle_database_errors
+    async def get_funnel_analysis(self,start_date:datetime,end_date:datetime,
+                                  event_list:typing.List[str]) -> typing.List[typing.Tuple[str,int]]:
+        """
+        Makes a funnel analysis for the given time range, see
+        :meth:`StateStat.get_funnel_analysis`
+        """
+        if not self.event_tracking_name:
+            return []
+
+        if len(event_list) < 2:
+            return []
+
+        coll = self._get_tracking_collection()
+        docs = await _aggregate(coll,StateStat._get_funnel_pipeline(
+            self._to_stored_time(start_date),self._to_stored_time(end_date),event_list))
+        return [(doc["_id"],doc["count"]) for doc in docs]
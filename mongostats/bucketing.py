@@ -0,0 +1,145 @@
+"""
+Bucket calendar: the start of the bucket of a time and the shifting of
+buckets, in constant time. The intervals are the values of
+:class:`mongostats.EventInterval`, 1 (SECOND) to 5 (MONTH).
+
+Without a timezone the times are naive local times. With a `tz` the times
+are naive UTC times, and the buckets start at the boundaries of the zone.
+"""
+import time as _time
+from datetime import datetime,timedelta,timezone
+
+_EPOCH = datetime(1970,1,1)
+
+#length of the buckets of SECOND, MINUTE, HOUR and DAY
+_STEPS = {
+    1: timedelta(seconds=1),
+    2: timedelta(minutes=1),
+    3: timedelta(hours=1),
+    4: timedelta(days=1),
+}
+
+_TRUNCATE = {
+    1: {"microsecond":0},
+    2: {"second":0,"microsecond":0},
+    3: {"minute":0,"second":0,"microsecond":0},
+    4: {"hour":0,"minute":0,"second":0,"microsecond":0},
+    5: {"day":1,"hour":0,"minute":0,"second":0,"microsecond":0},
+}
+
+_DAYS_IN_MONTH = (31,28,31,30,31,30,31,31,30,31,30,31)
+
+
+def to_utc(time:datetime) -> datetime:
+    """
+    Converts an aware time to a naive UTC time
+    """
+    return time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def to_zone(time:datetime,tz) -> datetime:
+    """
+    Converts a naive UTC time to an aware time in `tz`
+    """
+    return time.replace(tzinfo=timezone.utc).astimezone(tz)
+
+
+def get_zone_name(tz) -> str:
+    """
+    Name of the zone accepted by the `timezone` option of the MongoDB date
+    operators
+    """
+    name = getattr(tz,"key",None) or getattr(tz,"zone",None)
+    if name:
+        return name
+    #fixed offset
+    offset = int(tz.utcoffset(None).total_seconds()) // 60
+    return "%s%02d:%02d" % ("-" if offset < 0 else "+",abs(offset) // 60,abs(offset) % 60)
+
+
+def truncate(interval:int,time:datetime,tz=None) -> datetime:
+    """
+    Returns the start of the bucket of `interval` that contains `time`
+    """
+    if tz is not None:
+        #the fold is kept, the repeated hour at the end of DST is a separate
+        #bucket
+        return to_utc(to_zone(time,tz).replace(**_TRUNCATE[interval]))
+    step = _STEPS.get(interval)
+    if step is None or time.tzinfo is not None:
+        #the months have no fixed length and the aware times may have a
+        #different offset than the epoch
+        return time.replace(**_TRUNCATE[interval])
+    return time - (time - _EPOCH) % step
+
+
+def shift(interval:int,time:datetime,amount:int,tz=None) -> datetime:
+    """
+    Returns `time` moved by `amount` buckets of `interval`. The day of the
+    month is kept if possible when months are shifted
+    """
+    if tz is not None and interval >= 4:
+        #days and months are shifted on the wall clock of the zone, a day is
+        #23 or 25 hours long at the DST changes
+        local = to_zone(time,tz)
+        wall = shift(interval,local.replace(tzinfo=None),amount)
+        return to_utc(wall.replace(tzinfo=tz))
+
+    step = _STEPS.get(interval)
+    if step is not None:
+        return time + step * amount
+
+    year,month = divmod(time.year*12 + time.month-1 + amount,12)
+    month += 1
+    days = _DAYS_IN_MONTH[month-1]
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        days = 29
+    return time.replace(year=year,month=month,day=min(time.day,days))
+
+
+def _timestamp(time:datetime,tz) -> float:
+    if tz is None:
+        return time.timestamp()
+    return time.replace(tzinfo=timezone.utc).timestamp()
+
+
+class BucketClock:
+    """
+    The start of the current bucket of an interval. It is computed only when
+    the previous bucket ends, until then reading it costs a
+    :func:`time.time` call.
+    """
+    __slots__ = ("interval","tz","_current")
+
+    def __init__(self,interval:int,tz=None) -> None:
+        self.interval = interval
+        self.tz = tz
+        #(start, start timestamp, end timestamp)
+        self._current = (None,0.0,0.0)
+
+    def now(self) -> datetime:
+        start,begin,end = self._current
+        timestamp = _time.time()
+        if begin <= timestamp < end:
+            return start
+        if self.tz is None:
+            now = datetime.fromtimestamp(timestamp)
+        else:
+            now = datetime.fromtimestamp(timestamp,timezone.utc).replace(tzinfo=None)
+        start = truncate(self.interval,now,self.tz)
+        self._current = (start,_timestamp(start,self.tz),
+                         _timestamp(shift(self.interval,start,1,self.tz),self.tz))
+        return start
+
+
+_CLOCKS = {(interval,None): BucketClock(interval) for interval in _TRUNCATE}
+
+
+def current(interval:int,tz=None) -> datetime:
+    """
+    Returns the start of the current bucket of `interval`
+    """
+    clock = _CLOCKS.get((interval,tz))
+    if clock is None:
+        clock = _CLOCKS[(interval,tz)] = BucketClock(interval,tz)
+    return clock.now()
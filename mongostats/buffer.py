@@ -0,0 +1,230 @@
+import atexit
+import logging
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Stripe:
+    __slots__ = ("lock","pending","size")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.size = 0
+
+
+class WriteBuffer:
+    """
+    Collects the increments of the buffered stats in memory and writes them
+    to the database in bulk, one write per bucket per flush.
+
+    The buffer is thread safe, the increments are spread over lock protected
+    stripes so concurrent `add` calls rarely wait for each other. The stripes
+    are merged at flush time.
+    """
+    def __init__(self,max_size:int=1000,max_age:float=1.0,
+                 stripes:int=16) -> None:
+        """
+        :Parameters:
+          - `max_size`: the buffer is flushed when this many buckets are
+            pending
+          - `max_age`: the buffer is flushed when the oldest pending increment
+            is older than this many seconds
+          - `stripes`: number of independently locked parts of the buffer
+        """
+        self.max_size = max_size
+        self.max_age = max_age
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._oldest = None
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+
+    def add(self,stat,bucket,amount) -> None:
+        """
+        Adds an increment of a stat to the buffer. The `bucket` is the key
+        the stat uses to identify the document it writes to
+        """
+        stripe = self._stripes[hash((id(stat),bucket)) % len(self._stripes)]
+        with stripe.lock:
+            increments = stripe.pending.get(stat)
+            if increments is None:
+                increments = stripe.pending[stat] = {}
+            if bucket in increments:
+                increments[bucket] += amount
+            else:
+                increments[bucket] = amount
+                stripe.size += 1
+            stripe_size = stripe.size
+
+        now = time.monotonic()
+        if self._oldest is None:
+            self._oldest = now
+
+        if (stripe_size * len(self._stripes) >= self.max_size
+                or now - self._oldest >= self.max_age):
+            if self._flusher is not None and self._flusher.is_alive():
+                #the I/O is done by the background thread
+                self._flusher.wake()
+            else:
+                self.flush()
+
+    def get_pending(self,stat) -> list:
+        """
+        Returns the buckets of `stat` with increments not written yet
+        """
+        buckets = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                buckets.extend(stripe.pending.get(stat,()))
+        return buckets
+
+    def _take(self,stat=None) -> dict:
+        """
+        Removes the pending increments from the stripes and merges them
+        """
+        pending = {}
+        for stripe in self._stripes:
+            with stripe.lock:
+                if stat is None:
+                    taken = stripe.pending
+                    stripe.pending = {}
+                    stripe.size = 0
+                else:
+                    increments = stripe.pending.pop(stat,None)
+                    if not increments:
+                        continue
+                    taken = {stat: increments}
+                    stripe.size -= len(increments)
+            for taken_stat,increments in taken.items():
+                merged = pending.get(taken_stat)
+                if merged is None:
+                    pending[taken_stat] = increments
+                else:
+                    for bucket,amount in increments.items():
+                        merged[bucket] = merged.get(bucket,0) + amount
+        if stat is None or not len(self):
+            self._oldest = None
+        return pending
+
+    def flush(self,stat=None) -> None:
+        """
+        Writes the pending increments to the database. If `stat` is provided
+        only the increments of that stat are written
+        """
+        with self._flush_lock:
+            pending = self._take(stat)
+            while pending:
+                stat,increments = pending.popitem()
+                try:
+                    with metrics.operation(stat.name,"flush"):
+                        stat._apply_increments(increments)
+                except Exception as e:
+                    #put back everything not written yet, so a failed flush
+                    #does not lose data. The applied operations of a failed
+                    #bulk write are not repeated, they would count twice
+                    pending[stat] = getattr(e,"unwritten_increments",increments)
+                    for stat,increments in pending.items():
+                        for bucket,amount in increments.items():
+                            self._requeue(stat,bucket,amount)
+                    raise
+
+    def _requeue(self,stat,bucket,amount) -> None:
+        stripe = self._stripes[hash((id(stat),bucket)) % len(self._stripes)]
+        with stripe.lock:
+            increments = stripe.pending.setdefault(stat,{})
+            if bucket in increments:
+                increments[bucket] += amount
+            else:
+                increments[bucket] = amount
+                stripe.size += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def __len__(self) -> int:
+        return sum(stripe.size for stripe in self._stripes)
+
+
+class Flusher(threading.Thread):
+    """
+    Daemon thread that periodically flushes a :class:`WriteBuffer`
+    """
+    def __init__(self,buffer:WriteBuffer,period:float) -> None:
+        super().__init__(name="mongostats-flusher",daemon=True)
+        self.buffer = buffer
+        self.period = period
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def run(self) -> None:
+        while not self._stopping:
+            self._wakeup.wait(self.period)
+            self._wakeup.clear()
+            try:
+                self.buffer.flush()
+            except Exception:
+                #the increments stay in the buffer, the next round retries
+                logger.exception("Flushing the mongostats write buffer failed")
+
+    def stop(self,timeout:float=None) -> None:
+        self._stopping = True
+        self._wakeup.set()
+        self.join(timeout)
+
+
+write_buffer = WriteBuffer()
+"The buffer used by the stats created with `buffered=True`"
+
+
+def configure_write_buffer(max_size:int=None,max_age:float=None) -> None:
+    """
+    Sets the flush thresholds of the write buffer
+    """
+    if max_size is not None:
+        write_buffer.max_size = max_size
+    if max_age is not None:
+        write_buffer.max_age = max_age
+
+
+def start_background_flush(period:float=None) -> None:
+    """
+    Starts a daemon thread that flushes the write buffer every `period`
+    seconds (by default the `max_age` of the buffer). While it runs the
+    buffered `on_event` calls never do I/O on the calling thread
+    """
+    if write_buffer._flusher is not None and write_buffer._flusher.is_alive():
+        return
+    flusher = Flusher(write_buffer,period or write_buffer.max_age)
+    write_buffer._flusher = flusher
+    flusher.start()
+
+
+def flush() -> None:
+    """
+    Writes every buffered increment to the database
+    """
+    write_buffer.flush()
+
+
+def shutdown(timeout:float=None) -> None:
+    """
+    Stops the background flusher thread and writes the remaining buffered
+    increments to the database
+    """
+    flusher = write_buffer._flusher
+    if flusher is not None:
+        flusher.stop(timeout)
+        write_buffer._flusher = None
+    write_buffer.flush()
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    if write_buffer._flusher is not None or len(write_buffer):
+        shutdown()
@@ -0,0 +1,167 @@
+"""
+Read-through cache of the closed buckets. A bucket is closed when its value
+can not change anymore: the buckets of the smallest interval some time after
+their end and the buffer flush, the larger intervals once they are rolled up.
+The late writes of the spool replays drop the buckets they change. Pass an instance as
+the `cache` parameter of the stats, one instance can be shared by any number
+of stats.
+"""
+import collections
+import pickle
+import sqlite3
+import threading
+import time
+import typing
+from datetime import datetime
+
+from .main import EventInterval
+
+
+class CacheInfo(typing.NamedTuple):
+    """
+    Counters of a :class:`BucketCache`
+    """
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    max_size: int
+
+
+class BucketCache:
+    """
+    LRU cache of bucket values keyed by `(stat, interval, bucket)`. With a
+    `path` there is a second tier in an SQLite file that is shared by the
+    processes using the same path and survives restarts, it is read when a
+    bucket is not in memory.
+    """
+    def __init__(self,max_size:int=100000,ttl:float=3600,path:str=None,
+                 grace_seconds:float=60) -> None:
+        """
+        :Parameters:
+          - `max_size`: maximum number of buckets kept in memory, the least
+            recently used ones are evicted
+          - `ttl` (optional): seconds after a bucket is read again from the
+            database, it bounds how long the late writes of other processes
+            are hidden. `None` keeps the buckets until they are evicted
+          - `path` (optional): file of the on-disk tier
+          - `grace_seconds` (optional): the buckets of the smallest interval
+            are closed this long after their end (and the flush of the write
+            buffer for the buffered stats), to let the late writes arrive
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.grace_seconds = grace_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        #key -> (value, expiry)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        if path:
+            self._disk = sqlite3.connect(path,check_same_thread=False,isolation_level=None)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(key TEXT PRIMARY KEY, value BLOB, expiry REAL)")
+
+    @staticmethod
+    def _get_key(stat_name:str,interval:EventInterval,bucket:datetime) -> str:
+        return stat_name+"|"+str(interval)+"|"+bucket.isoformat()
+
+    @staticmethod
+    def _copy(value):
+        #the dicts of MultiNumericStat must not be changed through the result
+        return dict(value) if isinstance(value,dict) else value
+
+    def get(self,stat_name:str,interval:EventInterval,bucket:datetime,
+            default=None):
+        """
+        Returns the cached value of the bucket, or `default`
+        """
+        key = BucketCache._get_key(stat_name,interval,bucket)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] is None or entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return BucketCache._copy(entry[0])
+                del self._entries[key]
+
+            if self._disk is not None:
+                row = self._disk.execute("SELECT value, expiry FROM buckets WHERE key = ?",
+                                         (key,)).fetchone()
+                if row is not None and (row[1] is None or row[1] > now):
+                    value = pickle.loads(row[0])
+                    self._store(key,value,row[1])
+                    self.hits += 1
+                    return BucketCache._copy(value)
+
+            self.misses += 1
+            return default
+
+    def put_many(self,stat_name:str,interval:EventInterval,
+                 items:typing.Iterable[typing.Tuple[datetime,typing.Any]]) -> None:
+        """
+        Stores the `(bucket, value)` pairs, the buckets must be closed
+        """
+        expiry = time.time() + self.ttl if self.ttl else None
+        rows = []
+        with self._lock:
+            for bucket,value in items:
+                key = BucketCache._get_key(stat_name,interval,bucket)
+                value = BucketCache._copy(value)
+                self._store(key,value,expiry)
+                if self._disk is not None:
+                    rows.append((key,pickle.dumps(value),expiry))
+            if rows:
+                self._disk.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",rows)
+
+    def invalidate(self,stat_name:str,interval:EventInterval,
+                   buckets:typing.Iterable[datetime]) -> None:
+        """
+        Drops the buckets from both tiers, called when they are written late
+        """
+        keys = [BucketCache._get_key(stat_name,interval,bucket) for bucket in buckets]
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key,None)
+            if self._disk is not None and keys:
+                self._disk.executemany("DELETE FROM buckets WHERE key = ?",[(key,) for key in keys])
+
+    def _store(self,key:str,value,expiry:float) -> None:
+        self._entries[key] = (value,expiry)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def info(self) -> CacheInfo:
+        """
+        Returns the hit, miss and eviction counters and the size
+        """
+        with self._lock:
+            return CacheInfo(self.hits,self.misses,self.evictions,
+                             len(self._entries),self.max_size)
+
+    def clear(self) -> None:
+        """
+        Removes every bucket from both tiers and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM buckets")
+
+    def close(self) -> None:
+        """
+        Closes the on-disk tier
+        """
+        with self._lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
@@ -0,0 +1,77 @@
+"""
+Query plan diagnostics. :func:`explain` runs the queries of the stats with
+the `explain` command and reports the ones the server answers with a
+collection scan, usually because an index is missing.
+"""
+import typing
+from datetime import datetime,timedelta
+
+from . import main
+from .main import ConfigError,StatBase
+
+
+class QueryPlan(typing.NamedTuple):
+    """
+    The winning plan of a query of a stat
+    """
+    stat: str
+    collection: str
+    filter: dict
+    stages: typing.List[str]
+    "Stages of the winning plan, from the root"
+
+    @property
+    def collection_scan(self) -> bool:
+        return "COLLSCAN" in self.stages
+
+
+def _get_stages(plan) -> typing.List[str]:
+    #the plan is a tree of stages, the layout depends on the server version
+    #and on sharding
+    stages = []
+    if isinstance(plan,dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_get_stages(value))
+    elif isinstance(plan,list):
+        for value in plan:
+            stages.extend(_get_stages(value))
+    return stages
+
+
+def explain(stats:typing.Iterable[StatBase]=None,start_date:datetime=None,
+            end_date:datetime=None) -> typing.List[QueryPlan]:
+    """
+    Explains the data view, rollup and funnel queries of the stats and
+    returns their plans. The stats using a storage backend are skipped, they
+    query by `_id`.
+
+    :Parameters:
+      - `stats` (optional): the stats to check, every stat created in the
+        process by default
+      - `start_date` (optional): start of the queried time range, a day before
+        `end_date` by default
+      - `end_date` (optional): end of the queried time range, now by default
+    """
+    if main.dbclient is None:
+        raise ConfigError("The database connection is not initialized")
+    if stats is None:
+        stats = list(main.registry)
+
+    plans = []
+    for stat in stats:
+        end = stat._to_stored_time(end_date) if end_date else stat._get_now()
+        start = stat._to_stored_time(start_date) if start_date else end - timedelta(days=1)
+        for name,query in stat._get_diagnostic_queries(start,end):
+            result = main.database[name].find(query).explain()
+            stages = _get_stages(result.get("queryPlanner",{}).get("winningPlan",{}))
+            plans.append(QueryPlan(stat.name,name,query,stages))
+    return plans
+
+
+def find_collection_scans(stats:typing.Iterable[StatBase]=None) -> typing.List[QueryPlan]:
+    """
+    Returns the plans of :func:`explain` that scan a whole collection
+    """
+    return [plan for plan in explain(stats) if plan.collection_scan]
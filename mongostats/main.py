@@ -1,14 +1,49 @@
-from datetime import datetime,timedelta
+from datetime import datetime,timedelta,timezone
 import pymongo as pymongo
 from enum import IntEnum
+#the pymongo package loads these already, the imports only name them
 import pymongo.collection
 import pymongo.errors
 import typing
 import math
+import weakref
+import atexit
+import threading
+import uuid
+from . import bucketing, metrics
+from .buffer import write_buffer
+if typing.TYPE_CHECKING:
+    #imported at the first use, only the stats using a sketch load hashlib
+    from .sketches import DDSketch, HyperLogLog
 
 dbclient = None
 database = None
 
+registry = weakref.WeakSet()
+"Every stat object that is not a part of an other stat"
+
+WATERMARK_COLLECTION = "mongostats_watermarks"
+"Collection storing how far the rollups of the stats are done"
+
+LEASE_COLLECTION = "mongostats_leases"
+"Collection of the leases deciding which process rolls up a stat"
+
+_MISSING = object()
+
+#identifies this process in the leases and the shards
+_node_id = uuid.uuid4().hex
+
+#(database, collection, keys) of the indexes created by this process
+_ensured_indexes = set()
+
+_DATE_TRUNC_UNITS = {
+    1: "second",
+    2: "minute",
+    3: "hour",
+    4: "day",
+    5: "month",
+}
+
 def initialize_connection(mongoclient:pymongo.MongoClient,dbname:str):
     """
     This function initializes the database connection for the statistics
@@ -17,12 +52,91 @@ def initialize_connection(mongoclient:pymongo.MongoClient,dbname:str):
     dbclient = mongoclient
     database = mongoclient[dbname]
 
+def load_watermarks(names:typing.Iterable[str]) -> typing.Dict[str,datetime]:
+    """
+    Loads the rollup watermarks with the given names in one query
+    """
+    names = list(names)
+    if not names:
+        return {}
+    cursor = database[WATERMARK_COLLECTION].find({"_id":{"$in":names}})
+    return {doc["_id"]:doc["time"] for doc in cursor}
+
+def acquire_lease(name:str,seconds:float) -> bool:
+    """
+    Takes or extends the lease `name` for this process. Returns False if
+    an other process holds it and it has not expired
+    """
+    now = datetime.now(tz=timezone.utc).replace(tzinfo=None)
+    try:
+        database[LEASE_COLLECTION].update_one(
+            {"_id":name,"$or":[{"owner":_node_id},{"expires":{"$lt":now}}]},
+            {"$set":{"owner":_node_id,"expires":now+timedelta(seconds=seconds)}},
+            upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+        #the lease exists with an other owner, the upsert tried to insert it
+        return False
+    return True
+
+def _get_increment_write(bucket_id,amount,segment:str=None,window:int=0) -> pymongo.UpdateOne:
+    """
+    Upsert adding `amount` to the value of a bucket. With a spool `segment`
+    the update is skipped if the segment is applied to the bucket already
+    """
+    if segment is None:
+        return pymongo.UpdateOne({"_id":bucket_id},{"$inc":{"value":amount}},upsert=True)
+    return pymongo.UpdateOne(
+        {"_id":bucket_id,"spool":{"$ne":segment}},
+        {"$inc":{"value":amount},"$push":{"spool":{"$each":[segment],"$slice":-window}}},
+        upsert=True)
+
+def _set_unwritten(error:pymongo.errors.BulkWriteError,groups:list) -> None:
+    """
+    Stores the increments of the failed operations of an unordered bulk write
+    in `error.unwritten_increments`, the others are applied. `groups[i]` is
+    the list of `(bucket, amount)` written by the i-th operation
+    """
+    unwritten = {}
+    for write_error in error.details.get("writeErrors",()):
+        for bucket,amount in groups[write_error["index"]]:
+            unwritten[bucket] = amount
+    error.unwritten_increments = unwritten
+
+def _write_increments(coll,writes:list,increments:dict,segment:str=None) -> None:
+    """
+    Writes the upserts of `increments`, one per bucket in the order of the
+    dict. On a failure the error holds the increments not written, see
+    :func:`_set_unwritten`
+    """
+    try:
+        coll.bulk_write(writes,ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        if segment is None or e.details.get("writeConcernErrors") or any(
+                error["code"] != 11000 for error in e.details["writeErrors"]):
+            _set_unwritten(e,[[item] for item in increments.items()])
+            raise
+        #a duplicate key is either a bucket the segment is applied to already
+        #(the filter does not match, the upsert tries to insert it again) or
+        #an insert race with an other writer. The retry updates the bucket
+        #in the second case, a duplicate key again means the first one
+        items = list(increments.items())
+        retried = [error["index"] for error in e.details["writeErrors"]]
+        try:
+            coll.bulk_write([writes[index] for index in retried],ordered=False)
+        except pymongo.errors.BulkWriteError as retry_error:
+            if retry_error.details.get("writeConcernErrors") or any(
+                    error["code"] != 11000 for error in retry_error.details["writeErrors"]):
+                _set_unwritten(retry_error,[[items[index]] for index in retried])
+                raise
+
 # Decorator for error handling
 def handle_database_errors(func):
     def wrapper(*args, **kwargs):
         if not dbclient:
             raise ConfigError("The database connection is not initialized")
-        return func(*args, **kwargs)
+        if not metrics.enabled:
+            return func(*args, **kwargs)
+        return metrics.measure(func, args, kwargs)
     return wrapper
 
 class ConfigError(Exception):
@@ -47,55 +161,312 @@ class StatBase:
     Base class for stat measurement, has no own functionality
     """
     def __init__(self,name:str,min_interval:EventInterval=EventInterval.MINUTE,
-                 max_interval:EventInterval=EventInterval.MONTH) -> None:
+                 max_interval:EventInterval=EventInterval.MONTH,
+                 timezone=None) -> None:
         super()
         self.name = name
+        self.timezone = timezone
         self.intervals = []
         for i in range(min_interval.value,max_interval.value+1):
             self.intervals.append(EventInterval(i))
         
         if not len(self.intervals):
             raise ConfigError("There are no intervals in this stat")
+
+        registry.add(self)
+
+    def _get_watermark_names(self) -> typing.List[str]:
+        """
+        Names of the rollup watermarks of the stat, so they can be loaded in
+        batches with :func:`load_watermarks`
+        """
+        return []
+
+    def _run_interval(self,now:datetime,watermarks:typing.Dict[str,datetime]=None) -> None:
+        """
+        The work of `on_interval`. If `watermarks` is provided it contains the
+        loaded watermarks of the stat, otherwise the stat loads them itself
+        """
+        pass
+
+    def _get_now(self) -> datetime:
+        """
+        The current time as it is stored: naive UTC time if the stat has a
+        timezone, naive local time otherwise
+        """
+        if self.timezone is None:
+            return datetime.now(tz=None)
+        return datetime.now(tz=timezone.utc).replace(tzinfo=None)
+
+    def _to_stored_time(self,time:datetime) -> datetime:
+        """
+        Converts an aware time to the stored time of the stat, the naive
+        times are returned as they are
+        """
+        if time.tzinfo is None:
+            return time
+        if self.timezone is None:
+            return time.astimezone().replace(tzinfo=None)
+        return bucketing.to_utc(time)
+
+    def _get_bucket(self,interval:EventInterval,time:datetime=None) -> datetime:
+        """
+        Like :meth:`get_datetime_for_interval` in the timezone of the stat
+        """
+        if not time:
+            return bucketing.current(interval,self.timezone)
+        return bucketing.truncate(interval,time,self.timezone)
+
+    def _shift_bucket(self,interval:EventInterval,time:datetime,amount:int) -> datetime:
+        """
+        Like :meth:`get_shifted_interval` in the timezone of the stat
+        """
+        return bucketing.shift(interval,time,amount,self.timezone)
     
     @staticmethod
     def get_datetime_for_interval(interval:EventInterval,
                                   time=None) -> datetime:
+        """
+        Returns the start of the bucket of `interval` that contains `time`,
+        by default the current one
+        """
         if not time:
-            now = datetime.now(tz=None)
-        else:
-            now = time
-        if interval.value >= EventInterval.MONTH.value:
-            now = now.replace(day = 1)
-        if interval.value >= EventInterval.DAY.value:
-            now = now.replace(hour = 0)
-        if interval.value >= EventInterval.HOUR.value:
-            now = now.replace(minute = 0)
-        if interval.value >= EventInterval.MINUTE.value:
-            now = now.replace(second = 0)
-        if interval.value >= EventInterval.SECOND.value:
-            now = now.replace(microsecond = 0)
-        
-        return now
+            return bucketing.current(interval)
+        return bucketing.truncate(interval,time)
     
     @staticmethod
     def get_shifted_interval(interval:EventInterval,time,amount) -> datetime:
-        if interval == EventInterval.MONTH:
-            for _ in range(abs(amount)):
-                if amount < 0 and time.month == 1:
-                    time = time.replace(year=time.year-1,month=12)
-                if amount > 0 and time.month == 12:
-                    time = time.replace(year=time.year+1,month=1)
-                else:
-                    time = time.replace(month=time.month+(1 if amount>0 else -1))
-        elif interval == EventInterval.DAY:
-            time = time + timedelta(days=amount)
-        elif interval == EventInterval.HOUR:
-            time = time + timedelta(hours=amount)
-        elif interval == EventInterval.MINUTE:
-            time = time + timedelta(minutes=amount)
-        elif interval == EventInterval.SECOND:
-            time = time + timedelta(seconds=amount)
-        return time
+        """
+        Returns `time` moved by `amount` buckets of `interval`
+        """
+        return bucketing.shift(interval,time,amount)
+
+    accumulator = "$sum"
+    "Aggregation operator combining the buckets into the larger intervals"
+
+    rollup_catch_up = 1000
+    "Maximum number of missed periods rolled up per interval in one run"
+
+    def _get_watermark_name(self,interval:EventInterval) -> str:
+        return self.name+"_"+str(interval)
+
+    def _get_pending_windows(self,now:datetime,
+                             watermarks:typing.Dict[str,datetime]) -> typing.List[typing.Tuple[EventInterval,datetime,datetime]]:
+        """
+        Returns the range of closed periods not rolled up yet for every
+        interval except the smallest one as `(interval, start, end)`. Without a
+        watermark only the last closed period is pending
+        """
+        windows = []
+        for interval in self.intervals[1:]:
+            end = self._get_bucket(interval,now)
+            start = watermarks.get(self._get_watermark_name(interval))
+            if start is None:
+                start = self._shift_bucket(interval,end,-1)
+            end = min(end,self._shift_bucket(interval,start,self.rollup_catch_up))
+            if start < end:
+                windows.append((interval,start,end))
+        return windows
+
+    def _get_merge_windows(self,now:datetime,
+                           watermarks:typing.Dict[str,datetime]) -> typing.List[typing.Tuple[EventInterval,datetime,datetime]]:
+        """
+        Like :meth:`_get_pending_windows`, but every interval is merged from
+        the previous one: a period is merged only after the previous interval
+        has merged all of it in this or an earlier run. Without a watermark
+        an interval starts at the start of the next larger one, so the first
+        run does not store partial periods
+        """
+        starts = {}
+        upper_start = None
+        for interval in reversed(self.intervals[1:]):
+            start = watermarks.get(self._get_watermark_name(interval))
+            if start is None:
+                start = self._shift_bucket(interval,self._get_bucket(interval,now),-1)
+                if upper_start is not None:
+                    start = min(start,self._get_bucket(interval,upper_start))
+            starts[interval] = start
+            upper_start = start
+
+        windows = []
+        #end of the merged periods of the previous interval
+        merged = None
+        for interval in self.intervals[1:]:
+            start = starts[interval]
+            end = min(self._get_bucket(interval,now),
+                      self._shift_bucket(interval,start,self.rollup_catch_up))
+            if merged is not None:
+                end = min(end,self._get_bucket(interval,merged))
+            if start < end:
+                windows.append((interval,start,end))
+                merged = end
+            else:
+                merged = watermarks.get(self._get_watermark_name(interval),start)
+        return windows
+
+    def _get_watermark_updates(self,windows:typing.List[typing.Tuple[EventInterval,datetime,datetime]]) -> list:
+        return [
+            pymongo.UpdateOne({"_id":self._get_watermark_name(interval)},
+                              {"$max":{"time":end}},upsert=True)
+            for interval,_,end in windows
+        ]
+
+    def _get_group_pipeline(self,interval:EventInterval,start:datetime,end:datetime,
+                            time_field:str,group:dict) -> list:
+        """
+        Aggregation that groups the smallest interval into the buckets of
+        `interval` in `[start, end)`
+        """
+        group_id = {"$dateTrunc":{"date":"$"+time_field,"unit":_DATE_TRUNC_UNITS[interval.value]}}
+        if self.timezone is not None:
+            group_id["$dateTrunc"]["timezone"] = bucketing.get_zone_name(self.timezone)
+        if group:
+            group_id = dict(group,time=group_id)
+        return [
+            {"$match":{time_field:{"$gte":start,"$lt":end}}},
+            {"$group":{"_id":group_id,"value":{self.accumulator:"$value"}}}
+        ]
+
+    def _get_facet_pipeline(self,windows:typing.List[typing.Tuple[EventInterval,datetime,datetime]],
+                            time_field:str,group:dict) -> list:
+        """
+        Aggregation that groups the smallest interval into every pending
+        window in one pass, the result has a field for every interval. The
+        result is one document, only for the stats with one value per bucket
+        """
+        facets = {
+            str(interval):self._get_group_pipeline(interval,start,end,time_field,group)
+            for interval,start,end in windows
+        }
+        return [
+            {"$match":{time_field:{"$gte":min(window[1] for window in windows),
+                                   "$lt":max(window[2] for window in windows)}}},
+            {"$facet":facets}
+        ]
+
+    def _get_closed_until(self,interval:EventInterval,now:datetime) -> datetime:
+        """
+        The buckets of `interval` starting before the returned time do not
+        change anymore. The smallest interval is closed `grace_seconds` after
+        the end of the bucket and once the write buffer has no increment of
+        it, the others when they are rolled up
+        """
+        if interval == self.intervals[0]:
+            closed_until = self._get_bucket(
+                interval,now-timedelta(seconds=self.cache.grace_seconds))
+            if getattr(self,"buffered",False):
+                #the buffered increments are not written yet
+                pending = [self._get_bucket_time(bucket) for bucket in write_buffer.get_pending(self)]
+                if pending:
+                    closed_until = min(closed_until,min(pending))
+            return closed_until
+        storage = getattr(self,"storage",None)
+        if storage is not None and not storage.has_watermarks:
+            #the larger intervals are computed at read
+            return datetime.min
+        watermarks = load_watermarks([self._get_watermark_name(interval)])
+        return watermarks.get(self._get_watermark_name(interval),datetime.min)
+
+    def _get_bucket_time(self,bucket) -> datetime:
+        """
+        The time of a bucket key of the write buffer and the spool
+        """
+        return bucket
+
+    def _invalidate_cache(self,buckets:typing.Iterable) -> None:
+        """
+        Drops the cached buckets of the smallest interval written by a
+        buffer flush or a spool replay, they may be closed already
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self.name,self.intervals[0],
+                                  {self._get_bucket_time(bucket) for bucket in buckets})
+
+    def _iter_cached_data_view(self,interval:EventInterval,first:datetime,
+                               start_date:datetime,end_date:datetime,
+                               chunk_size:int,parameters:list=None) -> typing.Iterator[typing.Tuple[list,list]]:
+        """
+        Serves the closed buckets from the start of the range from the cache,
+        the rest is read from the database and its closed buckets are cached.
+        The `parameters` key filter of :class:`MultiNumericStat` is applied
+        to the cached buckets, the filtered reads are not cached
+        """
+        closed_until = self._get_closed_until(interval,self._get_now())
+        keys = []
+        values = []
+        key = first
+        while key <= end_date and key < closed_until:
+            value = self.cache.get(self.name,interval,key,_MISSING)
+            if value is _MISSING:
+                break
+            if parameters is not None:
+                value = {k:v for k,v in value.items() if k in parameters}
+            keys.append(key)
+            values.append(value)
+            if len(keys) >= chunk_size:
+                yield keys,values
+                keys = []
+                values = []
+            key = self._shift_bucket(interval,key,1)
+        if keys:
+            yield keys,values
+        if key > end_date:
+            return
+
+        if parameters is None:
+            cursor = self._find_data_view(interval,max(key,start_date),end_date,batch_size=chunk_size)
+        else:
+            cursor = self._find_data_view(interval,max(key,start_date),end_date,batch_size=chunk_size,
+                                          parameters=parameters)
+        for keys,values in self._iter_data_view(interval,key,end_date,cursor,chunk_size,self.timezone):
+            if parameters is None:
+                self.cache.put_many(self.name,interval,
+                                    [(k,v) for k,v in zip(keys,values) if k < closed_until])
+            yield keys,values
+
+    def _get_time_field(self,interval:EventInterval) -> str:
+        """
+        Field of the bucket start in the documents of `interval`
+        """
+        return "_id"
+
+    _indexes_ready = False
+
+    def _get_index_specs(self) -> typing.List[typing.Tuple[typing.Any,list,dict]]:
+        """
+        Indexes of the collections of the stat as `(collection, keys,
+        options)`
+        """
+        return []
+
+    def _ensure_indexes(self) -> int:
+        """
+        Creates the indexes of the stat at the first write, every index is
+        created once per process. Returns the number of created indexes
+        """
+        if self._indexes_ready:
+            return 0
+        created = 0
+        for coll,keys,options in self._get_index_specs():
+            key = (coll.database.name,coll.name,tuple(keys))
+            if key not in _ensured_indexes:
+                coll.create_index(keys,**options)
+                _ensured_indexes.add(key)
+                created += 1
+        self._indexes_ready = True
+        return created
+
+    def _get_diagnostic_queries(self,start_date:datetime,
+                                end_date:datetime) -> typing.List[typing.Tuple[str,dict]]:
+        """
+        The queries of the stat over the time range as `(collection name,
+        filter)`, see :func:`mongostats.diagnostics.explain`
+        """
+        if getattr(self,"storage",None) is not None:
+            return []
+        return [(self._get_collection(interval).name,
+                 {self._get_time_field(interval):{"$gte":start_date,"$lte":end_date}})
+                for interval in self.intervals]
 
     @staticmethod
     def get_prev_interval(interval:EventInterval,time) -> datetime:
@@ -112,7 +483,10 @@ class EventStat(StatBase):
     """
     def __init__(self, name: str, 
                 min_interval: EventInterval = EventInterval.MINUTE,
-                max_interval: EventInterval = EventInterval.MONTH) -> None:
+                max_interval: EventInterval = EventInterval.MONTH,
+                buffered: bool = False, storage=None, cache=None,
+                timezone=None, shards: int = None,
+                lease_seconds: float = 60, spool=None) -> None:
         """
         It measures how many times a given event happened. Does not
         store any data connected to the events.
@@ -122,24 +496,124 @@ class EventStat(StatBase):
             name
           - `min_interval`: smallest time interval of the measurement
           - `max_interval`: largest time interval of the measurement
+          - `buffered` (optional): if True the events are summed up in memory
+            and written in bulk when the write buffer is flushed, see
+            :func:`configure_write_buffer`
+          - `storage` (optional): storage backend from
+            :mod:`mongostats.storage`, by default every interval is stored in
+            its own collection named `name_INTERVAL`
+          - `cache` (optional): a :class:`mongostats.cache.BucketCache`, the
+            closed buckets are served from it by :meth:`get_data_view`
+          - `timezone` (optional): a `tzinfo`, for example a
+            `zoneinfo.ZoneInfo`. If provided the buckets are stored by their
+            UTC start and the days and months begin at midnight in this zone.
+            The times read back are naive UTC, aware times can be passed to
+            the queries. Without it everything is in naive local time
+          - `shards` (optional): multi-writer mode for stats written by many
+            processes. Every process writes its own sub-counter of the
+            smallest interval with the id `{"time": bucket, "shard": n}`,
+            `n` is one of `shards` numbers picked by the process. The
+            sub-counters are merged when they are read and rolled up, the
+            rollup is done by the process holding the lease of the stat
+          - `lease_seconds` (optional): the rollup lease of a multi-writer
+            stat expires this long after the last rollup of its holder
+          - `spool` (optional): a :class:`mongostats.spool.Spool`, the events
+            are appended to it and written to the database when it is
+            replayed. It can not be used with `buffered` or `storage`
         """
-        super().__init__(name, min_interval, max_interval)
+        super().__init__(name, min_interval, max_interval, timezone)
+        if storage is not None and timezone is not None:
+            raise ConfigError("The storage backends do not support timezones")
+        if storage is not None and shards:
+            raise ConfigError("The storage backends do not support shards")
+        if spool is not None and (buffered or storage is not None):
+            raise ConfigError("A spooled stat can not be buffered or use a storage backend")
+        self.buffered = buffered
+        self.storage = storage
+        self.cache = cache
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.spool = spool
+        if spool is not None:
+            spool.register(self)
+        if shards:
+            self.shard = int(_node_id,16) % shards
+            "Shard of the sub-counters written by this process"
 
     def _get_collection(self,
                         interval:EventInterval) -> pymongo.collection:
-        global database
         return database[self.name+"_"+str(interval)]
+
+    def _get_index_specs(self) -> typing.List[typing.Tuple[typing.Any,list,dict]]:
+        if self.shards:
+            return [(self._get_collection(self.intervals[0]),[("_id.time",1)],{})]
+        return []
+
+    def _get_bucket_id(self,time:datetime):
+        """
+        `_id` of the document of this process in the bucket of the smallest
+        interval at `time`
+        """
+        if self.shards:
+            return {"time":time,"shard":self.shard}
+        return time
+
+    def _get_time_field(self,interval:EventInterval) -> str:
+        if self.shards and interval == self.intervals[0]:
+            return "_id.time"
+        return "_id"
     
     @handle_database_errors
     def on_event(self) -> None:
-        smallestInterval = self.intervals[0]
-        time = StatBase.get_datetime_for_interval(smallestInterval)
-
-        coll = self._get_collection(smallestInterval)
-        coll.update_one({"_id":time},{"$inc":{"value":1}},True)
         """
         Call this function when the event happens
         """
+        time = self._get_bucket(self.intervals[0])
+        self._increment(time,1)
+
+    def _increment(self,time:datetime,amount) -> None:
+        """
+        Adds `amount` to the bucket of the smallest interval at `time`
+        """
+        if self.spool is not None:
+            self.spool.add(self,time,amount)
+        elif self.buffered:
+            write_buffer.add(self,time,amount)
+        elif self.storage:
+            self.storage.increment(self,time,amount)
+        else:
+            self._ensure_indexes()
+            coll = self._get_collection(self.intervals[0])
+            coll.update_one({"_id":self._get_bucket_id(time)},{"$inc":{"value":amount}},True)
+
+    def _put_max(self,time:datetime,value) -> None:
+        """
+        Raises the bucket of the smallest interval at `time` to `value`
+        """
+        if self.storage:
+            self.storage.put_max(self,time,value)
+        else:
+            coll = self._get_collection(self.intervals[0])
+            coll.update_one({"_id":self._get_bucket_id(time)},{"$max":{"value":value}},upsert=True)
+
+    def _apply_increments(self,increments:typing.Dict[datetime,int],
+                          segment:str=None) -> None:
+        """
+        Writes the buffered or spooled increments, one update per bucket. The
+        spool `segment` makes the writes idempotent
+        """
+        try:
+            if self.storage:
+                self.storage.apply_increments(self,increments)
+                return
+            self._ensure_indexes()
+            window = self.spool.window if segment is not None else 0
+            _write_increments(self._get_collection(self.intervals[0]),[
+                _get_increment_write(self._get_bucket_id(time),amount,segment,window)
+                for time,amount in increments.items()
+            ],increments,segment)
+        finally:
+            self._invalidate_cache(increments)
     
     @handle_database_errors
     def on_interval(self) -> None:
@@ -147,38 +621,61 @@ class EventStat(StatBase):
         Call this function periodically, at least as often as the second
         smallest interval
         """
-        global database
         #let's assume this is called every second smallest interval
-        if len(self.intervals) < 2:
+        self._run_interval(self._get_now())
+
+    def _run_interval(self,now:datetime,watermarks:typing.Dict[str,datetime]=None) -> None:
+        if self.buffered:
+            write_buffer.flush(self)
+        if self.spool is not None:
+            self.spool.replay()
+        self._rollup(now,watermarks)
+
+    def _get_watermark_names(self) -> typing.List[str]:
+        return [self._get_watermark_name(interval) for interval in self.intervals[1:]]
+
+    def _rollup(self,now:datetime,watermarks:typing.Dict[str,datetime]=None) -> None:
+        """
+        Rolls up every closed period since the last run. All intervals are
+        computed from the smallest one in a single aggregation
+        """
+        if self.storage:
+            self.storage.rollup(self,now,watermarks)
             return
-        
-        now = datetime.now(tz=None)
-
-        for i in range(1,len(self.intervals)):
-            interval = self.intervals[i]
-            
-            #check if the result exists and create the aggregation if needed
-            current_time = StatBase.get_datetime_for_interval(interval,now) 
-            #end of the measure window
-            time = StatBase.get_prev_interval(interval,current_time) 
-            #start of the measure window
-
-            #collection to collect the data from
-            coll = self._get_collection(EventInterval(interval.value-1))
-            coll_target = self._get_collection(interval)
-    
-            if coll_target.count_documents({"_id":time}) == 0:
-                coll.aggregate([
-                    {"$match":{"_id":{"$lt":current_time,"$gte":time}}},
-                    {"$group":{"_id":time,"value":{"$sum":"$value"}}},
-                    {"$merge":{
-                        "into":self.name+"_"+str(interval)
-                    }}
-                ])
-
-                #if the $match is empty, no document is created
-                if coll_target.count_documents({"_id":time}) == 0:
-                    coll_target.insert_one({"_id":time,"value":0})
+
+        if self.shards and not acquire_lease(self.name+"_rollup",self.lease_seconds):
+            #an other process rolls up the stat, the results would be the same
+            return
+
+        if watermarks is None:
+            watermarks = load_watermarks(self._get_watermark_names())
+        windows = self._get_pending_windows(now,watermarks)
+        if not windows:
+            return
+
+        coll = self._get_collection(self.intervals[0])
+        result = next(coll.aggregate(self._get_facet_pipeline(
+            windows,self._get_time_field(self.intervals[0]),None)))
+        for interval,updates in self._get_rollup_updates(windows,result):
+            self._get_collection(interval).bulk_write(updates,ordered=False)
+        database[WATERMARK_COLLECTION].bulk_write(
+            self._get_watermark_updates(windows),ordered=False)
+
+    def _get_rollup_updates(self,windows:typing.List[typing.Tuple[EventInterval,datetime,datetime]],
+                            result:dict) -> typing.Iterator[typing.Tuple[EventInterval,list]]:
+        """
+        Converts the result of the facet pipeline to writes, the periods
+        without data get 0
+        """
+        for interval,start,end in windows:
+            values = {doc["_id"]:doc["value"] for doc in result[str(interval)]}
+            updates = []
+            time = start
+            while time < end:
+                updates.append(pymongo.UpdateOne(
+                    {"_id":time},{"$set":{"value":values.get(time,0)}},upsert=True))
+                time = self._shift_bucket(interval,time,1)
+            yield interval,updates
     
     @handle_database_errors
     def get_data_view(self,interval:EventInterval,start_date:datetime,
@@ -187,41 +684,172 @@ class EventStat(StatBase):
         Gets the collected data from the time range.
         Returns a list of keys and values as `list[datetime], list[int]`
         """
+        keys = []
+        values = []
+        for chunk_keys,chunk_values in self.iter_data_view(interval,start_date,end_date):
+            keys.extend(chunk_keys)
+            values.extend(chunk_values)
+        return keys,values
+
+    @handle_database_errors
+    def iter_data_view(self,interval:EventInterval,start_date:datetime,
+                       end_date:datetime,chunk_size:int=1000) -> typing.Iterator[typing.Tuple[typing.List[datetime],typing.List[int]]]:
+        """
+        Gets the collected data from the time range in chunks of at most
+        `chunk_size` buckets, as the documents arrive from the server. Use it
+        for ranges too large to hold in memory at once.
+        Yields lists of keys and values as `list[datetime], list[int]`
+        """
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        first = self._shift_bucket(interval,self._get_bucket(interval,start_date),-1)
+        if self.cache is not None:
+            return self._iter_cached_data_view(interval,first,start_date,end_date,chunk_size)
+        cursor = self._find_data_view(interval,start_date,end_date,batch_size=chunk_size)
+        return self._iter_data_view(interval,first,end_date,cursor,chunk_size,self.timezone)
+
+    @handle_database_errors
+    def get_series(self,interval:EventInterval,start_date:datetime,
+                   end_date:datetime):
+        """
+        Gets the collected data from the time range as a `pandas.Series`
+        indexed by the start of the buckets, from the bucket of `start_date`
+        to `end_date`. Needs numpy and pandas
+        """
+        from .series import build_series
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        cursor = self._find_data_view(interval,start_date,end_date)
+        return build_series(interval,start_date,end_date,cursor,self.name,self.timezone)
+
+    @handle_database_errors
+    def get_zoned_data_view(self,interval:EventInterval,start_date:datetime,
+                            end_date:datetime,timezone) -> typing.Tuple[typing.List[datetime],typing.List[int]]:
+        """
+        Gets the collected data from the time range in the buckets of an
+        other timezone. The buckets are computed at read from the largest
+        stored interval that fits the boundaries of both zones, nothing is
+        stored per zone. Needs a stat with a timezone.
+        Returns a list of keys and values as `list[datetime], list[int]`,
+        the keys are the UTC starts of the buckets
+        """
+        if self.timezone is None:
+            raise ConfigError("Only the stats with a timezone can be read in an other zone")
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        source = self._get_zoned_source(interval,start_date,end_date,timezone)
+
+        first = bucketing.shift(interval,bucketing.truncate(interval,start_date,timezone),-1,timezone)
+        end = bucketing.shift(interval,bucketing.truncate(interval,end_date,timezone),1,timezone)
+        time_field = self._get_time_field(source)
+        cursor = self._get_collection(source).aggregate([
+            {"$match":{time_field:{"$gte":first,"$lt":end}}},
+            {"$group":{
+                "_id":{"$dateTrunc":{"date":"$"+time_field,"unit":_DATE_TRUNC_UNITS[interval.value],
+                                     "timezone":bucketing.get_zone_name(timezone)}},
+                "value":{self.accumulator:"$value"}
+            }},
+            {"$sort":{"_id":1}}
+        ])
+        keys = []
+        values = []
+        for chunk_keys,chunk_values in self._iter_data_view(interval,first,end_date,cursor,tz=timezone):
+            keys.extend(chunk_keys)
+            values.extend(chunk_values)
+        return keys,values
+
+    def _get_zoned_source(self,interval:EventInterval,start_date:datetime,
+                          end_date:datetime,timezone) -> EventInterval:
+        """
+        The largest stored interval not larger than `interval` whose buckets
+        do not cross the bucket boundaries of `timezone`
+        """
+        def offset(tz,time):
+            return bucketing.to_zone(time,tz).utcoffset().total_seconds()
+        for source in reversed(self.intervals):
+            if source > interval:
+                continue
+            if source <= EventInterval.MINUTE:
+                return source
+            if source == EventInterval.HOUR and all(
+                    (offset(self.timezone,time) - offset(timezone,time)) % 3600 == 0
+                    for time in (start_date,end_date)):
+                return source
+        raise ConfigError("The stat has no interval small enough for this timezone")
+
+    def _find_data_view(self,interval:EventInterval,start_date:datetime,
+                        end_date:datetime,batch_size:int=0):
+        """
+        Returns the documents of the time range sorted by time as
+        `{"_id": time, "value": value}`
+        """
+        if self.storage:
+            return self.storage.find(self,interval,start_date,end_date)
         coll = self._get_collection(interval)
-        cursor = coll.find(
+        if self._get_time_field(interval) == "_id.time":
+            #the sub-counters of the processes are merged
+            options = {"batchSize":batch_size} if batch_size else {}
+            return coll.aggregate([
+                {"$match":{"_id.time":{"$gte":start_date,"$lte":end_date}}},
+                {"$group":{"_id":"$_id.time","value":{self.accumulator:"$value"}}},
+                {"$sort":{"_id":1}}
+            ],**options)
+        return coll.find(
             filter={"_id":{"$gte":start_date,"$lte":end_date}},
-            sort=[('_id', pymongo.ASCENDING)]
+            projection={"_id":True,"value":True},
+            sort=[('_id', pymongo.ASCENDING)],
+            batch_size=batch_size
         )
 
+    def _build_data_view(self,interval:EventInterval,start_date:datetime,
+                         end_date:datetime,docs:typing.Iterable) -> typing.Tuple[typing.List[datetime],typing.List[int]]:
+        """
+        Fills the gaps between the sorted documents with zeros in the buckets
+        of the stat, the times are stored times
+        """
         keys = []
         values = []
+        first = self._shift_bucket(interval,self._get_bucket(interval,start_date),-1)
+        for chunk_keys,chunk_values in self._iter_data_view(interval,first,end_date,docs,
+                                                            tz=self.timezone):
+            keys.extend(chunk_keys)
+            values.extend(chunk_values)
+        return keys,values
 
-        key = StatBase.get_datetime_for_interval(interval,start_date)
-        key = StatBase.get_prev_interval(interval,key) 
-        
-        doc = None
-        no_more_doc = False
-        needs_next_doc = True
+    @staticmethod
+    def _iter_data_view(interval:EventInterval,first:datetime,
+                        end_date:datetime,docs:typing.Iterable,
+                        chunk_size:int=1000,tz=None) -> typing.Iterator[typing.Tuple[typing.List[datetime],typing.List[int]]]:
+        """
+        Fills the gaps between the sorted documents with zeros from the bucket
+        `first`, a chunk is yielded after every `chunk_size` buckets
+        """
+        docs = iter(docs)
+        keys = []
+        values = []
+
+        key = first
+        doc = next(docs,None)
         while True:
-            keys.append(key)
+            #documents not on a bucket boundary are skipped
+            while doc is not None and doc["_id"] < key:
+                doc = next(docs,None)
             value = 0
-            if not no_more_doc:
-                if needs_next_doc:
-                    try:
-                        doc = cursor.next()
-                    except StopIteration:
-                        no_more_doc = True
-                if doc["_id"] == key:
-                    value = doc["value"]
-                    needs_next_doc = True
-                else:
-                    needs_next_doc = False
+            if doc is not None and doc["_id"] == key:
+                value = doc["value"]
+                doc = next(docs,None)
+            keys.append(key)
             values.append(value)
-            key = StatBase.get_next_interval(interval,key)
+            if len(keys) >= chunk_size:
+                yield keys,values
+                keys = []
+                values = []
+            key = bucketing.shift(interval,key,1,tz)
             if key > end_date:
                 break
-        
-        return keys,values
+
+        if keys:
+            yield keys,values
 
 class NumericStat(EventStat):
     """
@@ -236,11 +864,8 @@ class NumericStat(EventStat):
         if not math.isfinite(count):
             return
         
-        smallestInterval = self.intervals[0]
-        time = StatBase.get_datetime_for_interval(smallestInterval)
-
-        coll = self._get_collection(smallestInterval)
-        coll.update_one({"_id":time},{"$inc":{"value":count}},True)
+        time = self._get_bucket(self.intervals[0])
+        self._increment(time,count)
 
 class MultiNumericStat(StatBase):
     """
@@ -248,17 +873,57 @@ class MultiNumericStat(StatBase):
     EventStats, but it is dynamical.
     """
 
-    @handle_database_errors
-    def __init__(self, name: str, min_interval: EventInterval = EventInterval.MINUTE, max_interval: EventInterval = EventInterval.MONTH) -> None:
-        super().__init__(name, min_interval, max_interval)
-        
-        for interval in self.intervals:
-            self._get_collection(interval).create_index({"_id.time":1})
+    def __init__(self, name: str, min_interval: EventInterval = EventInterval.MINUTE, max_interval: EventInterval = EventInterval.MONTH,
+                 buffered: bool = False, top_k: int = None, cache=None,
+                 timezone=None, spool=None) -> None:
+        """
+        :Parameters:
+          - `name`: name of the stat, it will be used in the collection name
+          - `min_interval`: smallest time interval of the measurement
+          - `max_interval`: largest time interval of the measurement
+          - `buffered` (optional): if True the events are summed up per key in
+            memory and written in bulk when the write buffer is flushed, see
+            :func:`configure_write_buffer`
+          - `top_k` (optional): if provided only the `top_k` largest keys of
+            a bucket are stored, the rest is summed up in the `__other__` key.
+            The buckets are kept in memory until they are closed, the counts
+            must not be negative
+          - `cache` (optional): a :class:`mongostats.cache.BucketCache`, the
+            closed buckets are served from it by :meth:`get_data_view`
+          - `timezone` (optional): timezone of the buckets, see
+            :class:`EventStat`
+          - `spool` (optional): a :class:`mongostats.spool.Spool`, see
+            :class:`EventStat`. It can not be used with `buffered` or `top_k`
+        """
+        super().__init__(name, min_interval, max_interval, timezone)
+        if spool is not None and (buffered or top_k):
+            raise ConfigError("A spooled stat can not be buffered or use top_k")
+        self.buffered = buffered
+        self.top_k = top_k
+        self.cache = cache
+        self.spool = spool
+        if spool is not None:
+            spool.register(self)
+        self._heavy_hitters = {}
+        self._heavy_hitters_lock = threading.Lock()
 
     def _get_collection(self,
                         interval:EventInterval) -> pymongo.collection:
-        global database
         return database[self.name+"_"+str(interval)]
+
+    def _get_index_specs(self) -> typing.List[typing.Tuple[typing.Any,list,dict]]:
+        #also bounds the key filter of the data views
+        return [(self._get_collection(interval),[("_id.time",1),("_id.key",1)],{})
+                for interval in self.intervals]
+
+    def _get_closed_until(self,interval:EventInterval,now:datetime) -> datetime:
+        closed_until = super()._get_closed_until(interval,now)
+        if self.top_k and interval == self.intervals[0]:
+            #the summaries in memory are not written yet
+            with self._heavy_hitters_lock:
+                if self._heavy_hitters:
+                    closed_until = min(closed_until,min(self._heavy_hitters))
+        return closed_until
     
     @handle_database_errors
     def on_event(self,parameter,count) -> None:
@@ -266,11 +931,74 @@ class MultiNumericStat(StatBase):
         Call this function when the event happens
         """
         smallestInterval = self.intervals[0]
-        time = StatBase.get_datetime_for_interval(smallestInterval)
+        time = self._get_bucket(smallestInterval)
+
+        if self.top_k:
+            with self._heavy_hitters_lock:
+                summary = self._heavy_hitters.get(time)
+                if summary is None:
+                    from .sketches import SpaceSaving
+                    summary = self._heavy_hitters[time] = SpaceSaving(self.top_k)
+                    closed = len(self._heavy_hitters) > 1
+                else:
+                    closed = False
+                summary.add(parameter,count)
+            if closed:
+                self._drain_heavy_hitters(time)
+        elif self.spool is not None:
+            self.spool.add(self,(time,parameter),count)
+        elif self.buffered:
+            write_buffer.add(self,(time,parameter),count)
+        else:
+            self._ensure_indexes()
+            coll = self._get_collection(smallestInterval)
+            coll.update_one({"_id":{"time":time,"key":parameter}},{"$inc":{"value":count}},True)
 
-        coll = self._get_collection(smallestInterval)
-        coll.update_one({"_id":{"time":time,"key":parameter}},{"$inc":{"value":count}},True)
+    def _apply_increments(self,increments:typing.Dict[typing.Tuple[datetime,typing.Any],int],
+                          segment:str=None) -> None:
+        """
+        Writes the buffered or spooled increments, one update per bucket and
+        key
+        """
+        try:
+            self._ensure_indexes()
+            window = self.spool.window if segment is not None else 0
+            _write_increments(self._get_collection(self.intervals[0]),[
+                _get_increment_write({"time":time,"key":key},amount,segment,window)
+                for (time,key),amount in increments.items()
+            ],increments,segment)
+        finally:
+            self._invalidate_cache(increments)
+
+    def _get_bucket_time(self,bucket) -> datetime:
+        return bucket[0]
+
+    def _drain_heavy_hitters(self,before:datetime=None) -> None:
+        """
+        Writes the top-K summaries of the buckets earlier than `before`, or
+        every summary if it is not provided
+        """
+        with self._heavy_hitters_lock:
+            times = [time for time in self._heavy_hitters
+                     if before is None or time < before]
+            summaries = [(time,self._heavy_hitters.pop(time)) for time in times]
+
+        increments = {}
+        for time,summary in summaries:
+            guaranteed,other = summary.guaranteed()
+            for key,amount in guaranteed.items():
+                if amount:
+                    increments[(time,key)] = amount
+            if other:
+                increments[(time,"__other__")] = other
+        if not increments:
+            return
 
+        if self.buffered:
+            for bucket,amount in increments.items():
+                write_buffer.add(self,bucket,amount)
+        else:
+            self._apply_increments(increments)
     
     @handle_database_errors
     def on_interval(self) -> None:
@@ -278,96 +1006,386 @@ class MultiNumericStat(StatBase):
         Call this function periodically, at least as often as the second
         smallest interval
         """
-        global database
         #let's assume this is called every second smallest interval
-        if len(self.intervals) < 2:
+        self._run_interval(self._get_now())
+
+    def _get_watermark_names(self) -> typing.List[str]:
+        return [self._get_watermark_name(interval) for interval in self.intervals[1:]]
+
+    def _run_interval(self,now:datetime,watermarks:typing.Dict[str,datetime]=None) -> None:
+        """
+        Rolls up every closed period since the last run. All intervals are
+        computed from the smallest one in a single aggregation
+        """
+        if self.top_k:
+            self._drain_heavy_hitters(self._get_bucket(self.intervals[0],now))
+        if self.buffered:
+            write_buffer.flush(self)
+        if self.spool is not None:
+            self.spool.replay()
+
+        if watermarks is None:
+            watermarks = load_watermarks(self._get_watermark_names())
+        windows = self._get_pending_windows(now,watermarks)
+        if not windows:
             return
-        
-        now = datetime.now(tz=None)
-
-        for i in range(1,len(self.intervals)):
-            interval = self.intervals[i]
-            
-            #check if the result exists and create the aggregation if needed
-            current_time = StatBase.get_datetime_for_interval(interval,now) 
-            #end of the measure window
-            time = StatBase.get_prev_interval(interval,current_time) 
-            #start of the measure window
-
-            #collection to collect the data from
-            coll = self._get_collection(EventInterval(interval.value-1))
-            coll_target = self._get_collection(interval)
-    
-            if coll_target.count_documents({"_id.time":time}) == 0:
-                coll.aggregate([
-                    {"$match":{"_id.time":{"$lt":current_time,"$gte":time}}},
-                    {"$group":{"_id":{"time":time,"key":"$_id.key"},"value":{"$sum":"$value"}}},
-                    {"$merge":{
-                        "into":self.name+"_"+str(interval)
-                    }}
-                ])
-
-                #if the $match is empty, no document is created
-                if coll_target.count_documents({"_id":{"time":time}}) == 0:
-                    coll_target.insert_one({"_id":{"time":time,"key":"__marker__"},"value":0})
+
+        #the keys of a window may not fit in one document, every interval is
+        #aggregated separately and streamed through the cursor
+        coll = self._get_collection(self.intervals[0])
+        for window in windows:
+            cursor = coll.aggregate(self._get_group_pipeline(*window,"_id.time",{"key":"$_id.key"}),
+                                    allowDiskUse=True,batchSize=self.rollup_batch_size)
+            for updates in self._get_rollup_batches(cursor):
+                self._get_collection(window[0]).bulk_write(updates,ordered=False)
+            database[WATERMARK_COLLECTION].bulk_write(
+                self._get_watermark_updates([window]),ordered=False)
+
+    rollup_batch_size = 1000
+    "Number of buckets written by one bulk write of the rollup"
+
+    def _get_rollup_batches(self,docs:typing.Iterable[dict]) -> typing.Iterator[list]:
+        """
+        Converts the grouped documents to writes in batches of
+        `rollup_batch_size`
+        """
+        updates = []
+        for doc in docs:
+            updates.append(pymongo.UpdateOne(
+                {"_id":{"time":doc["_id"]["time"],"key":doc["_id"]["key"]}},
+                {"$set":{"value":doc["value"]}},upsert=True))
+            if len(updates) >= self.rollup_batch_size:
+                yield updates
+                updates = []
+        if updates:
+            yield updates
     
     @handle_database_errors
     def get_data_view(self,interval:EventInterval,start_date:datetime,
-                      end_date:datetime) -> typing.Tuple[typing.List[datetime],typing.List[int]]:
+                      end_date:datetime,parameters:typing.Iterable=None) -> typing.Tuple[typing.List[datetime],typing.List[dict]]:
         """
-        Gets the collected data from the time range.
-        Returns a list of keys and values as `list[datetime], list[int]`
+        Gets the collected data from the time range. If `parameters` is
+        provided only those keys are read.
+        Returns a list of keys and values as `list[datetime], list[dict]`
+        """
+        keys = []
+        values = []
+        for chunk_keys,chunk_values in self.iter_data_view(interval,start_date,end_date,parameters=parameters):
+            keys.extend(chunk_keys)
+            values.extend(chunk_values)
+        return keys,values
+
+    @handle_database_errors
+    def iter_data_view(self,interval:EventInterval,start_date:datetime,
+                       end_date:datetime,chunk_size:int=1000,
+                       parameters:typing.Iterable=None) -> typing.Iterator[typing.Tuple[typing.List[datetime],typing.List[dict]]]:
         """
+        Gets the collected data from the time range in chunks of at most
+        `chunk_size` buckets, as the documents arrive from the server. Use it
+        for ranges too large to hold in memory at once. If `parameters` is
+        provided only those keys are read.
+        Yields lists of keys and values as `list[datetime], list[dict]`
+        """
+        if parameters is not None:
+            parameters = list(parameters)
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        first = self._shift_bucket(interval,self._get_bucket(interval,start_date),-1)
+        if self.cache is not None:
+            return self._iter_cached_data_view(interval,first,start_date,end_date,chunk_size,parameters)
+        cursor = self._find_data_view(interval,start_date,end_date,batch_size=chunk_size,parameters=parameters)
+        return self._iter_data_view(interval,first,end_date,cursor,chunk_size,self.timezone)
+
+    @handle_database_errors
+    def get_series(self,interval:EventInterval,start_date:datetime,
+                   end_date:datetime,parameters:typing.Iterable=None):
+        """
+        Gets the collected data from the time range as a wide
+        `pandas.DataFrame` with a column for every key, indexed by the start
+        of the buckets. If `parameters` is provided only those keys are read.
+        Needs numpy and pandas
+        """
+        from .series import build_frame
+        if parameters is not None:
+            parameters = list(parameters)
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        cursor = self._find_data_view(interval,start_date,end_date,parameters=parameters)
+        return build_frame(interval,start_date,end_date,cursor,self.timezone)
+
+    def _find_data_view(self,interval:EventInterval,start_date:datetime,
+                        end_date:datetime,batch_size:int=0,
+                        parameters:list=None):
+        query = {"_id.time":{"$gte":start_date,"$lte":end_date}}
+        if parameters is not None:
+            query["_id.key"] = {"$in":parameters}
         coll = self._get_collection(interval)
-        cursor = coll.find(
-            filter={"_id.time":{"$gte":start_date,"$lte":end_date}},
-            sort=[('_id.time', pymongo.ASCENDING)]
+        return coll.find(
+            filter=query,
+            projection={"_id":True,"value":True},
+            sort=[('_id.time', pymongo.ASCENDING)],
+            batch_size=batch_size
         )
 
+    def _get_diagnostic_queries(self,start_date:datetime,
+                                end_date:datetime) -> typing.List[typing.Tuple[str,dict]]:
+        return [(self._get_collection(interval).name,
+                 {"_id.time":{"$gte":start_date,"$lte":end_date}})
+                for interval in self.intervals]
+
+    def _build_data_view(self,interval:EventInterval,start_date:datetime,
+                         end_date:datetime,docs:typing.Iterable) -> typing.Tuple[typing.List[datetime],typing.List[dict]]:
+        """
+        Groups the sorted documents by time in the buckets of the stat, the
+        missing times get empty dicts. The times are stored times
+        """
         keys = []
         values = []
+        first = self._shift_bucket(interval,self._get_bucket(interval,start_date),-1)
+        for chunk_keys,chunk_values in self._iter_data_view(interval,first,end_date,docs,
+                                                            tz=self.timezone):
+            keys.extend(chunk_keys)
+            values.extend(chunk_values)
+        return keys,values
 
-        key = StatBase.get_datetime_for_interval(interval,start_date)
-        key = StatBase.get_prev_interval(interval,key) 
+    @staticmethod
+    def _iter_data_view(interval:EventInterval,first:datetime,
+                        end_date:datetime,docs:typing.Iterable,
+                        chunk_size:int=1000,tz=None) -> typing.Iterator[typing.Tuple[typing.List[datetime],typing.List[dict]]]:
+        """
+        Groups the sorted documents by time from the bucket `first`, the
+        missing times get empty dicts. A chunk is yielded after every
+        `chunk_size` buckets
+        """
+        docs = iter(docs)
+        keys = []
+        values = []
 
-        no_more_doc = False
-        needs_next_doc = True
+        key = first
+        doc = next(docs,None)
         while True:
-            keys.append(key)
+            while doc is not None and doc['_id']['time'] < key:
+                doc = next(docs,None)
             value = {}
-            while not no_more_doc:
-                if needs_next_doc:
-                    try:
-                        doc = cursor.next()
-                    except StopIteration:
-                        no_more_doc = True
-                        break
-                if doc['_id']['time'] == key:
+            while doc is not None and doc['_id']['time'] == key:
+                if doc['_id']['key'] != "__marker__":
                     value[doc['_id']['key']] = doc['value']
-                    needs_next_doc = True
-                else:
-                    needs_next_doc = False
-                    break
-
+                doc = next(docs,None)
+            keys.append(key)
             values.append(value)
-            key = StatBase.get_next_interval(interval,key)
+            if len(keys) >= chunk_size:
+                yield keys,values
+                keys = []
+                values = []
+            key = bucketing.shift(interval,key,1,tz)
             if key > end_date:
                 break
-        
+
+        if keys:
+            yield keys,values
+
+class DistributionStat(StatBase):
+    """
+    Distribution of numbers. Every bucket has the count, sum, minimum and
+    maximum of the values and a :class:`mongostats.sketches.DDSketch` of
+    them, so the quantiles of any bucket or range can be queried.
+    """
+
+    def __init__(self, name: str, min_interval: EventInterval = EventInterval.MINUTE,
+                 max_interval: EventInterval = EventInterval.MONTH,
+                 relative_accuracy: float = 0.01, timezone=None) -> None:
+        """
+        :Parameters:
+          - `name`: name of the stat, it will be used in the collection name
+          - `min_interval`: smallest time interval of the measurement
+          - `max_interval`: largest time interval of the measurement
+          - `relative_accuracy` (optional): relative error of the quantiles,
+            it can not be changed after data is collected
+          - `timezone` (optional): timezone of the buckets, see
+            :class:`EventStat`
+        """
+        super().__init__(name, min_interval, max_interval, timezone)
+        self.relative_accuracy = relative_accuracy
+        from .sketches import DDSketch
+        self._sketch = DDSketch(relative_accuracy)
+
+    def _get_collection(self,
+                        interval:EventInterval) -> pymongo.collection:
+        return database[self.name+"_"+str(interval)]
+
+    @handle_database_errors
+    def on_event(self,value) -> None:
+        """
+        Call this function when the event happens with the measured value
+        """
+        if not math.isfinite(value):
+            return
+
+        time = self._get_bucket(self.intervals[0])
+        if value > 0:
+            field = "p."+str(self._sketch.get_index(value))
+        elif value < 0:
+            field = "n."+str(self._sketch.get_index(value))
+        else:
+            field = "z"
+        self._get_collection(self.intervals[0]).update_one(
+            {"_id":time},
+            {"$inc":{"count":1,"sum":value,field:1},
+             "$min":{"min":value},"$max":{"max":value}},
+            upsert=True)
+
+    @handle_database_errors
+    def on_interval(self) -> None:
+        """
+        Call this function periodically, at least as often as the second
+        smallest interval
+        """
+        self._run_interval(self._get_now())
+
+    def _get_watermark_names(self) -> typing.List[str]:
+        return [self._get_watermark_name(interval) for interval in self.intervals[1:]]
+
+    def _run_interval(self,now:datetime,watermarks:typing.Dict[str,datetime]=None) -> None:
+        if watermarks is None:
+            watermarks = load_watermarks(self._get_watermark_names())
+        #the windows are ordered from the smallest interval, every interval
+        #is merged from the previous one written just before
+        for interval,start,end in self._get_merge_windows(now,watermarks):
+            source = self.intervals[self.intervals.index(interval)-1]
+            docs = self._get_collection(source).find({"_id":{"$gte":start,"$lt":end}})
+            self._get_collection(interval).bulk_write(
+                self._get_rollup_updates(interval,start,end,docs),ordered=False)
+            database[WATERMARK_COLLECTION].update_one(
+                {"_id":self._get_watermark_name(interval)},
+                {"$max":{"time":end}},upsert=True)
+
+    def _get_rollup_updates(self,interval:EventInterval,start:datetime,end:datetime,
+                            docs:typing.Iterable[dict]) -> list:
+        """
+        Merges the documents of the smaller interval into the periods of
+        `interval`, the periods without data get a zero count
+        """
+        merged = {}
+        for doc in docs:
+            time = self._get_bucket(interval,doc["_id"])
+            target = merged.get(time)
+            if target is None:
+                merged[time] = {key:(dict(value) if isinstance(value,dict) else value)
+                                for key,value in doc.items() if key != "_id"}
+                continue
+            target["count"] = target.get("count",0) + doc.get("count",0)
+            target["sum"] = target.get("sum",0) + doc.get("sum",0)
+            for key,choose in (("min",min),("max",max)):
+                if key in doc:
+                    target[key] = choose(target[key],doc[key]) if key in target else doc[key]
+            target["z"] = target.get("z",0) + doc.get("z",0)
+            for field in ("p","n"):
+                bins = target.setdefault(field,{})
+                for index,count in doc.get(field,{}).items():
+                    bins[index] = bins.get(index,0) + count
+
+        updates = []
+        time = start
+        while time < end:
+            updates.append(pymongo.ReplaceOne(
+                {"_id":time},merged.get(time,{"count":0,"sum":0}),upsert=True))
+            time = self._shift_bucket(interval,time,1)
+        return updates
+
+    def _get_sketch(self,doc:dict) -> "DDSketch":
+        from .sketches import DDSketch
+        sketch = DDSketch(self.relative_accuracy)
+        sketch.add_bins(doc.get("p"),doc.get("n"),doc.get("z",0))
+        return sketch
+
+    def _get_summary(self,docs:typing.Iterable[dict],
+                     quantiles:typing.Iterable[float]) -> dict:
+        """
+        Merges the documents into the count, sum, min, max, mean and the
+        requested quantiles
+        """
+        from .sketches import DDSketch
+        sketch = DDSketch(self.relative_accuracy)
+        summary = {"count":0,"sum":0,"min":None,"max":None}
+        for doc in docs:
+            sketch.merge(self._get_sketch(doc))
+            summary["count"] += doc.get("count",0)
+            summary["sum"] += doc.get("sum",0)
+            if "min" in doc:
+                summary["min"] = doc["min"] if summary["min"] is None else min(summary["min"],doc["min"])
+                summary["max"] = doc["max"] if summary["max"] is None else max(summary["max"],doc["max"])
+        summary["mean"] = summary["sum"] / summary["count"] if summary["count"] else None
+        for q in quantiles:
+            summary[q] = sketch.quantile(q)
+        return summary
+
+    def _find_data_view(self,interval:EventInterval,start_date:datetime,
+                        end_date:datetime):
+        coll = self._get_collection(interval)
+        return coll.find(
+            filter={"_id":{"$gte":start_date,"$lte":end_date}},
+            sort=[('_id', pymongo.ASCENDING)]
+        )
+
+    @handle_database_errors
+    def get_data_view(self,interval:EventInterval,start_date:datetime,end_date:datetime,
+                      quantiles:typing.Iterable[float]=(0.5,0.95,0.99)) -> typing.Tuple[typing.List[datetime],typing.List[dict]]:
+        """
+        Gets the collected data from the time range. Every value is a dict
+        with `count`, `sum`, `min`, `max`, `mean` and the requested
+        quantiles keyed by the quantile, for example `summary[0.99]`.
+        Returns a list of keys and values as `list[datetime], list[dict]`
+        """
+        quantiles = list(quantiles)
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        first = self._shift_bucket(interval,self._get_bucket(interval,start_date),-1)
+        docs = ({"_id":doc["_id"],"value":self._get_summary([doc],quantiles)}
+                for doc in self._find_data_view(interval,start_date,end_date))
+        empty = self._get_summary([],quantiles)
+        keys = []
+        values = []
+        for chunk_keys,chunk_values in EventStat._iter_data_view(interval,first,end_date,docs,tz=self.timezone):
+            keys.extend(chunk_keys)
+            values.extend(value or dict(empty) for value in chunk_values)
         return keys,values
 
+    @handle_database_errors
+    def get_quantiles(self,interval:EventInterval,start_date:datetime,end_date:datetime,
+                      quantiles:typing.Iterable[float]=(0.5,0.95,0.99)) -> dict:
+        """
+        Gets the summary of the whole time range from the buckets of
+        `interval`, in the form of the values of :meth:`get_data_view`
+        """
+        start_date = self._to_stored_time(start_date)
+        end_date = self._to_stored_time(end_date)
+        return self._get_summary(self._find_data_view(interval,start_date,end_date),list(quantiles))
+
+class _Session:
+    """
+    A session of the in-memory session store of :class:`StateStat`
+    """
+    __slots__ = ("created","events")
+
+    def __init__(self,created:datetime,events:list=None) -> None:
+        self.created = created
+        self.events = events if events is not None else []
+
 class StateStat(StatBase):
     """
     A stat object for event based statistics
     """
-    @handle_database_errors
     def __init__(
             self, name: str, start_event:str=None, end_event:str=None,
             magnitude_event:str=None, duration_event:str=None,
             unique_start_event:str=None, event_tracking:str=None,
             min_interval: EventInterval = EventInterval.MINUTE,
             max_interval: EventInterval = EventInterval.MONTH,
-            expire_after_seconds=None) -> None:
+            expire_after_seconds=None, storage=None, timezone=None,
+            unique_precision:int=12, duration_distribution:str=None,
+            in_memory:bool=False, absolute_event_times:bool=False,
+            max_events:int=None,
+            funnels:typing.Dict[str,typing.List[str]]=None, spool=None) -> None:
         """
         :Parameters:
           - `name`: name of the state, it will be used in the session
@@ -383,7 +1401,9 @@ class StateStat(StatBase):
             current count of the session is recorded at the intervals
           - `unique_start_event` (optional): name of the unique start event,
             if provided it will be measured in an :class:`EventStat` object,
-            the unique ids that has session in the interval measured
+            the unique ids that has session in the interval measured. The
+            ids are counted with HyperLogLog sketches in the `name_UNIQUE`
+            collection
           - `event_tracking` (optional): name of the collection where the
             event_tracking are stored if provided
           - `duration_event` (optional): name of the collection where the
@@ -393,8 +1413,44 @@ class StateStat(StatBase):
           - `expire_after_seconds` (optional): if provided the sessions will
             have a TTL set with this time amount. The expired sessions will not
             create duration events
+          - `storage` (optional): storage backend of the event stats, see
+            :class:`EventStat`
+          - `timezone` (optional): timezone of the buckets, see
+            :class:`EventStat`. The session times are stored in UTC with it
+          - `unique_precision` (optional): precision of the unique counting,
+            the sketches have `2 ** unique_precision` bytes and the error is
+            about `1.04 / sqrt(2 ** unique_precision)`
+          - `duration_distribution` (optional): name of a
+            :class:`DistributionStat` measuring the session durations in
+            seconds, if provided the quantiles of the durations can be
+            queried per interval
+          - `in_memory` (optional): if True the sessions are kept in memory
+            and written to the session collection in bulk at `on_interval`,
+            :meth:`checkpoint` and exit. The stored sessions are loaded when
+            the stat is created. The sessions of a stat must be handled by one
+            process
+          - `absolute_event_times` (optional): if True `on_custom_event`
+            stores the time of the event and writes it in one update without
+            reading the session, the times relative to the session start are
+            computed at `on_end_event`
+          - `max_events` (optional): limit of the tracked events of a
+            session, a positive value keeps the first, a negative value the
+            last events like the `$slice` modifier of `$push`
+          - `funnels` (optional): registered funnels as `{name: event_list}`.
+            The step reached by a session is computed when it ends and counted
+            in a :class:`MultiNumericStat` named `name` with the step as key,
+            see :meth:`get_funnel`
+          - `spool` (optional): a :class:`mongostats.spool.Spool` for the
+            start and end events and the funnel steps, see :class:`EventStat`.
+            The sessions are not spooled, see `in_memory`
         """
-        super().__init__(name, min_interval, max_interval)
+        super().__init__(name, min_interval, max_interval, timezone)
+        if storage is not None and timezone is not None:
+            raise ConfigError("The storage backends do not support timezones")
+        if storage is not None and spool is not None:
+            raise ConfigError("A spooled stat can not use a storage backend")
+        self.storage = storage
+        self.spool = spool
 
         self.start_event:EventStat | None = None
         "Optional EventStat for session start events"
@@ -406,30 +1462,349 @@ class StateStat(StatBase):
         "Optional EventStat for the unique session activity"
 
         if start_event:
-            self.start_event = EventStat(start_event)
-            self.start_event.intervals = self.intervals
+            self.start_event = self._create_event_stat(start_event)
         if end_event:
-            self.end_event = EventStat(end_event)
-            self.end_event.intervals = self.intervals
+            self.end_event = self._create_event_stat(end_event)
         if magnitude_event:
-            self.magnitude_event:EventStat | None = EventStat(magnitude_event)
-            self.magnitude_event.intervals = self.intervals
+            self.magnitude_event:EventStat | None = self._create_event_stat(magnitude_event)
+            #the larger intervals get the peak of the session count
+            self.magnitude_event.accumulator = "$max"
         if unique_start_event:
-            self.unique_start_event:EventStat | None = EventStat(unique_start_event)
-            self.unique_start_event.intervals = self.intervals
+            self.unique_start_event:EventStat | None = self._create_event_stat(unique_start_event)
+        self.duration_distribution:DistributionStat | None = None
+        "Optional DistributionStat for the session durations"
+        if duration_distribution:
+            self.duration_distribution = self._create_distribution_stat(duration_distribution)
+        self.funnels:typing.Dict[str,typing.List[str]] = {}
+        "Event lists of the registered funnels by name"
+        self.funnel_stats:typing.Dict[str,MultiNumericStat] = {}
+        "MultiNumericStats of the registered funnels by name"
+        for funnel_name,event_list in (funnels or {}).items():
+            if len(event_list) < 2:
+                raise ConfigError("A funnel needs at least two events")
+            self.funnels[funnel_name] = list(event_list)
+            self.funnel_stats[funnel_name] = self._create_funnel_stat(funnel_name)
+        self.unique_precision = unique_precision
+        #sketches of the unique ids by bucket of the smallest interval, not
+        #written yet
+        self._unique_sketches = {}
+        self._unique_lock = threading.Lock()
+        #the sketches of every process are stored separately and merged at
+        #the rollup
+        self._unique_node = uuid.uuid4().hex
 
         self.event_tracking_name = event_tracking
         self.duration_event_name = duration_event
+        self.expire_after_seconds = expire_after_seconds
+        self.absolute_event_times = absolute_event_times
+        self.max_events = max_events
 
         if expire_after_seconds:
-            global database
             self.use_ttl = True
-            self._get_session_collection().create_index(
-                {"created":1},
-                expireAfterSeconds=expire_after_seconds)
+
+        #id -> _Session, None if the sessions are in the database
+        self._sessions = None
+        if in_memory:
+            self._sessions = {}
+            self._sessions_lock = threading.Lock()
+            #ids changed and ended since the last checkpoint
+            self._dirty_sessions = set()
+            self._ended_sessions = set()
+            self._load_sessions()
+
+    _event_stat_class = EventStat
+    "Class of the EventStat objects measuring the session events"
+    _funnel_stat_class = MultiNumericStat
+    "Class of the MultiNumericStat objects counting the funnel steps"
+
+    def _create_event_stat(self,name:str) -> EventStat:
+        stat = self._event_stat_class(name)
+        stat.intervals = self.intervals
+        stat.storage = self.storage
+        stat.timezone = self.timezone
+        self._set_spool(stat)
+        #the event stats are driven by this stat
+        registry.discard(stat)
+        return stat
+
+    def _set_spool(self,stat) -> None:
+        stat.spool = self.spool
+        if self.spool is not None:
+            self.spool.register(stat)
+
+    def _create_distribution_stat(self,name:str) -> DistributionStat:
+        stat = DistributionStat(name,self.intervals[0],self.intervals[-1],timezone=self.timezone)
+        registry.discard(stat)
+        return stat
+
+    def _get_index_specs(self) -> typing.List[typing.Tuple[typing.Any,list,dict]]:
+        specs = []
+        for stat in self.funnel_stats.values():
+            specs.extend(stat._get_index_specs())
+        if self.expire_after_seconds:
+            specs.append((self._get_session_collection(),[("created",1)],
+                          {"expireAfterSeconds":self.expire_after_seconds}))
+        if self.event_tracking_name:
+            #the funnel matches an event and a range of start times
+            specs.append((self._get_tracking_collection(),
+                          [("events.event",1),("startTime",1)],{}))
+        if self.duration_event_name:
+            specs.append((self._get_duration_collection(),[("endTime",1)],{}))
+        return specs
+
+    def _create_funnel_stat(self,name:str) -> MultiNumericStat:
+        stat = self._funnel_stat_class(name,self.intervals[0],self.intervals[-1])
+        stat.timezone = self.timezone
+        self._set_spool(stat)
+        registry.discard(stat)
+        return stat
 
     def _get_session_collection(self):
         return database[self.name+"_SESSION"]
+
+    def _get_tracking_collection(self):
+        return database[self.event_tracking_name]
+
+    def _get_duration_collection(self):
+        return database[self.duration_event_name]
+
+    @handle_database_errors
+    def _load_sessions(self) -> None:
+        """
+        Loads the checkpointed sessions into the in-memory store
+        """
+        for doc in self._get_session_collection().find():
+            self._sessions[doc["_id"]] = _Session(doc["created"],doc.get("events",[]))
+
+    def _start_session(self,id) -> bool:
+        """
+        Adds a session to the in-memory store, returns False if it exists
+        """
+        with self._sessions_lock:
+            if id in self._sessions:
+                return False
+            self._sessions[id] = _Session(self._get_now())
+            self._dirty_sessions.add(id)
+            self._ended_sessions.discard(id)
+            return True
+
+    def _pop_session(self,id) -> typing.Optional[dict]:
+        """
+        Removes a session from the in-memory store, returns it in the form of
+        the session documents
+        """
+        with self._sessions_lock:
+            session = self._sessions.pop(id,None)
+            if session is None:
+                return None
+            self._dirty_sessions.discard(id)
+            self._ended_sessions.add(id)
+        return {"_id":id,"created":session.created,"events":session.events}
+
+    def _get_checkpoint_writes(self) -> typing.Tuple[list,set,set]:
+        """
+        Takes the changes of the in-memory store since the last checkpoint as
+        bulk writes. The expired sessions are dropped. Returns the writes and
+        the taken changed and ended ids
+        """
+        with self._sessions_lock:
+            if self.expire_after_seconds:
+                limit = self._get_now() - timedelta(seconds=self.expire_after_seconds)
+                for id,session in list(self._sessions.items()):
+                    if session.created < limit:
+                        del self._sessions[id]
+                        self._dirty_sessions.discard(id)
+                        self._ended_sessions.add(id)
+            writes = [
+                pymongo.ReplaceOne(
+                    {"_id":id},
+                    {"created":self._sessions[id].created,"events":list(self._sessions[id].events)},
+                    upsert=True)
+                for id in self._dirty_sessions
+            ]
+            writes.extend(pymongo.DeleteOne({"_id":id}) for id in self._ended_sessions)
+            dirty,ended = self._dirty_sessions,self._ended_sessions
+            self._dirty_sessions = set()
+            self._ended_sessions = set()
+        return writes,dirty,ended
+
+    def _restore_checkpoint(self,dirty:set,ended:set) -> None:
+        """
+        Puts back the changes of a failed checkpoint, unless the session
+        changed again since
+        """
+        with self._sessions_lock:
+            for id in dirty:
+                if id in self._sessions and id not in self._ended_sessions:
+                    self._dirty_sessions.add(id)
+            for id in ended:
+                if id not in self._sessions and id not in self._dirty_sessions:
+                    self._ended_sessions.add(id)
+
+    @handle_database_errors
+    def checkpoint(self) -> None:
+        """
+        Writes the changes of the in-memory sessions to the session
+        collection. It is called by `on_interval` and at exit
+        """
+        if self._sessions is None:
+            return
+        writes,dirty,ended = self._get_checkpoint_writes()
+        if writes:
+            try:
+                self._ensure_indexes()
+                self._get_session_collection().bulk_write(writes,ordered=False)
+            except Exception:
+                #the next checkpoint writes them again, the writes are
+                #idempotent
+                self._restore_checkpoint(dirty,ended)
+                raise
+
+    def _get_session_count(self) -> int:
+        if self._sessions is not None:
+            return len(self._sessions)
+        return self._get_session_collection().count_documents({})
+
+    def _get_unique_collection(self):
+        return database[self.name+"_UNIQUE"]
+
+    def _get_unique_watermark_name(self,interval:EventInterval) -> str:
+        return self.name+"_UNIQUE_"+str(interval)
+
+    def _add_unique(self,id) -> typing.Dict[datetime,"HyperLogLog"]:
+        """
+        Adds the id to the sketch of the current bucket. Returns the sketches
+        of the buckets closed since the last call, they are to be written
+        """
+        time = self._get_bucket(self.intervals[0])
+        closed = {}
+        with self._unique_lock:
+            sketch = self._unique_sketches.get(time)
+            if sketch is None:
+                from .sketches import HyperLogLog
+                closed = self._take_unique_sketches(time)
+                sketch = self._unique_sketches[time] = HyperLogLog(self.unique_precision)
+            sketch.add(id)
+        return closed
+
+    def _take_unique_sketches(self,before:datetime) -> typing.Dict[datetime,"HyperLogLog"]:
+        """
+        Removes the sketches of the buckets before `before` from the memory,
+        the caller holds the lock
+        """
+        closed = {time:sketch for time,sketch in self._unique_sketches.items() if time < before}
+        for time in closed:
+            del self._unique_sketches[time]
+        return closed
+
+    def _get_unique_sketch_id(self,interval:EventInterval,time:datetime,
+                              node:str) -> dict:
+        #the field order matters, the sketches of an interval are ordered by
+        #time in the _id index
+        return {"interval":str(interval),"time":time,"node":node}
+
+    def _get_unique_sketch_writes(self,sketches:typing.Dict[datetime,"HyperLogLog"]) -> list:
+        return [
+            pymongo.UpdateOne(
+                {"_id":self._get_unique_sketch_id(self.intervals[0],time,self._unique_node)},
+                {"$set":{"registers":sketch.to_bytes()}},upsert=True)
+            for time,sketch in sketches.items()
+        ]
+
+    def _get_unique_windows(self,now:datetime,
+                            watermarks:typing.Dict[str,datetime]) -> typing.List[typing.Tuple[EventInterval,datetime,datetime]]:
+        """
+        Returns the closed periods of every interval not counted yet as
+        `(interval, start, end)`, ordered from the smallest interval. The
+        smallest interval waits an extra bucket for the sketches of the
+        other processes, the others wait until the previous interval has
+        merged the whole period
+        """
+        windows = []
+        #end of the merged sketches of the previous interval
+        merged = None
+        for interval in self.intervals:
+            watermark = watermarks.get(self._get_unique_watermark_name(interval))
+            end = self._get_bucket(interval,now)
+            if interval == self.intervals[0]:
+                end = self._shift_bucket(interval,end,-1)
+            elif merged is None:
+                break
+            else:
+                end = min(end,self._get_bucket(interval,merged))
+            start = watermark
+            if start is None:
+                start = self._shift_bucket(interval,end,-1)
+            end = min(end,self._shift_bucket(interval,start,self.rollup_catch_up))
+            if start < end:
+                windows.append((interval,start,end))
+                merged = end
+            else:
+                merged = watermark
+        return windows
+
+    def _get_unique_source_query(self,interval:EventInterval,start:datetime,
+                                 end:datetime) -> dict:
+        """
+        Query of the sketches an interval is merged from: the sketches of
+        the processes for the smallest interval, the merged sketches of the
+        previous interval for the others
+        """
+        index = self.intervals.index(interval)
+        source = self.intervals[index-1] if index else interval
+        query = {"_id":{"$gte":{"interval":str(source),"time":start},
+                        "$lt":{"interval":str(source),"time":end}}}
+        if index:
+            query["_id.node"] = "*"
+        return query
+
+    def _get_unique_updates(self,interval:EventInterval,start:datetime,
+                            end:datetime,docs:typing.Iterable[dict]) -> typing.Tuple[list,list]:
+        """
+        Merges the source sketches into the buckets of `interval`. Returns the
+        writes of the merged sketches and of the counts, the buckets without
+        sketches get 0
+        """
+        from .sketches import HyperLogLog
+        merged = {}
+        for doc in docs:
+            time = self._get_bucket(interval,doc["_id"]["time"])
+            sketch = HyperLogLog.from_bytes(doc["registers"])
+            if time in merged:
+                merged[time].merge(sketch)
+            else:
+                merged[time] = sketch
+
+        sketch_writes = [
+            pymongo.UpdateOne(
+                {"_id":self._get_unique_sketch_id(interval,time,"*")},
+                {"$set":{"registers":sketch.to_bytes()}},upsert=True)
+            for time,sketch in merged.items()
+        ]
+        value_writes = []
+        time = start
+        while time < end:
+            count = merged[time].count() if time in merged else 0
+            value_writes.append(pymongo.UpdateOne(
+                {"_id":time},{"$set":{"value":count}},upsert=True))
+            time = self._shift_bucket(interval,time,1)
+        return sketch_writes,value_writes
+
+    def _get_unique_cleanup_query(self,interval:EventInterval,start:datetime,
+                                  end:datetime) -> dict:
+        """
+        Query of the sketches not needed after `interval` is counted
+        """
+        index = self.intervals.index(interval)
+        source = self.intervals[index-1] if index else interval
+        query = {"_id":{"$gte":{"interval":str(source),"time":start},
+                        "$lt":{"interval":str(source),"time":end}}}
+        if not index:
+            #the merged sketches are the source of the next interval
+            query["_id.node"] = {"$ne":"*"}
+        #the larger intervals remove the late sketches of the processes too,
+        #the period is counted by the previous interval already
+        return query
     
     @handle_database_errors
     def on_start_event(self,id):
@@ -439,22 +1814,26 @@ class StateStat(StatBase):
         state ends. The `id` can be any datatype that can be any type that the
         pymongo can handle
         """
-        global database
-
-        try:
-            coll = self._get_session_collection()
-            coll.insert_one({"_id":id,"created":datetime.now(),"events":[]})
-        except pymongo.errors.DuplicateKeyError:
-            self.on_end_event(id)
-            self.on_start_event(id)
-            return
+        if self._sessions is not None:
+            if not self._start_session(id):
+                self.on_end_event(id)
+                self.on_start_event(id)
+                return
+        else:
+            self._ensure_indexes()
+            try:
+                coll = self._get_session_collection()
+                coll.insert_one({"_id":id,"created":self._get_now(),"events":[]})
+            except pymongo.errors.DuplicateKeyError:
+                self.on_end_event(id)
+                self.on_start_event(id)
+                return
         
         if self.unique_start_event:
-            for i in range(1,len(self.intervals)):
-                interval = self.intervals[i]
-                coll = database[self.name+"_UNIQUE_"+str(interval)]
-                doc = {"_id":id}
-                coll.replace_one(doc,doc,upsert=True)
+            closed = self._add_unique(id)
+            if closed:
+                self._get_unique_collection().bulk_write(
+                    self._get_unique_sketch_writes(closed),ordered=False)
 
         if self.start_event:
             self.start_event.on_event()
@@ -465,44 +1844,181 @@ class StateStat(StatBase):
         Call this function when the state ends. Provide a unique id for the
         state
         """
-        global database
-
-        coll = self._get_session_collection()
-        doc = coll.find_one_and_delete({"_id":id})
+        if self._sessions is not None:
+            doc = self._pop_session(id)
+        else:
+            coll = self._get_session_collection()
+            doc = coll.find_one_and_delete({"_id":id})
         if  not doc:
             return
 
         if self.end_event:
             self.end_event.on_event()
 
-        if self.duration_event_name:
-            delta = datetime.now() - doc["created"]
-            duration = delta.total_seconds()
+        delta = self._get_now() - doc["created"]
+        duration = delta.total_seconds()
 
-            coll = database[self.duration_event_name]
-            coll.insert_one({"duration":duration,"endTime":datetime.now()})
+        if self.duration_distribution:
+            self.duration_distribution.on_event(duration)
+
+        for funnel_name,step in self._get_funnel_steps(doc):
+            self.funnel_stats[funnel_name].on_event(step,1)
+
+        if self.duration_event_name or self.event_tracking_name:
+            self._ensure_indexes()
+
+        if self.duration_event_name:
+            coll = self._get_duration_collection()
+            coll.insert_one({"duration":duration,"endTime":self._get_now()})
         
         if self.event_tracking_name:
             if 'events' in doc and len(doc['events']):
-                coll = database[self.event_tracking_name]
-                coll.insert_one({"startTime":duration,"endTime":datetime.now(),'events':doc['events']})
+                coll = self._get_tracking_collection()
+                coll.insert_one(self._get_tracking_document(doc,duration))
 
     
+    def _get_funnel_steps(self,doc:dict) -> typing.List[typing.Tuple[str,int]]:
+        """
+        The steps reached by an ended session in the registered funnels, the
+        funnels not started are left out
+        """
+        names = [event['event'] for event in doc.get('events',[])]
+        steps = []
+        for funnel_name,event_list in self.funnels.items():
+            step = StateStat._get_funnel_step(names,event_list)
+            if step:
+                steps.append((funnel_name,step))
+        return steps
+
+    @staticmethod
+    def _get_funnel_step(names:typing.List[str],event_list:typing.List[str]) -> int:
+        """
+        Number of the funnel steps completed in order, the same as the
+        funnel pipeline computes: the first occurrence of every step must
+        follow the previous step
+        """
+        step = 0
+        previous = -1
+        for event_name in event_list:
+            index = names.index(event_name) if event_name in names else -1
+            if index <= previous:
+                break
+            previous = index
+            step += 1
+        return step
+
+    def _get_tracking_document(self,doc:dict,duration:float) -> dict:
+        """
+        The document of an ended session in the event tracking collection
+        """
+        return {"startTime":doc["created"],"endTime":self._get_now(),
+                "duration":duration,'events':StateStat._get_relative_events(doc)}
+
     @handle_database_errors
     def on_custom_event(self,id,event_name,extra_info=None,timeoffset=0):
         """
         Call this function when you want to add an event to the event tracking.
         Provide the unique id for the state
-        Provide the name of the event and extra info if needed
+        Provide the name of the event and extra info if needed. The
+        `timeoffset` is the number of seconds the event happened before now
         """
-        global database
+        self.on_custom_events(id,[(event_name,extra_info,timeoffset)])
 
-        coll = self._get_session_collection()
-        doc = coll.find_one({"_id":id},projection={'created': True})
-        if  not doc:
+    @handle_database_errors
+    def on_custom_events(self,id,events:typing.Iterable) -> None:
+        """
+        Adds many events of a session to the event tracking in one update.
+        An event is a name or a tuple of `(event_name, extra_info)` or
+        `(event_name, extra_info, timeoffset)`
+        """
+        events = StateStat._get_event_arguments(events)
+        if not events:
+            return
+        now = self._get_now()
+
+        if self._sessions is not None:
+            with self._sessions_lock:
+                session = self._sessions.get(id)
+                if session is None:
+                    return
+                session.events.extend(
+                    StateStat._get_tracked_event({"created":session.created},*event,now)
+                    for event in events)
+                if self.max_events:
+                    session.events[:] = (session.events[:self.max_events] if self.max_events > 0
+                                         else session.events[self.max_events:])
+                self._dirty_sessions.add(id)
             return
 
-        delta = datetime.now() - doc["created"]
+        coll = self._get_session_collection()
+        if self.absolute_event_times:
+            entries = [StateStat._get_timed_event(*event,now) for event in events]
+        else:
+            doc = coll.find_one({"_id":id},projection={'created': True})
+            if  not doc:
+                return
+            entries = [StateStat._get_tracked_event(doc,*event,now) for event in events]
+        coll.update_one({"_id":id},self._get_events_update(entries))
+
+    @staticmethod
+    def _get_event_arguments(events:typing.Iterable) -> typing.List[tuple]:
+        """
+        Converts the events of :meth:`on_custom_events` to
+        `(event_name, extra_info, timeoffset)` tuples
+        """
+        arguments = []
+        for event in events:
+            if isinstance(event,str):
+                event = (event,)
+            event = tuple(event)
+            arguments.append(event + (None,0)[len(event)-1:])
+        return arguments
+
+    def _get_events_update(self,entries:list) -> dict:
+        if self.max_events:
+            return {'$push':{'events':{'$each':entries,'$slice':self.max_events}}}
+        if len(entries) == 1:
+            return {'$push':{'events':entries[0]}}
+        return {'$push':{'events':{'$each':entries}}}
+
+    @staticmethod
+    def _get_timed_event(event_name,extra_info,timeoffset,now:datetime) -> dict:
+        """
+        Creates an event tracking entry with the time of the event, it is made
+        relative by :meth:`_get_relative_events`
+        """
+        new_data = {
+            'event': event_name,
+            'at': now - timedelta(seconds=timeoffset) if timeoffset else now
+        }
+
+        if extra_info:
+            new_data['data'] = extra_info
+        return new_data
+
+    @staticmethod
+    def _get_relative_events(doc:dict) -> list:
+        """
+        The tracked events of a session document with the times relative to
+        the session start
+        """
+        events = []
+        for event in doc['events']:
+            if 'at' in event:
+                relative = {'event':event['event'],
+                            'time':(event['at'] - doc["created"]).total_seconds()}
+                if 'data' in event:
+                    relative['data'] = event['data']
+                event = relative
+            events.append(event)
+        return events
+
+    @staticmethod
+    def _get_tracked_event(doc,event_name,extra_info,timeoffset,now:datetime) -> dict:
+        """
+        Creates the event tracking entry of a session document
+        """
+        delta = now - doc["created"]
         duration = delta.total_seconds() - timeoffset
 
         new_data = {
@@ -512,8 +2028,7 @@ class StateStat(StatBase):
 
         if extra_info:
             new_data['data'] = extra_info
-
-        coll.update_one({"_id":id},{'$push':{'events':new_data}})
+        return new_data
 
     @handle_database_errors
     def on_interval(self) -> None:
@@ -521,82 +2036,101 @@ class StateStat(StatBase):
         Call this function periodically, at least as often as the second
         smallest interval
         """
-        now = datetime.now(tz=None)
+        self._run_interval(self._get_now())
+
+    def _get_watermark_names(self) -> typing.List[str]:
+        names = []
+        for stat in (self.start_event,self.end_event,self.magnitude_event,self.duration_distribution):
+            if stat:
+                names.extend(stat._get_watermark_names())
+        for stat in self.funnel_stats.values():
+            names.extend(stat._get_watermark_names())
+        if self.unique_start_event:
+            names.extend(self._get_unique_watermark_name(interval) for interval in self.intervals)
+        return names
+
+    def _run_interval(self,now:datetime,watermarks:typing.Dict[str,datetime]=None) -> None:
+        if watermarks is None:
+            watermarks = load_watermarks(self._get_watermark_names())
 
         if self.start_event:
-            self.start_event.on_interval()
+            self.start_event._run_interval(now,watermarks)
         if self.end_event:
-            self.end_event.on_interval()
+            self.end_event._run_interval(now,watermarks)
+        if self.duration_distribution:
+            self.duration_distribution._run_interval(now,watermarks)
+        for stat in self.funnel_stats.values():
+            stat._run_interval(now,watermarks)
         
         #magnitude
         smallest_interval = self.intervals[0]
-        time = StatBase.get_datetime_for_interval(smallest_interval,now)
+        time = self._get_bucket(smallest_interval,now)
         #end of the measure window
 
+        if self._sessions is not None:
+            self.checkpoint()
+
         if self.magnitude_event:
-            sessioncoll = self._get_session_collection()
-            count = sessioncoll.count_documents({})
-
-            coll = self.magnitude_event._get_collection(smallest_interval)
-            coll.insert_one({"_id":time,"value":count})
-
-        for i in range(1,len(self.intervals)):
-            interval = self.intervals[i]
-            
-            #check if the result exists and create the aggregation if needed
-            currenttime = StatBase.get_datetime_for_interval(interval,now)
-            #end of the measure window
-            time = StatBase.get_prev_interval(interval,currenttime)
-            #start of the measure window
-
-            if self.magnitude_event:
-                #collection to collect the data from
-                coll = self.magnitude_event._get_collection(
-                    EventInterval(interval.value-1))
-                colltarget = self.magnitude_event._get_collection(interval)
-        
-                if colltarget.count_documents({"_id":time}) == 0:
-                    coll.aggregate([
-                        {"$match":{"_id":{"$lt":currenttime,"$gte":time}}},
-                        {"$group":{"_id":time,"value":{"$max":"$value"}}},
-                        {"$merge":{
-                            "into":self.magnitude_event.name+"_"+str(interval)
-                        }}
-                    ])
-
-                    #if the $match is empty, no document is created
-                    if colltarget.count_documents({"_id":time}) == 0:
-                        colltarget.insert_one({"_id":time,"value":0})
+            count = self._get_session_count()
+
+            self.magnitude_event._put_max(time,count)
+
+            self.magnitude_event._rollup(now,watermarks)
         
         if self.unique_start_event:
-            smallest_rounded = StatBase.get_datetime_for_interval(self.unique_start_event.intervals[0],now)
-            for i in range(len(self.unique_start_event.intervals)):
-                interval = self.unique_start_event.intervals[i]
-                currenttime = StatBase.get_datetime_for_interval(interval,now)
-                time = StatBase.get_prev_interval(interval,currenttime)
-
-                #only do the larger intervals when needed
-                if smallest_rounded == currenttime:
-                    coll = self.unique_start_event._get_collection(interval)
-                    measurecoll = database[self.name+"_UNIQUE_"+str(interval)]
-                    
-                    count = 0
-                    if measurecoll is not None:
-                        #get the count of ids on the current interval and save it
-                        count = measurecoll.count_documents()
-                        #clear the id collection
-                        measurecoll.drop()
-                    
-                    coll.insert_one({"_id":time,"value":count})
-
-                    coll.insert_one({"_id":time,"value":count})
+            self._unique_rollup(now,watermarks)
+
+    def _unique_rollup(self,now:datetime,watermarks:typing.Dict[str,datetime]) -> None:
+        """
+        Writes the sketches of this process, then merges the sketches of the
+        closed periods into the larger intervals and stores the counts
+        """
+        coll = self._get_unique_collection()
+        with self._unique_lock:
+            sketches = self._take_unique_sketches(self._get_bucket(self.intervals[0],now))
+            #the current bucket is written too, but it stays in memory
+            sketches.update(self._unique_sketches)
+        if sketches:
+            coll.bulk_write(self._get_unique_sketch_writes(sketches),ordered=False)
+
+        for interval,start,end in self._get_unique_windows(now,watermarks):
+            docs = coll.find(self._get_unique_source_query(interval,start,end))
+            sketch_writes,value_writes = self._get_unique_updates(interval,start,end,docs)
+            if sketch_writes:
+                coll.bulk_write(sketch_writes,ordered=False)
+            self.unique_start_event._get_collection(interval).bulk_write(value_writes,ordered=False)
+            database[WATERMARK_COLLECTION].update_one(
+                {"_id":self._get_unique_watermark_name(interval)},
+                {"$max":{"time":end}},upsert=True)
+            coll.delete_many(self._get_unique_cleanup_query(interval,start,end))
+
+    def _get_diagnostic_queries(self,start_date:datetime,
+                                end_date:datetime) -> typing.List[typing.Tuple[str,dict]]:
+        queries = []
+        for stat in (self.start_event,self.end_event,self.magnitude_event,
+                     self.unique_start_event,self.duration_distribution,
+                     *self.funnel_stats.values()):
+            if stat:
+                queries.extend(stat._get_diagnostic_queries(start_date,end_date))
+        if self.unique_start_event:
+            queries.extend(
+                (self._get_unique_collection().name,
+                 self._get_unique_source_query(interval,start_date,end_date))
+                for interval in self.intervals)
+        if self.event_tracking_name:
+            queries.append((self._get_tracking_collection().name,
+                            StateStat._get_funnel_pipeline(start_date,end_date,["",""])[0]["$match"]))
+        if self.duration_event_name:
+            queries.append((self._get_duration_collection().name,
+                            {"endTime":{"$gte":start_date,"$lte":end_date}}))
+        return queries
 
     @handle_database_errors
     def get_funnel_analysis(self,start_date:datetime,end_date:datetime,
                             event_list:typing.List[str]) -> typing.List[typing.Tuple[str,int]]:
         """
-        Makes a funnel analysis for the given time range.
-        Uses the event_list for the funnel
+        Makes a funnel analysis for the sessions started in the given time
+        range. Uses the event_list for the funnel
         Returns a list of the events with how many of them are completed it in a session`
         """
 
@@ -606,9 +2140,42 @@ class StateStat(StatBase):
         if len(event_list) < 2:
             return []
         
-        coll = database[self.event_tracking_name]
+        coll = self._get_tracking_collection()
+        cursor = coll.aggregate(StateStat._get_funnel_pipeline(
+            self._to_stored_time(start_date),self._to_stored_time(end_date),event_list))
 
-        cursor = coll.aggregate([
+        result = []
+        for doc in cursor:
+            result.append((doc["_id"],doc["count"]))
+        
+        return result
+
+    @handle_database_errors
+    def get_funnel(self,name:str,interval:EventInterval,start_date:datetime,
+                   end_date:datetime) -> typing.List[typing.Tuple[int,int]]:
+        """
+        Reads a registered funnel for the sessions ended in the time range
+        from the buckets of `interval`, without scanning the sessions.
+        Returns the reached step numbers with the count of sessions like
+        :meth:`get_funnel_analysis`
+        """
+        if name not in self.funnel_stats:
+            raise ConfigError("There is no registered funnel named "+name)
+        _,values = self.funnel_stats[name].get_data_view(interval,start_date,end_date)
+        return StateStat._sum_funnel_steps(values)
+
+    @staticmethod
+    def _sum_funnel_steps(values:typing.Iterable[dict]) -> typing.List[typing.Tuple[int,int]]:
+        counts = {}
+        for value in values:
+            for step,count in value.items():
+                counts[step] = counts.get(step,0) + count
+        return sorted((step,count) for step,count in counts.items() if count)
+
+    @staticmethod
+    def _get_funnel_pipeline(start_date:datetime,end_date:datetime,
+                             event_list:typing.List[str]) -> list:
+        return [
             #filter out that are not even starting the 
             {
                 "$match": {
@@ -682,13 +2249,41 @@ class StateStat(StatBase):
             {
                 "$sort": { "_id": 1 }
             }
-        ])
+        ]
 
-        result = []
-        for doc in cursor:
-            result.append((doc["_id"],doc["count"]))
-        
-        return result
 
-        
- 
+def ensure_schema(stats:typing.Iterable[StatBase]=None) -> int:
+    """
+    Creates the indexes and collections of the stats now instead of at their
+    first write, for example at deploy time. By default every stat created
+    in the process is processed, the asyncio stats have `create_indexes`
+    instead.
+
+    Returns the number of indexes created
+    """
+    import inspect
+
+    if dbclient is None:
+        raise ConfigError("The database connection is not initialized")
+    if stats is None:
+        stats = list(registry)
+
+    created = 0
+    for stat in stats:
+        if inspect.iscoroutinefunction(stat.on_interval):
+            continue
+        if getattr(stat,"storage",None) is not None:
+            #the storage backends create their collection at the first use
+            stat.storage._get_collection()
+        created += stat._ensure_indexes()
+    return created
+
+
+@atexit.register
+def _drain_at_exit() -> None:
+    #runs before the write buffer is flushed at exit
+    for stat in list(registry):
+        if isinstance(stat,MultiNumericStat) and stat.top_k and stat._heavy_hitters:
+            stat._drain_heavy_hitters()
+        if isinstance(stat,StateStat) and stat._sessions is not None:
+            stat.checkpoint()
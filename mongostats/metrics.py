@@ -0,0 +1,342 @@
+"""
+Instrumentation of the stats: the calls and latency of the operations and
+the database round trips, bytes and latency they cause, per stat and
+operation.
+
+The round trips are counted by :data:`listener`, a pymongo command listener.
+Pass it to the client, `MongoClient(..., event_listeners=[listener])`, or
+let :func:`enable_metrics` register it globally before the client is
+created. While the metrics are disabled the stats only check a flag.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+import types
+import typing
+
+import bson
+import pymongo.monitoring
+
+enabled = False
+"True if the operations are measured, see :func:`enable_metrics`"
+
+#upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+#(stat name, operation) of the running operation
+_operation = contextvars.ContextVar("mongostats_operation",default=None)
+
+
+class OperationMetrics(typing.NamedTuple):
+    """
+    Counters of an operation of a stat
+    """
+    calls: int
+    errors: int
+    "Calls that raised an exception"
+    seconds: float
+    "Total time spent in the calls"
+    latency_buckets: typing.Tuple[int,...]
+    "Number of calls faster than each of :data:`BUCKETS`, cumulative"
+    round_trips: int
+    failed_round_trips: int
+    bytes_sent: int
+    bytes_received: int
+    database_seconds: float
+    "Total time of the round trips as measured by the driver"
+
+
+class _Counters:
+    __slots__ = ("calls","errors","seconds","buckets","round_trips","failed_round_trips",
+                 "bytes_sent","bytes_received","database_seconds")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.round_trips = 0
+        self.failed_round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.database_seconds = 0.0
+
+    def snapshot(self) -> OperationMetrics:
+        cumulative = []
+        total = 0
+        for count in self.buckets:
+            total += count
+            cumulative.append(total)
+        return OperationMetrics(self.calls,self.errors,self.seconds,tuple(cumulative),
+                                self.round_trips,self.failed_round_trips,
+                                self.bytes_sent,self.bytes_received,self.database_seconds)
+
+
+_counters = {}
+_lock = threading.Lock()
+
+
+def _get_counters(key:typing.Tuple[str,str]) -> _Counters:
+    #called with the lock held
+    counters = _counters.get(key)
+    if counters is None:
+        counters = _counters[key] = _Counters()
+    return counters
+
+
+def _record_call(key:typing.Tuple[str,str],seconds:float,failed:bool) -> None:
+    with _lock:
+        counters = _get_counters(key)
+        counters.calls += 1
+        counters.seconds += seconds
+        if failed:
+            counters.errors += 1
+        for index,bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counters.buckets[index] += 1
+                break
+
+
+class CommandListener(pymongo.monitoring.CommandListener):
+    """
+    Attributes the commands to the operation running in the context that
+    sends them. The commands sent outside of the stat operations are not
+    counted
+    """
+    def __init__(self) -> None:
+        #(connection, request id) -> operation of the commands in flight
+        self._pending = {}
+
+    def started(self,event) -> None:
+        if not enabled:
+            return
+        key = _operation.get()
+        if key is None:
+            return
+        size = len(bson.encode(event.command))
+        self._pending[(event.connection_id,event.request_id)] = key
+        with _lock:
+            counters = _get_counters(key)
+            counters.round_trips += 1
+            counters.bytes_sent += size
+
+    def succeeded(self,event) -> None:
+        key = self._pending.pop((event.connection_id,event.request_id),None)
+        if key is None:
+            return
+        size = len(bson.encode(event.reply))
+        with _lock:
+            counters = _get_counters(key)
+            counters.bytes_received += size
+            counters.database_seconds += event.duration_micros / 1e6
+
+    def failed(self,event) -> None:
+        key = self._pending.pop((event.connection_id,event.request_id),None)
+        if key is None:
+            return
+        with _lock:
+            counters = _get_counters(key)
+            counters.failed_round_trips += 1
+            counters.database_seconds += event.duration_micros / 1e6
+
+
+listener = CommandListener()
+"The command listener to pass to the `MongoClient`"
+
+_registered = False
+
+
+def enable_metrics(register_listener:bool=True) -> None:
+    """
+    Starts measuring the operations of the stats
+
+    :Parameters:
+      - `register_listener` (optional): registers :data:`listener` for the
+        clients created after this call, the existing clients have to be
+        created with it in their `event_listeners`
+    """
+    global enabled,_registered
+    if register_listener and not _registered:
+        pymongo.monitoring.register(listener)
+        _registered = True
+    enabled = True
+
+
+def disable_metrics() -> None:
+    """
+    Stops measuring, the collected metrics are kept
+    """
+    global enabled
+    enabled = False
+
+
+def reset_metrics() -> None:
+    """
+    Clears the collected metrics
+    """
+    with _lock:
+        _counters.clear()
+
+
+def get_metrics() -> typing.Dict[typing.Tuple[str,str],OperationMetrics]:
+    """
+    Returns a snapshot of the metrics by `(stat name, operation)`
+    """
+    with _lock:
+        return {key:counters.snapshot() for key,counters in _counters.items()}
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def operation(stat_name:str,name:str) -> typing.ContextManager:
+    """
+    Context manager measuring the work of a stat done outside of its public
+    methods, like the flushes and the scheduled rollups
+    """
+    if not enabled:
+        return _NULL_CONTEXT
+    return _measure(stat_name,name)
+
+
+@contextlib.contextmanager
+def _measure(stat_name:str,name:str) -> typing.Iterator[None]:
+    key = (stat_name,name)
+    token = _operation.set(key)
+    started = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        _operation.reset(token)
+        _record_call(key,time.perf_counter()-started,failed)
+
+
+def measure(func:typing.Callable,args:tuple,kwargs:dict):
+    """
+    Calls the stat method `func` as a measured operation. A returned
+    generator is measured while it is consumed. The calls inside an other
+    operation are part of that operation
+    """
+    if _operation.get() is not None:
+        return func(*args,**kwargs)
+    key = (getattr(args[0],"name",None) if args else None,func.__name__)
+    token = _operation.set(key)
+    started = time.perf_counter()
+    try:
+        result = func(*args,**kwargs)
+    except BaseException:
+        _record_call(key,time.perf_counter()-started,True)
+        raise
+    finally:
+        _operation.reset(token)
+    if isinstance(result,types.GeneratorType):
+        return _measure_generator(key,result,time.perf_counter()-started)
+    _record_call(key,time.perf_counter()-started,False)
+    return result
+
+
+def _measure_generator(key:typing.Tuple[str,str],generator:typing.Iterator,
+                       seconds:float) -> typing.Iterator:
+    #the operation is active only inside the generator, not between its items
+    failed = True
+    try:
+        while True:
+            token = _operation.set(key)
+            started = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                failed = False
+                return
+            finally:
+                seconds += time.perf_counter() - started
+                _operation.reset(token)
+            try:
+                yield item
+            except GeneratorExit:
+                #the consumer stopped early
+                failed = False
+                generator.close()
+                raise
+    finally:
+        _record_call(key,seconds,failed)
+
+
+async def measure_async(func:typing.Callable,args:tuple,kwargs:dict):
+    """
+    Awaits the stat coroutine `func` as a measured operation, see
+    :func:`measure`
+    """
+    if _operation.get() is not None:
+        return await func(*args,**kwargs)
+    with _measure(getattr(args[0],"name",None) if args else None,func.__name__):
+        return await func(*args,**kwargs)
+
+
+def _escape(value) -> str:
+    if value is None:
+        return ""
+    return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+
+def get_prometheus_text() -> str:
+    """
+    Returns the metrics in the Prometheus text exposition format
+    """
+    metrics = get_metrics()
+    lines = []
+
+    def add(name:str,kind:str,help_text:str,field:str) -> None:
+        lines.append("# HELP %s %s" % (name,help_text))
+        lines.append("# TYPE %s %s" % (name,kind))
+        for (stat_name,operation_name),values in sorted(metrics.items(),key=str):
+            lines.append('%s{stat="%s",operation="%s"} %s' % (
+                name,_escape(stat_name),_escape(operation_name),getattr(values,field)))
+
+    add("mongostats_round_trips_total","counter","Database commands sent","round_trips")
+    add("mongostats_failed_round_trips_total","counter","Database commands failed","failed_round_trips")
+    add("mongostats_bytes_sent_total","counter","Size of the commands sent","bytes_sent")
+    add("mongostats_bytes_received_total","counter","Size of the replies received","bytes_received")
+    add("mongostats_database_seconds_total","counter","Time of the database commands","database_seconds")
+    add("mongostats_operation_errors_total","counter","Operations raising an exception","errors")
+
+    name = "mongostats_operation_duration_seconds"
+    lines.append("# HELP %s Duration of the stat operations" % name)
+    lines.append("# TYPE %s histogram" % name)
+    for (stat_name,operation_name),values in sorted(metrics.items(),key=str):
+        labels = 'stat="%s",operation="%s"' % (_escape(stat_name),_escape(operation_name))
+        for bound,count in zip(BUCKETS,values.latency_buckets):
+            lines.append('%s_bucket{%s,le="%s"} %d' % (name,labels,bound,count))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name,labels,values.calls))
+        lines.append("%s_sum{%s} %s" % (name,labels,values.seconds))
+        lines.append("%s_count{%s} %d" % (name,labels,values.calls))
+    return "\n".join(lines)+"\n"
+
+
+def start_metrics_server(port:int,addr:str=""):
+    """
+    Serves :func:`get_prometheus_text` over HTTP on a daemon thread for
+    Prometheus to scrape. Returns the `http.server.HTTPServer`, `shutdown()`
+    stops it
+    """
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            body = get_prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type","text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self,format,*args) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer((addr,port),Handler)
+    thread = threading.Thread(target=server.serve_forever,name="mongostats-metrics",daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,65 @@
+import concurrent.futures
+import inspect
+import typing
+from datetime import datetime
+
+from . import main
+from .main import ConfigError,EventInterval,MultiNumericStat,StatBase
+
+
+def get_many(stats:typing.Iterable[StatBase],interval:EventInterval,
+             start_date:datetime,end_date:datetime,
+             parameters:typing.Union[typing.Iterable,typing.Dict[str,typing.Iterable]]=None,
+             max_workers:int=8) -> typing.Tuple[typing.List[datetime],typing.Dict[typing.Any,list]]:
+    """
+    Gets the data of many stats from the time range at once, the stats are
+    read concurrently on a thread pool of `max_workers` threads.
+
+    Returns the shared time axis and a table of columns: an :class:`EventStat`
+    gives the column `name`, a :class:`MultiNumericStat` a column
+    `(name, key)` for every key. The missing values are 0. The stats must
+    have the same timezone, their buckets are matched by their keys.
+
+    :Parameters:
+      - `parameters` (optional): keys read from the MultiNumericStats, either
+        one list for all of them or a dict of lists by stat name. Every listed
+        key gets a column
+    """
+    if main.dbclient is None:
+        raise ConfigError("The database connection is not initialized")
+
+    stats = list(stats)
+    if any(inspect.iscoroutinefunction(stat.get_data_view) for stat in stats):
+        raise ConfigError("The async stats can not be read by get_many")
+    if len({str(stat.timezone) for stat in stats}) > 1:
+        raise ConfigError("The stats read together must have the same timezone")
+
+    def get_parameters(stat:StatBase):
+        if isinstance(parameters,dict):
+            return parameters.get(stat.name)
+        return parameters
+
+    def read(stat:StatBase):
+        if isinstance(stat,MultiNumericStat):
+            return stat.get_data_view(interval,start_date,end_date,
+                                      parameters=get_parameters(stat))
+        return stat.get_data_view(interval,start_date,end_date)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        views = list(pool.map(read,stats))
+
+    times = sorted({time for view_times,_ in views for time in view_times})
+    table = {}
+    for stat,(view_times,values) in zip(stats,views):
+        by_time = dict(zip(view_times,values))
+        if not isinstance(stat,MultiNumericStat):
+            table[stat.name] = [by_time.get(time,0) for time in times]
+            continue
+        keys = get_parameters(stat)
+        if keys is None:
+            keys = {}
+            for value in values:
+                keys.update(dict.fromkeys(value))
+        for key in keys:
+            table[(stat.name,key)] = [by_time.get(time,{}).get(key,0) for time in times]
+    return times,table
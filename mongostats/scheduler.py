@@ -0,0 +1,57 @@
+import concurrent.futures
+import inspect
+import time
+import typing
+from datetime import datetime,timezone
+
+from . import main,metrics
+from .main import ConfigError,StatBase
+
+
+class IntervalResult(typing.NamedTuple):
+    """
+    Outcome of the `on_interval` work of one stat in :func:`run_interval`
+    """
+    stat: StatBase
+    seconds: float
+    "Time spent on the stat"
+    error: typing.Optional[BaseException]
+    "The exception raised by the stat, if any"
+
+
+def run_interval(stats:typing.Iterable[StatBase]=None,
+                 max_workers:int=8) -> typing.List[IntervalResult]:
+    """
+    Does the `on_interval` work of many stats at once. The rollup watermarks
+    of all stats are loaded in one query, then the stats run on a thread
+    pool of `max_workers` threads. By default every stat created in this
+    process is processed.
+
+    Returns the time spent on each stat, a failing stat does not stop the
+    others
+    """
+    if main.dbclient is None:
+        raise ConfigError("The database connection is not initialized")
+
+    if stats is None:
+        stats = main.registry
+    #the asyncio stats are driven by mongostats.aio.run_interval
+    stats = [stat for stat in list(stats)
+             if not inspect.iscoroutinefunction(stat.on_interval)]
+
+    now = datetime.now(tz=timezone.utc)
+    watermarks = main.load_watermarks(
+        name for stat in stats for name in stat._get_watermark_names())
+
+    def run(stat:StatBase) -> IntervalResult:
+        started = time.perf_counter()
+        error = None
+        try:
+            with metrics.operation(stat.name,"on_interval"):
+                stat._run_interval(stat._to_stored_time(now),watermarks)
+        except Exception as e:
+            error = e
+        return IntervalResult(stat,time.perf_counter() - started,error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(run,stats))
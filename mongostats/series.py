@@ -0,0 +1,126 @@
+"""
+NumPy/pandas output of the stats. The time axis is built with `numpy.arange`
+and the values are scattered into it by index, there is no per bucket Python
+work apart from reading the cursor. numpy and pandas are optional
+dependencies, they are imported at the first use.
+"""
+import typing
+from datetime import datetime
+
+from . import bucketing
+from .main import ConfigError,EventInterval,StatBase
+
+_NUMPY_UNITS = {
+    EventInterval.SECOND: "s",
+    EventInterval.MINUTE: "m",
+    EventInterval.HOUR: "h",
+    EventInterval.DAY: "D",
+    EventInterval.MONTH: "M",
+}
+
+
+def _import():
+    try:
+        import numpy
+        import pandas
+    except ImportError as e:
+        raise ConfigError("numpy and pandas are needed for the series output") from e
+    return numpy,pandas
+
+
+def get_time_axis(interval:EventInterval,start_date:datetime,
+                  end_date:datetime,tz=None):
+    """
+    Returns the start of every bucket of `interval` between `start_date` and
+    `end_date` as a `datetime64` array. With a `tz` the times are UTC and the
+    buckets follow the zone
+    """
+    numpy,_ = _import()
+    if tz is not None and interval >= EventInterval.HOUR:
+        #the hours, days and months of a zone are not whole units of UTC
+        times = []
+        time = bucketing.truncate(interval,start_date,tz)
+        while time <= end_date:
+            times.append(time)
+            time = bucketing.shift(interval,time,1,tz)
+        return numpy.array(times,dtype="datetime64[s]")
+
+    unit = _NUMPY_UNITS[interval]
+    first = numpy.datetime64(StatBase.get_datetime_for_interval(interval,start_date),unit)
+    last = numpy.datetime64(end_date,unit)
+    return numpy.arange(first,last+1,dtype="datetime64["+unit+"]")
+
+
+def _get_positions(numpy,interval:EventInterval,axis,times:list):
+    """
+    Index of the times in the axis, -1 if a time is not on the axis
+    """
+    if axis.dtype == numpy.dtype("datetime64[s]") and interval >= EventInterval.HOUR:
+        times = numpy.array(times,dtype="datetime64[s]")
+        positions = numpy.searchsorted(axis,times)
+        found = positions < len(axis)
+        found[found] = axis[positions[found]] == times[found]
+        return numpy.where(found,positions,-1)
+    unit = _NUMPY_UNITS[interval]
+    positions = (numpy.array(times,dtype="datetime64["+unit+"]") - axis[0]).astype("int64")
+    return positions
+
+
+def build_series(interval:EventInterval,start_date:datetime,
+                 end_date:datetime,docs:typing.Iterable[dict],name:str=None,
+                 tz=None):
+    """
+    Creates a `pandas.Series` indexed by bucket start from the
+    `{"_id": time, "value": value}` documents, the missing buckets are 0
+    """
+    numpy,pandas = _import()
+    axis = get_time_axis(interval,start_date,end_date,tz)
+
+    times = []
+    values = []
+    for doc in docs:
+        times.append(doc["_id"])
+        values.append(doc["value"])
+
+    values = numpy.asarray(values) if values else numpy.zeros(0,dtype="int64")
+    data = numpy.zeros(len(axis),dtype=values.dtype if values.dtype.kind in "iuf" else "float64")
+    if times:
+        positions = _get_positions(numpy,interval,axis,times)
+        inside = (positions >= 0) & (positions < len(axis))
+        data[positions[inside]] = values[inside]
+
+    index = pandas.DatetimeIndex(axis.astype("datetime64[ns]"),name="time")
+    return pandas.Series(data,index=index,name=name)
+
+
+def build_frame(interval:EventInterval,start_date:datetime,
+                end_date:datetime,docs:typing.Iterable[dict],tz=None):
+    """
+    Creates a wide `pandas.DataFrame` indexed by bucket start with a column
+    for every key from the `{"_id": {"time": time, "key": key}, "value":
+    value}` documents, the missing values are 0
+    """
+    numpy,pandas = _import()
+    axis = get_time_axis(interval,start_date,end_date,tz)
+
+    times = []
+    keys = []
+    values = []
+    for doc in docs:
+        if doc["_id"]["key"] == "__marker__":
+            continue
+        times.append(doc["_id"]["time"])
+        keys.append(doc["_id"]["key"])
+        values.append(doc["value"])
+
+    codes,columns = pandas.factorize(pandas.Index(keys,dtype=object),sort=True)
+    values = numpy.asarray(values) if values else numpy.zeros(0,dtype="int64")
+    data = numpy.zeros((len(axis),len(columns)),
+                       dtype=values.dtype if values.dtype.kind in "iuf" else "float64")
+    if times:
+        positions = _get_positions(numpy,interval,axis,times)
+        inside = (positions >= 0) & (positions < len(axis))
+        data[positions[inside],codes[inside]] = values[inside]
+
+    index = pandas.DatetimeIndex(axis.astype("datetime64[ns]"),name="time")
+    return pandas.DataFrame(data,index=index,columns=pandas.Index(columns,name="key"))
@@ -0,0 +1,206 @@
+"""
+Compact summaries of large data streams used by the stats
+"""
+import hashlib
+import heapq
+import math
+import typing
+import zlib
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters summary. It keeps at most `capacity` keys, a
+    new key replaces the smallest one and inherits its count as error. Every
+    key whose total is larger than `total / capacity` is guaranteed to be
+    kept. The amounts must not be negative.
+    """
+    __slots__ = ("capacity","counts","errors","_heap")
+
+    def __init__(self,capacity:int) -> None:
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        #min heap of (count, key), the entries with an outdated count are
+        #skipped when popped
+        self._heap = []
+
+    def add(self,key,amount) -> None:
+        counts = self.counts
+        if key in counts:
+            counts[key] += amount
+        else:
+            if len(counts) < self.capacity:
+                counts[key] = amount
+                self.errors[key] = 0
+            else:
+                floor = self._pop_min()
+                counts[key] = floor + amount
+                self.errors[key] = floor
+        heapq.heappush(self._heap,(counts[key],id(key),key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count,id(k),k) for k,count in counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count,_,key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                del self.errors[key]
+                return count
+
+    def guaranteed(self) -> typing.Tuple[typing.Dict[typing.Any,float],float]:
+        """
+        Returns the guaranteed part of the count of every kept key, and the
+        rest of the total that can not be attributed to a key
+        """
+        guaranteed = {key: count - self.errors[key]
+                      for key,count in self.counts.items()}
+        return guaranteed,sum(self.errors.values())
+
+
+_POWERS = [2.0 ** -rank for rank in range(66)]
+
+
+class HyperLogLog:
+    """
+    HyperLogLog distinct counter with `2 ** precision` one byte registers,
+    the standard error of the count is about `1.04 / sqrt(2 ** precision)`.
+    The items are hashed by their `repr`, so the registers are the same in
+    every process and two counters are merged by keeping the larger
+    registers. Merging is idempotent, a counter can be merged more than once.
+    """
+    __slots__ = ("precision","registers")
+
+    def __init__(self,precision:int=12,registers:bytes=None) -> None:
+        if not 4 <= precision <= 16:
+            raise ValueError("The precision must be between 4 and 16")
+        self.precision = precision
+        if registers is None:
+            self.registers = bytearray(1 << precision)
+        else:
+            self.registers = bytearray(registers)
+
+    def add(self,item) -> None:
+        digest = hashlib.blake2b(repr(item).encode(),digest_size=8).digest()
+        value = int.from_bytes(digest,"big")
+        bits = 64 - self.precision
+        index = value >> bits
+        #position of the first 1 bit of the rest of the hash
+        rank = bits - (value & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self,other:"HyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError("Only counters of the same precision can be merged")
+        self.registers = bytearray(map(max,self.registers,other.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(_POWERS[rank] for rank in self.registers)
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            #linear counting is more accurate for the small counts
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        """
+        Compact form of the counter, the registers are compressed
+        """
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls,data:bytes) -> "HyperLogLog":
+        return cls(data[0],zlib.decompress(data[1:]))
+
+
+class DDSketch:
+    """
+    DDSketch quantile summary: the values are counted in logarithmic bins, a
+    quantile is returned with at most `relative_accuracy` relative error.
+    The bins are keyed by integer index, two sketches of the same accuracy
+    are merged by adding the bins, so they can be summed up with `$inc` in
+    the database. Negative values have their own bins.
+    """
+    __slots__ = ("relative_accuracy","gamma","_log_gamma","positive",
+                 "negative","zero","count")
+
+    def __init__(self,relative_accuracy:float=0.01) -> None:
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("The relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+
+    def get_index(self,value:float) -> int:
+        """
+        Index of the bin of the absolute value of a non zero `value`
+        """
+        return math.ceil(math.log(abs(value)) / self._log_gamma)
+
+    def get_value(self,index:int) -> float:
+        """
+        The value a bin stands for, within the relative accuracy of every
+        value in the bin
+        """
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self,value:float,count:int=1) -> None:
+        if value > 0:
+            index = self.get_index(value)
+            self.positive[index] = self.positive.get(index,0) + count
+        elif value < 0:
+            index = self.get_index(value)
+            self.negative[index] = self.negative.get(index,0) + count
+        else:
+            self.zero += count
+        self.count += count
+
+    def add_bins(self,positive:typing.Dict[typing.Any,int]=None,
+                 negative:typing.Dict[typing.Any,int]=None,zero:int=0) -> None:
+        """
+        Adds the counts of bins, the keys may be strings as stored in the
+        database
+        """
+        for bins,target in ((positive,self.positive),(negative,self.negative)):
+            for index,count in (bins or {}).items():
+                index = int(index)
+                target[index] = target.get(index,0) + count
+                self.count += count
+        self.zero += zero
+        self.count += zero
+
+    def merge(self,other:"DDSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches of the same accuracy can be merged")
+        self.add_bins(other.positive,other.negative,other.zero)
+
+    def quantile(self,q:float) -> typing.Optional[float]:
+        """
+        Returns the estimated `q` quantile, `q` is between 0 and 1, None if
+        the sketch is empty
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative,reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self.get_value(index)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self.get_value(index)
+        return self.get_value(max(self.positive))
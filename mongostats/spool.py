@@ -0,0 +1,238 @@
+"""
+Local write-ahead spool of the increments. With a spool the `on_event`
+calls of a stat only append a record to a local file, the records are
+written to the database later by :meth:`Spool.replay`, so a slow or
+unreachable server does not block or lose the events.
+"""
+import atexit
+import logging
+import os
+import pickle
+import struct
+import threading
+import typing
+import uuid
+import weakref
+import zlib
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+#length and CRC32 of the payload
+_HEADER = struct.Struct("<II")
+_SUFFIX = ".seg"
+
+
+class Spool:
+    """
+    Append-only log of increments in a directory of segment files. A record
+    is the pickled `(stat name, bucket, amount)` framed by its length and
+    CRC32, a torn record at the end of a segment (a crash during the write)
+    is ignored.
+
+    The delivery is at least once: a segment is deleted only after all its
+    increments are written. The replay of a segment is idempotent, the
+    updated documents remember the last `window` segments applied to them
+    and skip those. A directory must be used by one process at a time.
+    """
+    def __init__(self,path:str,segment_size:int=4*1024*1024,fsync:bool=False,
+                 window:int=64) -> None:
+        """
+        :Parameters:
+          - `path`: directory of the segments, it is created if missing. The
+            segments left by a previous process are replayed too
+          - `segment_size` (optional): a new segment is started when the
+            current one reaches this many bytes
+          - `fsync` (optional): if True every record is synced to the disk,
+            otherwise it is handed to the OS, that survives a crash of the
+            process but not of the machine
+          - `window` (optional): number of segment ids remembered in the
+            updated documents, a segment must be replayed again before this
+            many newer segments are applied to the same bucket
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.window = window
+        os.makedirs(path,exist_ok=True)
+
+        id_path = os.path.join(path,"id")
+        if not os.path.exists(id_path):
+            with open(id_path,"w") as f:
+                f.write(uuid.uuid4().hex)
+        with open(id_path) as f:
+            self.spool_id = f.read().strip()
+            "Identifies the segments of this spool in the database"
+
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        #the previous process may have left a torn record, it never appends
+        #to an existing segment. The segment ids are never reused, the
+        #updated documents remember the replayed ones
+        sequences = self._get_sequences()
+        self._sequence = max(sequences[-1]+1 if sequences else 0,self._read_next_sequence())
+        self._file = None
+        self._replayer = None
+        _spools.add(self)
+
+    def _get_sequences(self) -> typing.List[int]:
+        return sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(_SUFFIX))
+
+    def _read_next_sequence(self) -> int:
+        try:
+            with open(os.path.join(self.path,"sequence")) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_next_sequence(self,sequence:int) -> None:
+        #written before the segment is created, replaced atomically
+        temp_path = os.path.join(self.path,"sequence.tmp")
+        with open(temp_path,"w") as f:
+            f.write(str(sequence))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temp_path,os.path.join(self.path,"sequence"))
+
+    def _get_segment_path(self,sequence:int) -> str:
+        return os.path.join(self.path,"%020d%s" % (sequence,_SUFFIX))
+
+    def register(self,stat) -> None:
+        """
+        Makes the records of `stat` replayable, the stats given a spool are
+        registered when they are created
+        """
+        self._stats[stat.name] = stat
+
+    def add(self,stat,bucket,amount) -> None:
+        """
+        Appends an increment of a stat. The `bucket` is the key the stat uses
+        to identify the document it writes to
+        """
+        payload = pickle.dumps((stat.name,bucket,amount),pickle.HIGHEST_PROTOCOL)
+        record = _HEADER.pack(len(payload),zlib.crc32(payload))+payload
+        with self._lock:
+            if self._file is None:
+                self._write_next_sequence(self._sequence+1)
+                self._file = open(self._get_segment_path(self._sequence),"ab")
+            self._file.write(record)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            if self._file.tell() >= self.segment_size:
+                self._seal()
+
+    def _seal(self) -> None:
+        #called with the lock held
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._sequence += 1
+
+    @staticmethod
+    def _read(path:str) -> typing.Iterator[tuple]:
+        with open(path,"rb") as f:
+            data = f.read()
+        position = 0
+        while position + _HEADER.size <= len(data):
+            length,crc = _HEADER.unpack_from(data,position)
+            payload = data[position+_HEADER.size:position+_HEADER.size+length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logger.warning("Torn record in the spool segment %s, the rest is ignored",path)
+                return
+            yield pickle.loads(payload)
+            position += _HEADER.size + length
+
+    def replay(self) -> int:
+        """
+        Writes the increments of the spool to the database, the increments
+        of a segment are summed up per bucket first. The segments with
+        records of stats not registered yet are kept for a later replay.
+
+        Returns the number of replayed records
+        """
+        with self._replay_lock:
+            with self._lock:
+                self._seal()
+                sequences = [sequence for sequence in self._get_sequences()
+                             if sequence < self._sequence]
+
+            replayed = 0
+            for sequence in sequences:
+                path = self._get_segment_path(sequence)
+                increments = {}
+                count = 0
+                for stat_name,bucket,amount in Spool._read(path):
+                    stat_increments = increments.setdefault(stat_name,{})
+                    stat_increments[bucket] = stat_increments.get(bucket,0) + amount
+                    count += 1
+
+                missing = [name for name in increments if name not in self._stats]
+                if missing:
+                    logger.warning("The spool segment %s is kept, the stats %s are not registered",
+                                   path,", ".join(missing))
+                    continue
+
+                segment = "%s:%d" % (self.spool_id,sequence)
+                for stat_name,stat_increments in increments.items():
+                    stat = self._stats[stat_name]
+                    with metrics.operation(stat.name,"replay"):
+                        stat._apply_increments(stat_increments,segment)
+                os.remove(path)
+                replayed += count
+            return replayed
+
+    def start_replay(self,period:float=1.0) -> None:
+        """
+        Starts a daemon thread replaying the spool every `period` seconds,
+        the failed replays are retried in the next round
+        """
+        if self._replayer is not None and self._replayer.is_alive():
+            return
+        stopping = threading.Event()
+
+        def run() -> None:
+            while not stopping.wait(period):
+                try:
+                    self.replay()
+                except Exception:
+                    logger.exception("Replaying the mongostats spool failed")
+
+        self._replayer = threading.Thread(target=run,name="mongostats-spool",daemon=True)
+        self._replayer.stopping = stopping
+        self._replayer.start()
+
+    def stop_replay(self) -> None:
+        """
+        Stops the thread started by :meth:`start_replay`
+        """
+        if self._replayer is not None:
+            self._replayer.stopping.set()
+            self._replayer.join()
+            self._replayer = None
+
+    def close(self) -> None:
+        """
+        Stops the replay thread and closes the current segment, the records
+        stay on disk until they are replayed
+        """
+        self.stop_replay()
+        with self._lock:
+            self._seal()
+
+
+_spools = weakref.WeakSet()
+
+
+@atexit.register
+def _replay_at_exit() -> None:
+    for spool in list(_spools):
+        try:
+            spool.replay()
+        except Exception:
+            #the records stay in the segments for the next process
+            logger.exception("Replaying the mongostats spool at exit failed")
@@ -0,0 +1,367 @@
+"""
+Alternative storage layouts for :class:`EventStat` and the stats built on it.
+Pass an instance as the `storage` parameter of the stat, one instance can be
+shared by any number of stats.
+"""
+import typing
+from datetime import datetime
+
+import pymongo
+import pymongo.errors
+
+from . import main
+from .main import EventInterval,StatBase
+
+
+class BucketedStorage:
+    """
+    Stores every stat in one collection. A document holds every bucket of an
+    interval inside the next larger period: the seconds of a minute, the
+    minutes of an hour, the hours of a day, the days of a month and the months
+    of a year. The buckets are fields of the `v` subdocument keyed by their
+    position in the period, and are updated with `$inc` on `v.<position>`.
+
+    Compared to the default layout there are two collections less per
+    interval per stat, and reading a range touches only a handful of
+    documents.
+    """
+    def __init__(self,collection:str="mongostats_buckets") -> None:
+        """
+        :Parameters:
+          - `collection`: name of the shared collection
+        """
+        self.collection_name = collection
+
+    def _get_collection(self):
+        return main.database[self.collection_name]
+
+    @staticmethod
+    def get_period(interval:EventInterval,time:datetime) -> datetime:
+        """
+        Start of the period the bucket of `time` is stored in
+        """
+        if interval == EventInterval.MONTH:
+            return time.replace(month=1,day=1,hour=0,minute=0,second=0,microsecond=0)
+        return StatBase.get_datetime_for_interval(EventInterval(interval.value+1),time)
+
+    @staticmethod
+    def get_position(interval:EventInterval,time:datetime) -> int:
+        """
+        Position of the bucket of `time` inside its period
+        """
+        if interval == EventInterval.SECOND:
+            return time.second
+        if interval == EventInterval.MINUTE:
+            return time.minute
+        if interval == EventInterval.HOUR:
+            return time.hour
+        if interval == EventInterval.DAY:
+            return time.day
+        return time.month
+
+    @staticmethod
+    def get_bucket_time(interval:EventInterval,period:datetime,
+                        position:int) -> datetime:
+        """
+        The inverse of :meth:`get_period` and :meth:`get_position`
+        """
+        if interval == EventInterval.SECOND:
+            return period.replace(second=position)
+        if interval == EventInterval.MINUTE:
+            return period.replace(minute=position)
+        if interval == EventInterval.HOUR:
+            return period.replace(hour=position)
+        if interval == EventInterval.DAY:
+            return period.replace(day=position)
+        return period.replace(month=position)
+
+    @staticmethod
+    def get_document_id(stat:StatBase,interval:EventInterval,
+                        period:datetime) -> dict:
+        #the field order matters, the documents of a stat and an interval are
+        #ordered by period in the _id index
+        return {"stat":stat.name,"interval":str(interval),"period":period}
+
+    def _locate(self,stat:StatBase,interval:EventInterval,
+                time:datetime) -> typing.Tuple[dict,str]:
+        period = BucketedStorage.get_period(interval,time)
+        position = BucketedStorage.get_position(interval,time)
+        return (BucketedStorage.get_document_id(stat,interval,period),
+                "v."+str(position))
+
+    def increment(self,stat:StatBase,time:datetime,amount) -> None:
+        _id,field = self._locate(stat,stat.intervals[0],time)
+        self._get_collection().update_one({"_id":_id},{"$inc":{field:amount}},upsert=True)
+
+    def put_max(self,stat:StatBase,time:datetime,value) -> None:
+        _id,field = self._locate(stat,stat.intervals[0],time)
+        self._get_collection().update_one({"_id":_id},{"$max":{field:value}},upsert=True)
+
+    def apply_increments(self,stat:StatBase,
+                         increments:typing.Dict[datetime,int]) -> None:
+        #the buckets of the same period are written in one update
+        updates = {}
+        for time,amount in increments.items():
+            period = BucketedStorage.get_period(stat.intervals[0],time)
+            position = BucketedStorage.get_position(stat.intervals[0],time)
+            fields = updates.setdefault(period,{})
+            field = "v."+str(position)
+            fields[field] = fields.get(field,0) + amount
+
+        try:
+            self._get_collection().bulk_write([
+                pymongo.UpdateOne(
+                    {"_id":BucketedStorage.get_document_id(stat,stat.intervals[0],period)},
+                    {"$inc":fields},upsert=True)
+                for period,fields in updates.items()
+            ],ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            groups = {period:[] for period in updates}
+            for time,amount in increments.items():
+                groups[BucketedStorage.get_period(stat.intervals[0],time)].append((time,amount))
+            main._set_unwritten(e,list(groups.values()))
+            raise
+
+    has_watermarks = True
+    "The rollups record their progress in the watermarks of the stat"
+
+    def rollup(self,stat:StatBase,now:datetime,
+               watermarks:typing.Dict[str,datetime]=None) -> None:
+        if watermarks is None:
+            watermarks = main.load_watermarks(stat._get_watermark_names())
+        #every interval is summed up from the previous one, see
+        #StatBase._get_merge_windows
+        for interval,start,end in stat._get_merge_windows(now,watermarks):
+            source_interval = EventInterval(interval.value-1)
+            #the source of a bucket is exactly one document: the period of
+            #the smaller interval is the bucket itself
+            times = []
+            time = start
+            while time < end:
+                times.append(time)
+                time = stat._shift_bucket(interval,time,1)
+            sources = {}
+            for doc in self._get_collection().find({"_id":{"$in":[
+                    BucketedStorage.get_document_id(stat,source_interval,time) for time in times]}}):
+                sources[doc["_id"]["period"]] = list(doc.get("v",{}).values())
+
+            fields = {}
+            for time in times:
+                values = sources.get(time,[])
+                value = max(values,default=0) if stat.accumulator == "$max" else sum(values)
+                target_id,field = self._locate(stat,interval,time)
+                fields.setdefault(target_id["period"],{})[field] = value
+            self._get_collection().bulk_write([
+                pymongo.UpdateOne(
+                    {"_id":BucketedStorage.get_document_id(stat,interval,period)},
+                    {"$set":values},upsert=True)
+                for period,values in fields.items()
+            ],ordered=False)
+            main.database[main.WATERMARK_COLLECTION].bulk_write(
+                stat._get_watermark_updates([(interval,start,end)]),ordered=False)
+
+    def find(self,stat:StatBase,interval:EventInterval,start_date:datetime,
+             end_date:datetime) -> typing.Iterator[dict]:
+        first = BucketedStorage.get_document_id(
+            stat,interval,BucketedStorage.get_period(interval,start_date))
+        last = BucketedStorage.get_document_id(
+            stat,interval,BucketedStorage.get_period(interval,end_date))
+        cursor = self._get_collection().find(
+            filter={"_id":{"$gte":first,"$lte":last}},
+            sort=[("_id",pymongo.ASCENDING)]
+        )
+        for doc in cursor:
+            period = doc["_id"]["period"]
+            positions = sorted(int(position) for position in doc.get("v",{}))
+            for position in positions:
+                time = BucketedStorage.get_bucket_time(interval,period,position)
+                if start_date <= time <= end_date:
+                    yield {"_id":time,"value":doc["v"][str(position)]}
+
+
+def migrate_to_bucketed(stat:StatBase,storage:BucketedStorage,
+                        drop:bool=False,batch_size:int=1000) -> int:
+    """
+    Copies the data of a stat from the default collection per interval layout
+    into a :class:`BucketedStorage`. Existing buckets in the target are
+    overwritten. If `drop` is True the old collections are dropped after the
+    copy.
+
+    Returns the number of copied buckets
+    """
+    if main.database is None:
+        raise main.ConfigError("The database connection is not initialized")
+
+    copied = 0
+    target = storage._get_collection()
+    for interval in stat.intervals:
+        source = main.database[stat.name+"_"+str(interval)]
+        pending = {}
+
+        def write():
+            if pending:
+                target.bulk_write([
+                    pymongo.UpdateOne(
+                        {"_id":BucketedStorage.get_document_id(stat,interval,period)},
+                        {"$set":fields},upsert=True)
+                    for period,fields in pending.items()
+                ],ordered=False)
+                pending.clear()
+
+        if stat._get_time_field(interval) == "_id":
+            docs = source.find(sort=[("_id",pymongo.ASCENDING)])
+        else:
+            #the sub-counters of a multi-writer stat are merged
+            docs = stat._find_data_view(interval,datetime.min,datetime.max,batch_size=batch_size)
+        for doc in docs:
+            period = BucketedStorage.get_period(interval,doc["_id"])
+            position = BucketedStorage.get_position(interval,doc["_id"])
+            pending.setdefault(period,{})["v."+str(position)] = doc["value"]
+            copied += 1
+            if len(pending) >= batch_size:
+                write()
+        write()
+
+        if drop:
+            source.drop()
+    return copied
+
+
+_DATE_TRUNC_UNITS = {
+    EventInterval.SECOND: "second",
+    EventInterval.MINUTE: "minute",
+    EventInterval.HOUR: "hour",
+    EventInterval.DAY: "day",
+    EventInterval.MONTH: "month",
+}
+
+
+class TimeSeriesStorage:
+    """
+    Stores the buckets of the smallest interval as samples of a MongoDB
+    time series collection (MongoDB 5.0+), the stat name is the metaField.
+    The larger intervals are computed with `$dateTrunc` when they are read,
+    or, with `materialize=True`, at `on_interval` into regular collections
+    named `<collection>_<INTERVAL>`.
+
+    There is no rollup to maintain for the raw data and the server stores it
+    compressed.
+    """
+    def __init__(self,collection:str="mongostats_timeseries",
+                 granularity:str="seconds",expire_after_seconds:int=None,
+                 materialize:bool=False) -> None:
+        """
+        :Parameters:
+          - `collection`: name of the time series collection, it is created
+            at the first use
+          - `granularity`: granularity of the time series collection,
+            `"seconds"`, `"minutes"` or `"hours"`
+          - `expire_after_seconds` (optional): the samples are deleted after
+            this time
+          - `materialize` (optional): if True the larger intervals are stored
+            at `on_interval` instead of computed on every read
+        """
+        self.collection_name = collection
+        self.granularity = granularity
+        self.expire_after_seconds = expire_after_seconds
+        self.materialize = materialize
+        self._created = False
+
+    def _get_collection(self):
+        if not self._created:
+            options = {"timeseries":{"timeField":"time","metaField":"meta",
+                                     "granularity":self.granularity}}
+            if self.expire_after_seconds:
+                options["expireAfterSeconds"] = self.expire_after_seconds
+            try:
+                main.database.create_collection(self.collection_name,**options)
+            except pymongo.errors.CollectionInvalid:
+                #created already, maybe by an other process
+                pass
+            self._created = True
+        return main.database[self.collection_name]
+
+    def _get_materialized_collection(self,interval:EventInterval):
+        return main.database[self.collection_name+"_"+str(interval)]
+
+    @staticmethod
+    def _sample(stat:StatBase,time:datetime,value) -> dict:
+        return {"time":time,"meta":{"stat":stat.name},"value":value}
+
+    def increment(self,stat:StatBase,time:datetime,amount) -> None:
+        self._get_collection().insert_one(TimeSeriesStorage._sample(stat,time,amount))
+
+    def put_max(self,stat:StatBase,time:datetime,value) -> None:
+        #the samples of a bucket are combined with the accumulator of the stat
+        self._get_collection().insert_one(TimeSeriesStorage._sample(stat,time,value))
+
+    def apply_increments(self,stat:StatBase,
+                         increments:typing.Dict[datetime,int]) -> None:
+        try:
+            self._get_collection().insert_many([
+                TimeSeriesStorage._sample(stat,time,amount)
+                for time,amount in increments.items()
+            ],ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            main._set_unwritten(e,[[item] for item in increments.items()])
+            raise
+
+    def _get_pipeline(self,stat:StatBase,interval:EventInterval,
+                      start:datetime,end:datetime) -> list:
+        """
+        Aggregation of the samples in `[start, end)` into buckets of
+        `interval`
+        """
+        return [
+            {"$match":{"meta.stat":stat.name,"time":{"$gte":start,"$lt":end}}},
+            {"$group":{
+                "_id":{"$dateTrunc":{"date":"$time","unit":_DATE_TRUNC_UNITS[interval]}},
+                "value":{stat.accumulator:"$value"}
+            }},
+            {"$sort":{"_id":1}}
+        ]
+
+    @property
+    def has_watermarks(self) -> bool:
+        "The rollups record their progress in the watermarks of the stat"
+        return self.materialize
+
+    def rollup(self,stat:StatBase,now:datetime,
+               watermarks:typing.Dict[str,datetime]=None) -> None:
+        if not self.materialize:
+            return
+        if watermarks is None:
+            watermarks = main.load_watermarks(stat._get_watermark_names())
+
+        #every pending period of an interval in one pass, the buckets are
+        #merged into the materialized collection on the server
+        for interval,start,end in stat._get_pending_windows(now,watermarks):
+            pipeline = self._get_pipeline(stat,interval,start,end)[:-1]
+            pipeline.extend([
+                {"$project":{"_id":{"stat":{"$literal":stat.name},"time":"$_id"},"value":True}},
+                {"$merge":{"into":self._get_materialized_collection(interval).name,
+                           "whenMatched":"replace","whenNotMatched":"insert"}}
+            ])
+            self._get_collection().aggregate(pipeline)
+            main.database[main.WATERMARK_COLLECTION].bulk_write(
+                stat._get_watermark_updates([(interval,start,end)]),ordered=False)
+
+    def find(self,stat:StatBase,interval:EventInterval,start_date:datetime,
+             end_date:datetime) -> typing.Iterator[dict]:
+        if self.materialize and interval != stat.intervals[0]:
+            cursor = self._get_materialized_collection(interval).find(
+                filter={"_id":{"$gte":{"stat":stat.name,"time":start_date},
+                               "$lte":{"stat":stat.name,"time":end_date}}},
+                sort=[("_id",pymongo.ASCENDING)]
+            )
+            for doc in cursor:
+                yield {"_id":doc["_id"]["time"],"value":doc["value"]}
+            return
+
+        start = StatBase.get_datetime_for_interval(interval,start_date)
+        end = StatBase.get_next_interval(interval,
+            StatBase.get_datetime_for_interval(interval,end_date))
+        for doc in self._get_collection().aggregate(
+                self._get_pipeline(stat,interval,start,end)):
+            if start_date <= doc["_id"] <= end_date:
+                yield doc
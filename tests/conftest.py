@@ -0,0 +1,65 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from mongostats import main
+
+
+@pytest.fixture
+def database():
+    """
+    Connects the stats to an empty in-memory database
+    """
+    client = mongomock.MongoClient()
+    main.initialize_connection(client,"mongostats_test")
+    main._ensured_indexes.clear()
+    yield main.database
+    main.dbclient = None
+    main.database = None
+
+
+class _AsyncCursor:
+    def __init__(self,cursor) -> None:
+        self.cursor = cursor
+
+    async def to_list(self,length) -> list:
+        return list(self.cursor)
+
+
+class _AsyncCollection:
+    def __init__(self,collection) -> None:
+        self.collection = collection
+
+    def find(self,*args,**kwargs):
+        return _AsyncCursor(self.collection.find(*args,**kwargs))
+
+    def aggregate(self,pipeline,**kwargs):
+        return _AsyncCursor(self.collection.aggregate(pipeline,**kwargs))
+
+    def __getattr__(self,name:str):
+        method = getattr(self.collection,name)
+
+        async def call(*args,**kwargs):
+            return method(*args,**kwargs)
+        return call
+
+
+class _AsyncDatabase:
+    def __init__(self,database) -> None:
+        self.database = database
+
+    def __getitem__(self,name:str):
+        return _AsyncCollection(self.database[name])
+
+
+@pytest.fixture
+def async_database(database):
+    """
+    Connects the async stats to the in-memory database of `database` through
+    an asyncio wrapper
+    """
+    from mongostats import aio
+
+    aio.database = _AsyncDatabase(database)
+    yield database
+    aio.database = None
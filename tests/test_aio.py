@@ -0,0 +1,44 @@
+import asyncio
+from datetime import datetime,timedelta
+
+import pytest
+
+import mongostats
+
+MINUTE = mongostats.EventInterval.MINUTE
+
+
+def test_event_stat(async_database):
+    stat = mongostats.AsyncEventStat("async_event")
+
+    async def run():
+        await stat.on_event()
+        await stat.on_event()
+        await stat.on_interval()
+        now = datetime.now()
+        return await stat.get_data_view(MINUTE,now-timedelta(minutes=1),now)
+
+    _,values = asyncio.run(run())
+    assert sum(values) == 2
+
+
+def test_multi_numeric_stat_parameters(async_database):
+    stat = mongostats.AsyncMultiNumericStat("async_multi")
+
+    async def run():
+        await stat.on_event("a",1)
+        await stat.on_event("b",2)
+        now = datetime.now()
+        return await stat.get_data_view(MINUTE,now-timedelta(minutes=1),now,parameters=["b"])
+
+    _,values = asyncio.run(run())
+    assert values[-1] == {"b":2}
+
+
+def test_blocking_reads_are_rejected(async_database):
+    stat = mongostats.AsyncEventStat("async_blocked")
+    now = datetime.now()
+    with pytest.raises(mongostats.ConfigError):
+        stat.iter_data_view(MINUTE,now,now)
+    with pytest.raises(mongostats.ConfigError):
+        mongostats.get_many([stat],MINUTE,now,now)
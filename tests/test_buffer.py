@@ -0,0 +1,67 @@
+import pymongo.errors
+import pytest
+from mongomock.collection import Collection
+
+import mongostats
+from mongostats.buffer import write_buffer
+
+
+def get_values(database,name):
+    return sorted((doc["_id"]["key"],doc["value"]) for doc in database[name+"_MINUTE"].find())
+
+
+@pytest.fixture
+def failing_bulk_write(monkeypatch):
+    """
+    Makes the next bulk write apply every operation but the first one and
+    raise a BulkWriteError for it
+    """
+    bulk_write = Collection.bulk_write
+    failures = [1]
+
+    def fail_once(self,requests,**kwargs):
+        if not failures[0]:
+            return bulk_write(self,requests,**kwargs)
+        failures[0] -= 1
+        if requests[1:]:
+            bulk_write(self,requests[1:],**kwargs)
+        raise pymongo.errors.BulkWriteError({"writeErrors":[{"index":0,"code":1,"errmsg":"failed"}],
+                                             "writeConcernErrors":[],"nInserted":0})
+    monkeypatch.setattr(Collection,"bulk_write",fail_once)
+    yield
+    write_buffer.flush()
+
+
+def test_failed_flush_requeues_only_the_unwritten_increments(database,failing_bulk_write):
+    stat = mongostats.MultiNumericStat("requeued",buffered=True)
+    for key in "abc":
+        stat.on_event(key,1)
+
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        mongostats.flush()
+    assert len(write_buffer) == 1
+    assert len(get_values(database,"requeued")) == 2
+
+    mongostats.flush()
+    assert len(write_buffer) == 0
+    assert get_values(database,"requeued") == [("a",1),("b",1),("c",1)]
+
+
+def test_failed_flush_keeps_the_increments_of_the_other_stats(database,monkeypatch):
+    first = mongostats.MultiNumericStat("first",buffered=True)
+    second = mongostats.MultiNumericStat("second",buffered=True)
+    first.on_event("a",2)
+    second.on_event("b",3)
+
+    def fail(self,requests,**kwargs):
+        raise pymongo.errors.AutoReconnect("connection lost")
+    with monkeypatch.context() as patch:
+        patch.setattr(Collection,"bulk_write",fail)
+        with pytest.raises(pymongo.errors.AutoReconnect):
+            mongostats.flush()
+    assert len(write_buffer) == 2
+
+    first.on_event("a",1)
+    mongostats.flush()
+    assert get_values(database,"first") == [("a",3)]
+    assert get_values(database,"second") == [("b",3)]
@@ -0,0 +1,44 @@
+from datetime import timedelta
+
+import pytest
+
+import mongostats
+from mongostats import spool as spool_module
+from mongostats.buffer import write_buffer
+from mongostats.spool import Spool
+
+MINUTE = mongostats.EventInterval.MINUTE
+
+
+def read(stat,time):
+    keys,values = stat.get_data_view(MINUTE,time,time)
+    return dict(zip(keys,values))[time]
+
+
+def test_spool_replay_drops_the_cached_buckets(database,tmp_path):
+    spool = Spool(str(tmp_path))
+    cache = mongostats.BucketCache()
+    stat = mongostats.EventStat("late",min_interval=MINUTE,cache=cache,spool=spool)
+    time = stat._get_bucket(MINUTE,stat._get_now()-timedelta(hours=1))
+    stat._increment(time,2)
+    spool.replay()
+    assert read(stat,time) == 2
+    assert cache.get("late",MINUTE,time) == 2
+
+    stat._increment(time,3)
+    spool.replay()
+    assert read(stat,time) == 5
+    spool_module._spools.clear()
+
+
+def test_buffered_buckets_are_not_cached(database):
+    cache = mongostats.BucketCache()
+    stat = mongostats.EventStat("buffered",min_interval=MINUTE,cache=cache,buffered=True)
+    time = stat._get_bucket(MINUTE,stat._get_now()-timedelta(hours=1))
+    write_buffer.add(stat,time,2)
+    try:
+        assert read(stat,time) == 0
+        write_buffer.flush(stat)
+        assert read(stat,time) == 2
+    finally:
+        write_buffer.flush()
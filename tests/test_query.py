@@ -0,0 +1,28 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import mongostats
+
+DAY = mongostats.EventInterval.DAY
+
+
+def test_get_many_matches_the_buckets_by_time(database):
+    first = mongostats.EventStat("first",min_interval=DAY)
+    second = mongostats.MultiNumericStat("second",min_interval=DAY)
+    database["first_DAY"].insert_many([{"_id":datetime(2024,5,1),"value":1},
+                                       {"_id":datetime(2024,5,2),"value":2}])
+    database["second_DAY"].insert_one({"_id":{"time":datetime(2024,5,2),"key":"a"},"value":5})
+
+    times,table = mongostats.get_many([first,second],DAY,datetime(2024,5,1),datetime(2024,5,2))
+    assert times == [datetime(2024,4,30),datetime(2024,5,1),datetime(2024,5,2)]
+    assert table["first"] == [0,1,2]
+    assert table[("second","a")] == [0,0,5]
+
+
+def test_get_many_rejects_different_timezones(database):
+    tokyo = mongostats.EventStat("tokyo",min_interval=DAY,timezone=ZoneInfo("Asia/Tokyo"))
+    local = mongostats.EventStat("local",min_interval=DAY)
+    with pytest.raises(mongostats.ConfigError):
+        mongostats.get_many([tokyo,local],DAY,datetime(2024,5,1),datetime(2024,5,2))
@@ -0,0 +1,49 @@
+from datetime import datetime,timedelta
+
+import mongostats
+
+I = mongostats.EventInterval
+
+
+def get_counts(database,name):
+    return {doc["_id"]:doc["count"] for doc in database[name].find()}
+
+
+def test_distribution_first_run_merges_complete_periods(database):
+    stat = mongostats.DistributionStat("latency")
+    time = datetime(2025,12,1)
+    docs = []
+    while time < datetime(2026,1,3):
+        docs.append({"_id":time,"count":1,"sum":1})
+        time += timedelta(minutes=10)
+    database["latency_MINUTE"].insert_many(docs)
+
+    stat._run_interval(datetime(2026,1,2,10,30))
+    assert get_counts(database,"latency_DAY")[datetime(2026,1,1)] == 144
+    assert get_counts(database,"latency_MONTH")[datetime(2025,12,1)] == 31*144
+
+    #the ticks of a whole day are missed
+    stat._run_interval(datetime(2026,1,3,0,30))
+    assert get_counts(database,"latency_DAY")[datetime(2026,1,2)] == 144
+    assert get_counts(database,"latency_HOUR")[datetime(2026,1,2,23)] == 6
+
+
+def test_bucketed_rollup_catches_up_the_missed_ticks(database):
+    storage = mongostats.BucketedStorage("buckets")
+    stat = mongostats.EventStat("bucketed",max_interval=I.DAY,storage=storage)
+    increments = {}
+    time = datetime(2026,1,1)
+    while time < datetime(2026,1,3,5):
+        increments[time] = 1
+        time += timedelta(minutes=15)
+    storage.apply_increments(stat,increments)
+
+    stat._rollup(datetime(2026,1,1,10,5))
+    #the ticks of almost two days are missed
+    stat._rollup(datetime(2026,1,3,4,5))
+
+    _,values = stat.get_data_view(I.HOUR,datetime(2026,1,1),datetime(2026,1,3,3))
+    assert values[1:] == [4]*(len(values)-1)
+    keys,values = stat.get_data_view(I.DAY,datetime(2026,1,1),datetime(2026,1,3))
+    assert dict(zip(keys,values))[datetime(2026,1,1)] == 96
+    assert dict(zip(keys,values))[datetime(2026,1,2)] == 96
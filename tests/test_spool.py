@@ -0,0 +1,86 @@
+import pytest
+
+import mongostats
+from mongostats import spool as spool_module
+from mongostats.spool import Spool
+
+DAY = mongostats.EventInterval.DAY
+
+
+@pytest.fixture
+def spool_path(tmp_path):
+    yield str(tmp_path)
+    #the spools of a test are not replayed at exit
+    spool_module._spools.clear()
+
+
+def get_value(database,name):
+    return sum(doc["value"] for doc in database[name+"_DAY"].find())
+
+
+def test_replay_writes_the_summed_increments(database,spool_path):
+    spool = Spool(spool_path)
+    stat = mongostats.EventStat("spooled",min_interval=DAY,spool=spool)
+    for _ in range(4):
+        stat.on_event()
+    assert database["spooled_DAY"].count_documents({}) == 0
+
+    assert spool.replay() == 4
+    assert get_value(database,"spooled") == 4
+    assert spool.replay() == 0
+
+
+def test_restart_after_a_full_replay(database,spool_path):
+    spool = Spool(spool_path)
+    stat = mongostats.EventStat("restarted",min_interval=DAY,spool=spool)
+    for _ in range(3):
+        stat.on_event()
+    spool.replay()
+    spool.close()
+
+    spool = Spool(spool_path)
+    stat = mongostats.EventStat("restarted",min_interval=DAY,spool=spool)
+    for _ in range(5):
+        stat.on_event()
+    assert spool.replay() == 5
+    assert get_value(database,"restarted") == 8
+
+
+def test_restart_replays_the_segments_left_behind(database,spool_path):
+    spool = Spool(spool_path)
+    stat = mongostats.EventStat("left",min_interval=DAY,spool=spool)
+    stat.on_event()
+    stat.on_event()
+    spool.close()
+
+    spool = Spool(spool_path)
+    mongostats.EventStat("left",min_interval=DAY,spool=spool)
+    assert spool.replay() == 2
+    assert get_value(database,"left") == 2
+
+
+def test_replaying_a_segment_again_is_skipped(database,spool_path):
+    spool = Spool(spool_path)
+    stat = mongostats.EventStat("again",min_interval=DAY,spool=spool)
+    stat.on_event()
+    spool.replay()
+
+    segment = database["again_DAY"].find_one()["spool"][-1]
+    stat._apply_increments({stat._get_bucket(DAY):1},segment)
+    assert get_value(database,"again") == 1
+
+
+def test_torn_record_is_ignored(database,spool_path):
+    spool = Spool(spool_path,segment_size=1)
+    stat = mongostats.EventStat("torn",min_interval=DAY,spool=spool)
+    stat.on_event()
+    stat.on_event()
+    spool.close()
+    segments = sorted(spool._get_sequences())
+    with open(spool._get_segment_path(segments[-1]),"ab") as f:
+        f.write(b"\x10\x00\x00\x00abc")
+
+    spool = Spool(spool_path)
+    mongostats.EventStat("torn",min_interval=DAY,spool=spool)
+    assert spool.replay() == 2
+    assert get_value(database,"torn") == 2